@@ -0,0 +1,371 @@
+"""
+Persistent cache of rendered answers, shared by every worker process through one SQLite file.
+
+Answers are keyed by the normalized prompt and model name and hold the final rendered HTML.
+Entries expire after a TTL and the least recently used ones are evicted once the cache grows
+past its size budget. Answers the caller marks as not cacheable (generated while an upstream was
+failing) are only kept for the short degraded TTL, so an outage does not outlive itself in the cache.
+
+Identical prompts that arrive while an answer is still being generated are coalesced: the first
+request takes a lease (in-process via a threading.Event, across workers via a lease row) and the
+others wait for its answer instead of running the pipeline again. If the leader fails without
+storing an answer, waiters fall back to generating their own.
+"""
+import hashlib
+import hmac
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import metrics
+import resilience
+from config import env_int, env_flag
+
+ANSWER_CACHE_ENABLED = env_flag("ANSWER_CACHE_ENABLED", True)
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", os.path.join(tempfile.gettempdir(), "bujji_answer_cache.sqlite3"))
+ANSWER_CACHE_TTL = max(0, env_int("ANSWER_CACHE_TTL", 6 * 3600))
+# Lifetime of answers generated while an upstream was failing (e.g. images missing); 0 does not store them
+ANSWER_CACHE_DEGRADED_TTL = max(0, env_int("ANSWER_CACHE_DEGRADED_TTL", 60))
+ANSWER_CACHE_MAX_BYTES = max(0, env_int("ANSWER_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# How long a request waits for an identical in-flight request before generating on its own
+ANSWER_CACHE_WAIT_TIMEOUT = max(0, env_int("ANSWER_CACHE_WAIT_TIMEOUT", 90))
+# Token required for cache bypass and the admin endpoints; unset disables both
+ANSWER_CACHE_ADMIN_TOKEN = os.getenv("ANSWER_CACHE_ADMIN_TOKEN", "")
+
+_POLL_INTERVAL = 0.1  # Seconds between checks while waiting on another worker's lease
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    model TEXT NOT NULL,
+    html TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access);
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Case- and whitespace-insensitive form of a prompt, used for the cache key."""
+    return " ".join(prompt.split()).casefold()
+
+
+class AnswerFlight:
+    """An answer being generated by the caller of AnswerCache.acquire()."""
+    __slots__ = ("key", "prompt", "model_name", "owner", "local_event")
+
+    def __init__(self, key: str, prompt: str, model_name: str, owner: str | None = None, local_event=None):
+        self.key = key
+        self.prompt = prompt
+        self.model_name = model_name
+        self.owner = owner  # Lease owner id when this flight holds the cross-worker lease
+        self.local_event = local_event  # Set when in-process waiters should be woken
+
+
+class AnswerCache:
+    """SQLite-backed answer cache with TTL, size-based LRU eviction and single-flight generation."""
+
+    def __init__(self, path: str, ttl_seconds: float, max_bytes: int, wait_timeout: float, enabled: bool = True,
+                 degraded_ttl_seconds: float = 0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.degraded_ttl_seconds = min(degraded_ttl_seconds, ttl_seconds)
+        self.max_bytes = max_bytes
+        self.wait_timeout = wait_timeout
+        self.enabled = enabled and ttl_seconds > 0 and max_bytes > 0
+        self._local_flights = {}  # key -> threading.Event, for requests in this process
+        self._lock = threading.Lock()
+        self._initialized = False
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.bypassed = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.executescript(_SCHEMA)
+                    self._initialized = True
+        return connection
+
+    def _record(self, outcome: str) -> None:
+        with self._lock:
+            if outcome == "hit":
+                self.hits += 1
+            elif outcome == "miss":
+                self.misses += 1
+            elif outcome == "coalesced":
+                self.coalesced += 1
+            elif outcome == "bypass":
+                self.bypassed += 1
+        metrics.inc("answer_cache_total", outcome=outcome)
+
+    @staticmethod
+    def key_for(prompt: str, model_name: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT html, expires_at FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            html, expires_at = row
+            if expires_at <= now:
+                connection.execute("DELETE FROM answers WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE answers SET last_access = ? WHERE key = ?", (now, key))
+            return html
+        finally:
+            connection.close()
+
+    def put(self, key: str, prompt: str, model_name: str, html: str, ttl_seconds: float | None = None) -> None:
+        now = time.time()
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        size = len(html.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO answers (key, prompt, model, html, size, created_at, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, prompt, model_name, html, size, now, now + ttl_seconds, now),
+            )
+            self._evict(connection, now)
+        finally:
+            connection.close()
+
+    def _evict(self, connection: sqlite3.Connection, now: float) -> None:
+        connection.execute("DELETE FROM answers WHERE expires_at <= ?", (now,))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in connection.execute("SELECT key, size FROM answers ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            connection.execute("DELETE FROM answers WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        if evicted:
+            metrics.inc("answer_cache_evictions_total", evicted)
+
+    def _try_lease(self, key: str, owner: str) -> bool:
+        """Claims the cross-worker lease for key; succeeds if nobody holds it or the holder's lease expired."""
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT expires_at FROM leases WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] > now:
+                connection.execute("COMMIT")
+                return False
+            connection.execute("INSERT OR REPLACE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                               (key, owner, now + self.wait_timeout))
+            connection.execute("COMMIT")
+            return True
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            print(f"WARNING: Could not take answer cache lease ({e}). Generating without coalescing.")
+            return True
+        finally:
+            connection.close()
+
+    def _release_lease(self, key: str, owner: str) -> None:
+        connection = self._connect()
+        try:
+            connection.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+        finally:
+            connection.close()
+
+    def _lease_held(self, key: str) -> bool:
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT expires_at FROM leases WHERE key = ?", (key,)).fetchone()
+            return row is not None and row[0] > time.time()
+        finally:
+            connection.close()
+
+    def _wait_for_other_worker(self, key: str) -> str | None:
+        deadline = time.monotonic() + resilience.cap_timeout(self.wait_timeout)
+        while time.monotonic() < deadline:
+            time.sleep(_POLL_INTERVAL)
+            html = self.get(key)
+            if html is not None:
+                return html
+            if not self._lease_held(key):
+                return None
+        return None
+
+    def acquire(self, prompt: str, model_name: str, bypass: bool = False):
+        """
+        Looks the prompt up and, on a miss, makes the caller responsible for generating it.
+
+        Returns (html, outcome, flight). When html is not None the answer is ready ("hit" or "coalesced").
+        Otherwise the caller must generate the answer and then call finish(flight, html, cacheable), passing
+        html=None if generation failed. outcome is "hit", "coalesced", "miss", "bypass" or "disabled".
+        """
+        if not self.enabled:
+            return None, "disabled", None
+        key = self.key_for(prompt, model_name)
+        if bypass:
+            self._record("bypass")
+            return None, "bypass", AnswerFlight(key, prompt, model_name)
+
+        try:
+            html = self.get(key)
+        except sqlite3.Error as e:
+            print(f"WARNING: Answer cache unavailable ({e}). Generating without cache.")
+            return None, "disabled", None
+        if html is not None:
+            self._record("hit")
+            return html, "hit", None
+
+        # In-process single flight: wait for an identical request already running in this worker
+        with self._lock:
+            local_event = self._local_flights.get(key)
+            leader = local_event is None
+            if leader:
+                local_event = self._local_flights[key] = threading.Event()
+        if not leader:
+            local_event.wait(resilience.cap_timeout(self.wait_timeout))
+            html = self.get(key)
+            if html is not None:
+                self._record("coalesced")
+                return html, "coalesced", None
+            # The leader failed or is taking too long; generate independently
+            self._record("miss")
+            return None, "miss", AnswerFlight(key, prompt, model_name)
+
+        flight = AnswerFlight(key, prompt, model_name, owner=uuid.uuid4().hex, local_event=local_event)
+        # Cross-worker single flight: wait on another process's lease, then take over if it gave up
+        try:
+            if not self._try_lease(key, flight.owner):
+                html = self._wait_for_other_worker(key)
+                if html is not None:
+                    self._record("coalesced")
+                    self._end_local_flight(flight)
+                    return html, "coalesced", None
+                self._try_lease(key, flight.owner)
+        except Exception:
+            self._end_local_flight(flight)
+            raise
+
+        self._record("miss")
+        return None, "miss", flight
+
+    def finish(self, flight, html: str | None, cacheable: bool = True) -> None:
+        """
+        Stores the generated answer (if any) and releases the flight taken by acquire(). Answers that are
+        not cacheable are kept for degraded_ttl_seconds only, or not at all when that is 0.
+        """
+        if flight is None:
+            return
+        try:
+            ttl_seconds = self.ttl_seconds if cacheable else self.degraded_ttl_seconds
+            if html is not None and ttl_seconds > 0:
+                self._safe_put(flight.key, flight.prompt, flight.model_name, html, ttl_seconds)
+        finally:
+            if flight.owner is not None:
+                try:
+                    self._release_lease(flight.key, flight.owner)
+                except sqlite3.Error:
+                    pass
+            self._end_local_flight(flight)
+
+    def _end_local_flight(self, flight) -> None:
+        if flight.local_event is None:
+            return
+        with self._lock:
+            self._local_flights.pop(flight.key, None)
+        flight.local_event.set()
+
+    def get_or_compute(self, prompt: str, model_name: str, compute, bypass: bool = False):
+        """
+        Returns (html, error, outcome). compute() must return (html, error, cacheable); only html results
+        are stored, and with cacheable False only for the degraded TTL (see finish()).
+        """
+        html, outcome, flight = self.acquire(prompt, model_name, bypass=bypass)
+        if html is not None:
+            return html, None, outcome
+        error = None
+        cacheable = True
+        try:
+            html, error, cacheable = compute()
+        finally:
+            self.finish(flight, html, cacheable)
+        return html, error, outcome
+
+    def _safe_put(self, key: str, prompt: str, model_name: str, html: str, ttl_seconds: float | None = None) -> None:
+        try:
+            self.put(key, prompt, model_name, html, ttl_seconds)
+        except sqlite3.Error as e:
+            print(f"WARNING: Could not store answer in cache. Error: {e}")
+
+    def purge(self, prompt: str | None = None, model_name: str | None = None) -> int:
+        """Deletes one prompt's answer (when prompt and model_name are given) or every answer; returns the count."""
+        connection = self._connect()
+        try:
+            if prompt is not None and model_name is not None:
+                cursor = connection.execute("DELETE FROM answers WHERE key = ?", (self.key_for(prompt, model_name),))
+            else:
+                cursor = connection.execute("DELETE FROM answers")
+            return cursor.rowcount
+        finally:
+            connection.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            process_stats = {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "bypassed": self.bypassed,
+                "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+                "ttl_seconds": self.ttl_seconds,
+                "degraded_ttl_seconds": self.degraded_ttl_seconds,
+                "max_bytes": self.max_bytes,
+            }
+        if not self.enabled:
+            return process_stats
+        try:
+            connection = self._connect()
+            try:
+                entries, total = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+            finally:
+                connection.close()
+            process_stats.update({"entries": entries, "bytes": total})
+        except sqlite3.Error as e:
+            process_stats["error"] = str(e)
+        return process_stats
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_BYTES,
+                           ANSWER_CACHE_WAIT_TIMEOUT, enabled=ANSWER_CACHE_ENABLED,
+                           degraded_ttl_seconds=ANSWER_CACHE_DEGRADED_TTL)
+
+
+def is_admin(token: str | None) -> bool:
+    """True when the admin token is configured and the given token matches it."""
+    return bool(ANSWER_CACHE_ADMIN_TOKEN) and token is not None and \
+        hmac.compare_digest(token.encode("utf-8"), ANSWER_CACHE_ADMIN_TOKEN.encode("utf-8"))
@@ -1,101 +1,196 @@
 import os
 import re
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold, GenerationConfig
-import requests
-from bs4 import BeautifulSoup
-from flask import Flask, request, render_template
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, render_template, jsonify, stream_with_context
 from markupsafe import Markup
 import json
-import markdown2
+import time
 import traceback
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
+from config import env_int, env_flag
+import metrics
+import http_client
+import image_search
+import answer_cache
+import resilience
+import local_query
+import image_proxy
+from streaming import MarkdownSectionSplitter, sse_event
+from renderer import HeadingTracker, render_document, render_markdown
 
 app = Flask(__name__)
 
-try:
-    # Access API key from environment variable
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise ValueError("GOOGLE_API_KEY not found in .env file or environment variables.")  # More specific error
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.0-flash')
-except Exception as e:
-    tb_str = traceback.format_exc()
-    print(f"FATAL ERROR: Could not configure or initialize Gemini API. Exception Type: {type(e)}, Error: {e}\nTraceback:\n{tb_str}")
-    model = None
+# Upper bound on image placeholders resolved in parallel within a single /prepare request
+IMAGE_RESOLVE_CONCURRENCY = max(1, env_int("IMAGE_RESOLVE_CONCURRENCY", 6))
+# Generate all image search queries of one explanation with a single Gemini call
+IMAGE_QUERY_BATCH = env_flag("IMAGE_QUERY_BATCH", True)
+# Return text with image slots and let the browser resolve each slot via /api/image when it scrolls into view
+DEFERRED_IMAGES = env_flag("DEFERRED_IMAGES", False)
+# How image search queries are built: "gemini" asks the model, "local" uses keyword extraction (local_query.py) and
+# never calls Gemini, "auto" asks the model and uses the local query instead of the bare heading when that fails
+IMAGE_QUERY_MODE = os.getenv("IMAGE_QUERY_MODE", "auto").strip().lower()
 
-# --- Core Helper Functions ---
-def get_best_image_url(search_query: str, image_index_to_fetch: int = 0) -> str | None:
+# Import google.generativeai and create the model on first use instead of at import time (faster cold starts)
+LAZY_INIT = env_flag("LAZY_INIT", True)
+# Load the model and the other heavy modules in a background thread right after import
+WARMUP_ON_START = env_flag("WARMUP_ON_START", False)
+
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
+
+model = None # Created by get_model(); tests and benchmarks may install a stand-in here
+_model_lock = threading.Lock()
+_model_init_attempted = False
+
+def create_model():
     """
-    Fetches an image URL from Bing based on the search query and the desired image index.
+    Imports the Gemini SDK and creates the model client. Returns None (and logs why) if that fails.
     """
-    if not search_query:
-        print("WARNING: Empty search query provided to get_best_image_url.")
+    try:
+        import google.generativeai as genai # Deferred: the SDK takes about half a second to import
+
+        # Access API key from environment variable
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            raise ValueError("GOOGLE_API_KEY not found in .env file or environment variables.")  # More specific error
+        genai.configure(api_key=api_key)
+        return genai.GenerativeModel(GEMINI_MODEL_NAME)
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(f"FATAL ERROR: Could not configure or initialize Gemini API. Exception Type: {type(e)}, Error: {e}\nTraceback:\n{tb_str}")
         return None
 
-    print(f"INFO: Attempting to find image (index {image_index_to_fetch}) for query: '{search_query}'")
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"}
-    encoded_query = requests.utils.quote(search_query)
-    url = f"https://www.bing.com/images/search?q={encoded_query}&form=HDRSC2"
+def get_model():
+    """
+    Returns the Gemini model, creating it on the first call (thread-safe; only one thread initializes).
+    Returns None if initialization failed; it is not retried.
+    """
+    global model, _model_init_attempted
+    if model is not None or _model_init_attempted:
+        return model
+    with _model_lock:
+        if model is None and not _model_init_attempted:
+            with metrics.timer("model_init"):
+                model = create_model()
+            _model_init_attempted = True
+    return model
 
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        image_elements = soup.find_all("a", {"class": "iusc"})
-
-        if not image_elements:
-            print(f"INFO: No 'iusc' image elements found on Bing for query '{search_query}'. Trying fallback.")
-            img_tags = soup.find_all('img', {'src': re.compile(r'^https?://')})
-            if image_index_to_fetch < len(img_tags):
-                img_tag = img_tags[image_index_to_fetch]
-                src = img_tag.get('src')
-                # Basic filter for meaningful images (size might not always be available)
-                if src and not any(x in src for x in ['logo', 'icon', 'svg', 'spinner', 'loader', 'avatar']):
-                     # Check if it's a data URI (less likely for primary images but good to filter)
-                    if not src.startswith('data:image'):
-                        print(f"SUCCESS (fallback img tag, index {image_index_to_fetch}): Found image for query '{search_query}': {src[:70]}...")
-                        return src
-            print(f"FAILURE: Fallback img tag search also failed or index out of bounds for query '{search_query}'.")
-            return None
+def model_unavailable() -> bool:
+    """True when the model is known to be unusable (no API key, or initialization failed). Never initializes it."""
+    return model is None and (_model_init_attempted or not os.getenv("GOOGLE_API_KEY"))
 
-        if image_index_to_fetch < len(image_elements):
-            target_element = image_elements[image_index_to_fetch]
-            m_data = target_element.get("m")
-            if m_data:
-                try:
-                    m_json = json.loads(m_data)
-                    image_url = m_json.get("murl")
-                    if image_url:
-                        print(f"SUCCESS: Found image (index {image_index_to_fetch}) for query '{search_query}': {image_url[:70]}...")
-                        return image_url
-                except json.JSONDecodeError:
-                    print(f"WARNING: Could not parse 'm' attribute JSON for image element at index {image_index_to_fetch} for query '{search_query}'.")
-        else:
-            print(f"WARNING: Requested image index {image_index_to_fetch} out of bounds. Found {len(image_elements)} 'iusc' elements for query '{search_query}'.")
-        
-        print(f"FAILURE: Could not extract URL for image at index {image_index_to_fetch} for query '{search_query}' using 'iusc' elements.")
+def warm_up() -> None:
+    """
+    Loads what the first /prepare would otherwise pay for: the Gemini model, the Markdown renderer and the
+    HTTP connection pool. Safe to call from several threads; meant for WARMUP_ON_START or a server hook
+    such as gunicorn's post_worker_init.
+    """
+    started = time.perf_counter()
+    get_model()
+    render_markdown("warm-up")
+    http_client.get_client()
+    if image_search.BING_PARSER == "soup":
+        import bs4 # noqa: F401
+    print(f"INFO: Warm-up finished in {time.perf_counter() - started:.2f}s.")
+
+# --- Core Helper Functions ---
+def pick_image_candidate(candidates: list[str | None], image_index_to_fetch: int, search_query: str = "") -> str | None:
+    """
+    Returns the candidate at the requested index, or None if it is missing or out of bounds.
+    """
+    if image_index_to_fetch < len(candidates):
+        image_url = candidates[image_index_to_fetch]
+        if image_url:
+            print(f"SUCCESS: Found image (index {image_index_to_fetch}) for query '{search_query}': {image_url[:70]}...")
+            return image_url
+        metrics.inc("image_lookup_failures_total", reason="no_url")
+        print(f"FAILURE: Could not extract URL for image at index {image_index_to_fetch} for query '{search_query}'.")
         return None
+    metrics.inc("image_lookup_failures_total", reason="out_of_range")
+    print(f"WARNING: Requested image index {image_index_to_fetch} out of bounds. Found {len(candidates)} candidates for query '{search_query}'.")
+    return None
 
-    except requests.exceptions.RequestException as e:
-        print(f"WARNING: Request failed for Bing Image Search ('{search_query}'). Error: {e}")
+def iter_concurrently(func, items: list, max_workers: int):
+    """
+    Applies func to every item on a bounded thread pool and yields the results in input order,
+    each one as soon as it (and every earlier one) is ready.
+    """
+    if not items:
+        return
+    workers = max(1, min(max_workers, len(items)))
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-resolve") as executor:
+        # Each task runs in a copy of the caller's context so per-request metrics follow it into the pool
+        futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+        for future in futures:
+            yield future.result()
+
+def run_concurrently(func, items: list, max_workers: int) -> list:
+    """
+    Applies func to every item on a bounded thread pool and returns the results in input order.
+    """
+    return list(iter_concurrently(func, items, max_workers))
+
+# Plain names (the SDK converts them) so the safety settings do not need the SDK's types at import time
+SAFETY_CONFIGURATIONS = {
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
+}
+
+def call_gemini(purpose: str, prompt: str, **kwargs):
+    """
+    Single entry point for model.generate_content so every Gemini call is counted, globally and per request,
+    goes through the Gemini circuit breaker and is cut off when the request's time budget runs out.
+    Raises resilience.CircuitOpenError without calling Gemini while the circuit is open or saturated.
+    Streaming calls go through generate_explanation_stream, which holds the breaker slot until the stream ends.
+    """
+    with resilience.gemini_breaker.guard(is_failure=is_gemini_outage):
+        return generate_content(purpose, prompt, **kwargs)
+
+def generate_content(purpose: str, prompt: str, **kwargs):
+    """model.generate_content with the budget timeout and call/error counters; callers hold a breaker slot."""
+    timeout = resilience.cap_timeout(None)
+    if timeout is not None:
+        kwargs.setdefault("request_options", {"timeout": max(timeout, 0.5)})
+    metrics.inc("gemini_calls_total", purpose=purpose)
+    try:
+        return get_model().generate_content(prompt, safety_settings=SAFETY_CONFIGURATIONS, **kwargs)
     except Exception as e:
-        print(f"WARNING: An unexpected error occurred while processing Bing Image Search ('{search_query}'). Error: {e}")
-    return None
+        metrics.inc("gemini_errors_total", purpose=purpose, reason="timeout" if is_timeout_error(e) else "error")
+        raise
 
-def generate_explanation(prompt: str) -> str:
+def is_timeout_error(e: Exception) -> bool:
+    """True for client-side timeouts and the API's DeadlineExceeded errors."""
+    return isinstance(e, TimeoutError) or "deadline" in type(e).__name__.lower() or "timeout" in type(e).__name__.lower()
+
+def is_gemini_outage(e: Exception) -> bool:
     """
-    Generates the main explanation from Gemini, asking it to place [IMAGE] placeholders.
+    Errors that say Gemini itself is unavailable (timeouts, connection failures, 429/5xx), as opposed to
+    a rejected prompt. Only these count towards opening the Gemini circuit.
     """
-    if not model:
-        return "Error: AI model is not configured. Please check server logs."
+    if is_timeout_error(e) or isinstance(e, ConnectionError):
+        return True
+    code = getattr(e, "code", None)
+    return isinstance(code, int) and (code == 429 or code >= 500)
 
-    engineered_prompt = f"""
+def response_text(response) -> str | None:
+    """Extracts the text of a Gemini response, joining parts when .text is unavailable."""
+    if hasattr(response, 'text'):
+        return response.text
+    if response.parts:
+        return "".join(part.text for part in response.parts if hasattr(part, 'text'))
+    return None
+
+def build_explanation_prompt(prompt: str) -> str:
+    """
+    Builds the engineered prompt that asks Gemini for a Markdown explanation with [IMAGE] placeholders.
+    """
+    return f"""
     Explain the topic: "{prompt}".
     Developer and Personal Instructions:1. You Name is Bujji, an AI model. Your modelname is bujjisearch-v1. 2.Your developer and creator is Surya Nallamothu(Nallamothu Ayyappa Venkata Surya) Developer. 
     Your Core Directives:
@@ -127,25 +222,20 @@ def generate_explanation(prompt: str) -> str:
     ---
     Now, generate the complete response for my topic: "{prompt}"
     """
+
+def generate_explanation(prompt: str) -> str:
+    """
+    Generates the main explanation from Gemini, asking it to place [IMAGE] placeholders.
+    """
+    if not get_model():
+        return "Error: AI model is not configured. Please check server logs."
+
+    engineered_prompt = build_explanation_prompt(prompt)
     print("INFO: Sending main explanation prompt to Gemini API...")
     try:
-        safety_configurations = {
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        }
-        
-        response = model.generate_content(
-            engineered_prompt, 
-            safety_settings=safety_configurations
-        )
-        
-        ai_text = None
-        if hasattr(response, 'text'):
-            ai_text = response.text
-        elif response.parts:
-            ai_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
+        with metrics.timer("explanation"):
+            response = call_gemini("explanation", engineered_prompt)
+            ai_text = response_text(response)
         
         if ai_text:
             print("INFO: Received structured response from Gemini for main explanation.")
@@ -165,45 +255,108 @@ def generate_explanation(prompt: str) -> str:
             if response.prompt_feedback and response.prompt_feedback.block_reason:
                 prompt_feedback_info = f" Prompt Feedback Block Reason: {response.prompt_feedback.block_reason.name}."
 
+            metrics.inc("explanation_errors_total", reason="empty")
             error_message = f"Error: AI model returned an empty explanation. This might be due to content policies or an issue with the response structure.{candidate_info}{prompt_feedback_info} Please try rephrasing your prompt or check server logs. Full Response: {response}"
             print(f"ERROR: {error_message}")
             return error_message
 
+    except resilience.CircuitOpenError as e:
+        metrics.inc("explanation_errors_total", reason="circuit_open")
+        return explanation_error_message(e)
     except Exception as e:
-        tb_str = traceback.format_exc()
-        error_message_detail = str(e)
-        if hasattr(e, 'message') and e.message:
-            error_message_detail = f"API Error: {e.message} (Underlying exception: {str(e)})"
-        
-        print(f"ERROR: Failed to call Gemini API for main explanation. Exception Type: {type(e)}, Error Details: {error_message_detail}\nTraceback:\n{tb_str}")
-        
-        user_error = "Error: Could not retrieve an explanation from the AI model."
-        lower_error_detail = error_message_detail.lower()
-        if "safety" in lower_error_detail or \
-           "block_reason" in lower_error_detail or \
-           "invalid argument" in lower_error_detail or \
-           isinstance(e, (getattr(genai.types, 'BlockedPromptException', type(None)), 
-                          getattr(genai.types, 'StopCandidateException', type(None)))) or \
-           (hasattr(e, 'grpc_status_code') and e.grpc_status_code == 3):
-            user_error += " This may be due to the prompt violating content policies or an API configuration issue. Please check server logs for details."
-        else:
-            user_error += " This could be related to API key, model name, network connectivity, or other server-side issues. Check server logs."
-        return user_error
+        metrics.inc("explanation_errors_total", reason="timeout" if is_timeout_error(e) else "error")
+        return explanation_error_message(e)
 
-def generate_image_search_query(heading: str, context_text: str, original_topic: str) -> str:
+def explanation_error_message(e: Exception) -> str:
     """
-    Generates a Bing image search query using Gemini based on heading and context.
+    Logs a failed explanation call and returns the user-facing "Error: ..." message for it.
     """
-    if not model:
-        print("WARNING: AI model not configured. Cannot generate image search query. Falling back to heading.")
-        return heading if heading else original_topic
+    if isinstance(e, resilience.CircuitOpenError):
+        print(f"WARNING: Skipped the main explanation call: {e}")
+        return "Error: The AI service is temporarily unavailable. Please try again in a moment."
+
+    tb_str = traceback.format_exc()
+    error_message_detail = str(e)
+    if hasattr(e, 'message') and e.message:
+        error_message_detail = f"API Error: {e.message} (Underlying exception: {str(e)})"
+
+    print(f"ERROR: Failed to call Gemini API for main explanation. Exception Type: {type(e)}, Error Details: {error_message_detail}\nTraceback:\n{tb_str}")
+
+    user_error = "Error: Could not retrieve an explanation from the AI model."
+    lower_error_detail = error_message_detail.lower()
+    if "safety" in lower_error_detail or \
+       "block_reason" in lower_error_detail or \
+       "invalid argument" in lower_error_detail or \
+       type(e).__name__ in ('BlockedPromptException', 'StopCandidateException') or \
+       (hasattr(e, 'grpc_status_code') and e.grpc_status_code == 3):
+        user_error += " This may be due to the prompt violating content policies or an API configuration issue. Please check server logs for details."
+    else:
+        user_error += " This could be related to API key, model name, network connectivity, or other server-side issues. Check server logs."
+    return user_error
 
-    # Clean and shorten context_text for the image query prompt
+def generate_explanation_stream(prompt: str):
+    """
+    Streams the main explanation from Gemini, yielding text chunks as they arrive.
+    Exceptions propagate; callers can turn them into a user message with explanation_error_message().
+    """
+    print("INFO: Streaming main explanation prompt to Gemini API...")
+    # Includes the time the caller spends on each chunk, so it is kept apart from the "explanation" stage.
+    # generate_content returns after the first chunk, so the breaker slot is held until the whole stream
+    # is read; failures while reading it count towards opening the circuit too.
+    with metrics.timer("explanation_stream"), resilience.gemini_breaker.guard(is_failure=is_gemini_outage):
+        for chunk in generate_content("explanation", build_explanation_prompt(prompt), stream=True):
+            text = response_text(chunk)
+            if text:
+                yield text
+
+def clean_image_context(context_text: str) -> str:
+    """
+    Cleans and shortens the text preceding an [IMAGE] placeholder for use in an image query prompt.
+    """
     cleaned_context = re.sub(r'#+\s*', '', context_text) # Remove markdown from context
     cleaned_context = re.sub(r'\s+', ' ', cleaned_context).strip() # Normalize whitespace
     max_context_len = 250 # Characters for context snippet
     if len(cleaned_context) > max_context_len:
         cleaned_context = cleaned_context[:max_context_len] + "..."
+    return cleaned_context
+
+def clean_query_text(query_text: str) -> str:
+    """
+    Cleans up a model-generated query: removes potential "Query:" prefixes, quotes and surrounding whitespace.
+    """
+    query_text = re.sub(r'^(Search Query:|Query:)\s*', '', query_text, flags=re.IGNORECASE).strip()
+    return query_text.strip('"\'').strip()
+
+def local_image_query(heading: str, context_text: str, original_topic: str) -> str:
+    """Builds the image query in-process from the heading, the cleaned context and the topic (no Gemini call)."""
+    return local_query.generate_local_query(heading, clean_image_context(context_text), original_topic)
+
+def fallback_image_query(heading: str, context_text: str, original_topic: str) -> str:
+    """
+    Query used when Gemini cannot provide one: the local keyword query in "auto" mode, otherwise the heading
+    (or the topic when there is no heading).
+    """
+    if IMAGE_QUERY_MODE == "gemini":
+        return heading if heading else original_topic
+    return local_image_query(heading, context_text, original_topic)
+
+def generate_image_search_query(heading: str, context_text: str, original_topic: str) -> str:
+    """
+    Generates a Bing image search query using Gemini based on heading and context
+    (or locally, without Gemini, when IMAGE_QUERY_MODE is "local").
+    """
+    if IMAGE_QUERY_MODE == "local":
+        return local_image_query(heading, context_text, original_topic)
+    if not get_model():
+        print("WARNING: AI model not configured. Cannot generate image search query. Falling back.")
+        metrics.inc("image_query_fallback_total", reason="no_model")
+        return fallback_image_query(heading, context_text, original_topic)
+    if not resilience.has_time(resilience.IMAGE_QUERY_MIN_SECONDS):
+        print(f"WARNING: Request time budget is running out. Building the image query without Gemini for: '{heading}'")
+        metrics.inc("image_query_fallback_total", reason="deadline")
+        return fallback_image_query(heading, context_text, original_topic)
+
+    cleaned_context = clean_image_context(context_text)
 
     prompt_for_image_query = f"""
     The main topic is: "{original_topic}".
@@ -223,176 +376,682 @@ def generate_image_search_query(heading: str, context_text: str, original_topic:
     """
     print(f"INFO: Sending image query generation prompt to Gemini. Original Topic: '{original_topic}', Heading: '{heading}', Context Snippet: '{cleaned_context[:60]}...'")
     try:
-        safety_configurations = {
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        }
         # Configure generation for short, direct output
-        generation_config = GenerationConfig(
-            temperature=0.4, # More focused output
-            max_output_tokens=20, # Limit query length
-            # top_p=0.9, # Alternative to temperature
-            # top_k=10   # Alternative to temperature
-        )
+        generation_config = {
+            "temperature": 0.4, # More focused output
+            "max_output_tokens": 20, # Limit query length
+            # "top_p": 0.9, # Alternative to temperature
+            # "top_k": 10   # Alternative to temperature
+        }
 
-        response = model.generate_content(
-            prompt_for_image_query,
-            safety_settings=safety_configurations,
-            generation_config=generation_config
-        )
-        
-        query_text = None
-        if hasattr(response, 'text'):
-            query_text = response.text
-        elif response.parts:
-            query_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
+        started = time.perf_counter()
+        with metrics.timer("image_query"):
+            response = call_gemini("image_query", prompt_for_image_query, generation_config=generation_config)
+            query_text = response_text(response)
 
         if query_text:
-            # Clean up the query: remove potential "Query:" prefixes, quotes, newlines
-            query_text = re.sub(r'^(Search Query:|Query:)\s*', '', query_text, flags=re.IGNORECASE).strip()
-            query_text = query_text.strip('"\'').strip() # Remove surrounding quotes and whitespace
+            query_text = clean_query_text(query_text)
             if query_text:
                  print(f"SUCCESS: Gemini generated image query: '{query_text}'")
+                 local_query.record_gemini_query(original_topic, heading, cleaned_context, query_text, time.perf_counter() - started)
                  return query_text
             else: # AI returned empty string after cleaning
                 print(f"WARNING: Gemini generated an empty image query after cleaning. Falling back. Heading: '{heading}'")
-                return heading if heading else original_topic
+                metrics.inc("image_query_fallback_total", reason="empty")
+                return fallback_image_query(heading, context_text, original_topic)
         else:
-            print(f"WARNING: Gemini returned empty or no text for image query. Response: {response}. Falling back to heading: '{heading}'")
-            return heading if heading else original_topic
+            print(f"WARNING: Gemini returned empty or no text for image query. Response: {response}. Falling back. Heading: '{heading}'")
+            metrics.inc("image_query_fallback_total", reason="empty")
+            return fallback_image_query(heading, context_text, original_topic)
     except Exception as e:
         tb_str = traceback.format_exc()
-        print(f"ERROR: Failed to call Gemini API for image query generation. Error: {e}\nTraceback:{tb_str}\nFalling back to heading: '{heading}'")
-        return heading if heading else original_topic
+        print(f"ERROR: Failed to call Gemini API for image query generation. Error: {e}\nTraceback:{tb_str}\nFalling back. Heading: '{heading}'")
+        if isinstance(e, resilience.CircuitOpenError):
+            reason = "circuit_open"
+        else:
+            reason = "timeout" if is_timeout_error(e) else "error"
+        metrics.inc("image_query_fallback_total", reason=reason)
+        return fallback_image_query(heading, context_text, original_topic)
+
+class ImageSelector:
+    """
+    Chooses the image for each slot, in document order, from its query's Bing candidates.
+    Holds the state that makes the choice depend on earlier slots: the main H1 image and the
+    index progression for sub-images, which also skip a candidate identical to the main image.
+    """
+
+    def __init__(self, user_prompt: str):
+        self.user_prompt = user_prompt
+        self.main_image_url = None
+        self.processed_first_h1_image = False
+        self.image_counter_for_subheadings = 0 # Used to vary image index for non-H1 images
+        self.last_image_url = None
+
+    def select(self, slot: dict, query_for_bing: str, candidates: list[str | None], thumbnails: dict | None = None) -> str:
+        """
+        Returns the image HTML (or the image-error placeholder) for the next slot.
+        thumbnails maps candidate URLs to their Bing thumbnails, used by the image proxy as a fallback.
+        """
+        active_heading_text = slot["heading"]
+        first_h1_text = slot["first_h1_text"]
+        image_url_to_display = None
+
+        # Determine if this image is for the main H1 title
+        is_main_h1_image_context = (slot["heading_level"] == 1 and
+                                    active_heading_text == first_h1_text and
+                                    not self.processed_first_h1_image)
+
+        if is_main_h1_image_context:
+            alt_text = f"Main illustration for {first_h1_text}, based on query: {query_for_bing}"
+            print(f"INFO: Selecting MAIN image (AI query: '{query_for_bing}') for H1: '{first_h1_text}'")
+            image_url_to_display = pick_image_candidate(candidates, 0, query_for_bing)
+            if image_url_to_display:
+                self.main_image_url = image_url_to_display
+                self.processed_first_h1_image = True
+        else:
+            context_prefix_for_alt = first_h1_text if first_h1_text else self.user_prompt
+            alt_text = f"Visual for '{active_heading_text}' (related to {context_prefix_for_alt}), AI query: '{query_for_bing}'"
+
+            print(f"INFO: Selecting SUB image (AI query: '{query_for_bing}') for heading '{active_heading_text}'")
+
+            image_fetch_index = self.image_counter_for_subheadings
+            image_url_to_display = pick_image_candidate(candidates, image_fetch_index, query_for_bing)
+
+            # Deduplication: if sub-image is same as main, try next one
+            if image_url_to_display and self.main_image_url and image_url_to_display == self.main_image_url:
+                print(f"INFO: Sub-image (AI query: '{query_for_bing}', index {image_fetch_index}) matched main image. Attempting next.")
+                image_fetch_index += 1
+                second_attempt_url = pick_image_candidate(candidates, image_fetch_index, query_for_bing)
+                if second_attempt_url and second_attempt_url != self.main_image_url:
+                    image_url_to_display = second_attempt_url
+                    print(f"SUCCESS: Selected unique SUB image (index {image_fetch_index}): {second_attempt_url[:70]}...")
+                else:
+                    print(f"WARNING: Could not fetch a unique different SUB image (index {image_fetch_index}) for '{query_for_bing}'. Using first found or it was also a duplicate.")
+
+            if image_url_to_display: # If an image was successfully fetched (either first or second attempt)
+                self.image_counter_for_subheadings = image_fetch_index + 1 # Next non-H1 image should try a new index
+
+        if not image_url_to_display:
+            metrics.inc("image_slots_failed_total")
+        self.last_image_url = image_url_to_display
+        thumbnail_url = thumbnails.get(image_url_to_display) if thumbnails and image_url_to_display else None
+        return render_image_html(image_url_to_display, alt_text, query_for_bing, thumbnail_url)
+
+def render_image_html(image_url: str | None, alt_text: str, query_for_bing: str, thumbnail_url: str | None = None) -> str:
+    """
+    Image HTML, or the image-error placeholder when no URL was found. With the image proxy enabled the
+    src is the /img endpoint, which can fall back to the Bing thumbnail.
+    """
+    if image_url:
+        safe_alt_text = Markup.escape(alt_text)
+        src = image_proxy.proxy_url(image_url, thumbnail_url) if image_proxy.IMAGE_PROXY_ENABLED else image_url
+        return f'<div class="image-container"><img src="{src}" alt="{safe_alt_text}" loading="lazy"></div>'
+    error_query_display = Markup.escape(query_for_bing)
+    return f'<p class="image-error"><em>[Could not load image for AI-generated query: "{error_query_display}"]</em></p>'
+
+class DeferredSlotPlanner:
+    """
+    Describes image slots for deferred resolution, one slot at a time in document order.
+
+    Without the serial walk, each slot carries hints that reproduce prepare()'s choices. Every slot under
+    the first H1 may become the main image: prepare() keeps offering the main role to the next such slot
+    until one finds an image, so these slots get role "main" and name the previous candidate in main_slot.
+    The browser awaits that slot and demotes this one to a sub-image if the previous one already found the
+    main image (its response's main_url). Sub-images name the last main candidate before them as main_slot,
+    so they can pass the main image's URL along for deduplication. Slots also name the previous slot that
+    may be a sub-image: when that one was resolved first, its next_fetch_index replaces the planned index,
+    which keeps the index progression identical to prepare() after dedupes and misses. Planned indices assume
+    the first main candidate finds its image and every sub-image finds one.
+    """
+
+    def __init__(self, user_prompt: str):
+        self.user_prompt = user_prompt
+        self.main_slot = None  # Latest slot that may hold the main image
+        self.previous_sub_slot = None
+        self.sub_images_planned = 0
+
+    def describe(self, slot_number: int, slot: dict) -> dict:
+        is_main_candidate = slot["heading_level"] == 1 and slot["heading"] == slot["first_h1_text"]
+        is_first_main_candidate = is_main_candidate and self.main_slot is None
+        descriptor = {
+            "slot": slot_number,
+            "heading": slot["heading"],
+            "context": clean_image_context(slot["context"]),
+            "topic": self.user_prompt,
+            "first_h1": slot["first_h1_text"] or "",
+            "role": "main" if is_main_candidate else "sub",
+            "fetch_index": 0 if is_first_main_candidate else self.sub_images_planned,
+            "main_slot": self.main_slot,
+            "previous_sub_slot": None if is_first_main_candidate else self.previous_sub_slot,
+        }
+        if is_main_candidate:
+            self.main_slot = slot_number
+        if not is_first_main_candidate:
+            self.previous_sub_slot = slot_number
+            self.sub_images_planned += 1
+        return descriptor
+
+def render_deferred_slot_html(descriptor: dict) -> str:
+    """Empty image slot carrying everything /api/image needs to resolve it later."""
+    return (f'<div class="image-slot" data-image-slot="{descriptor["slot"]}" '
+            f'data-image-request="{Markup.escape(json.dumps(descriptor))}"></div>')
+
+def resolve_single_image(descriptor: dict) -> tuple[str | None, str, int]:
+    """
+    Resolves one deferred slot and returns (image_url, html, next_fetch_index). Reuses ImageSelector with its state primed
+    from the slot's hints, so main/sub selection and the main-image dedupe behave as in prepare().
+    """
+    query_for_bing = generate_image_search_query(
+        heading=descriptor["heading"],
+        context_text=descriptor["context"],
+        original_topic=descriptor["topic"]
+    )
+    selector = ImageSelector(descriptor["topic"])
+    selector.main_image_url = descriptor.get("avoid_url") or None
+    selector.processed_first_h1_image = descriptor["role"] != "main"
+    selector.image_counter_for_subheadings = descriptor["fetch_index"]
+    first_h1_text = descriptor["first_h1"] or None
+    slot = {
+        "heading": descriptor["heading"],
+        "heading_level": 1 if descriptor["role"] == "main" else 0,
+        "first_h1_text": descriptor["heading"] if descriptor["role"] == "main" else first_h1_text,
+    }
+    result_set = image_search.get_result_set(query_for_bing)
+    if result_set is None:
+        image_html = selector.select(slot, query_for_bing, [])
+    else:
+        image_html = selector.select(slot, query_for_bing, result_set.candidates, result_set.thumbnails)
+    return selector.last_image_url, image_html, selector.image_counter_for_subheadings
+
+def iter_image_slot_html(image_slots: list[dict], user_prompt: str):
+    """
+    Resolves the image for every slot and yields the HTML to insert for each one, in slot order.
+    Queries are generated up front (batched when enabled) and Bing fetches run concurrently (bounded by IMAGE_RESOLVE_CONCURRENCY);
+    the choice of main image, sub-image indices and deduplication is then made serially so the output matches a one-by-one walk.
+    """
+    queries = generate_slot_queries(image_slots, user_prompt)
+    selector = ImageSelector(user_prompt)
+    result_sets = iter_concurrently(image_search.get_result_set, queries, IMAGE_RESOLVE_CONCURRENCY)
+    for slot, query_for_bing, result_set in zip(image_slots, queries, result_sets):
+        if result_set is None:
+            yield selector.select(slot, query_for_bing, [])
+        else:
+            yield selector.select(slot, query_for_bing, result_set.candidates, result_set.thumbnails)
+
+def resolve_image_slots(image_slots: list[dict], user_prompt: str) -> list[str]:
+    """
+    Resolves the image for every slot and returns the HTML to insert for each one, in slot order.
+    """
+    return list(iter_image_slot_html(image_slots, user_prompt))
+
+def generate_image_search_queries_batch(items: list[tuple[str, str]], original_topic: str) -> list[str] | None:
+    """
+    Generates Bing image search queries for several (heading, context) pairs with a single Gemini call.
+    Returns the queries in input order, or None if the call fails or the reply is malformed.
+    """
+    if not items or not get_model():
+        return None
+
+    numbered_sections = "\n".join(
+        f'{position}. Heading: "{heading}" | Preceding text: "{clean_image_context(context_text)}"'
+        for position, (heading, context_text) in enumerate(items, start=1)
+    )
+    prompt_for_image_queries = f"""
+    The main topic is: "{original_topic}".
+    An explanation of this topic needs {len(items)} illustrative images. For each numbered section below you get its heading and the text immediately preceding the need for an image:
+    {numbered_sections}
+
+    For each section, generate a concise and effective Bing image search query (ideally 3-7 words) to find a highly relevant illustrative image for that specific section.
+    Focus on the key nouns, concepts, or visual elements described or implied.
+    Respond with ONLY a JSON array of exactly {len(items)} strings, one query per section, in the same order as the sections. No labels or extra text.
+
+    Example:
+    ["glycolysis glucose breakdown diagram", "krebs cycle mitochondria diagram"]
+    """
+    print(f"INFO: Sending batched image query prompt to Gemini for {len(items)} images. Original Topic: '{original_topic}'")
+    try:
+        generation_config = {
+            "temperature": 0.4,
+            "max_output_tokens": 30 * len(items) + 20, # Single-query budget per image, plus room for JSON quotes and commas
+            "response_mime_type": "application/json",
+        }
+        started = time.perf_counter()
+        with metrics.timer("image_query_batch"):
+            response = call_gemini("image_query_batch", prompt_for_image_queries, generation_config=generation_config)
+            raw_text = response_text(response)
+        if not raw_text:
+            print(f"WARNING: Gemini returned empty or no text for batched image queries. Response: {response}")
+            return None
+
+        raw_text = re.sub(r'^```(?:json)?\s*|\s*```$', '', raw_text.strip()) # Tolerate fenced JSON
+        parsed = json.loads(raw_text)
+        if isinstance(parsed, dict): # Accept {"queries": [...]} as well as a bare list
+            parsed = parsed.get("queries")
+        if not isinstance(parsed, list) or len(parsed) != len(items):
+            print(f"WARNING: Batched image query reply has the wrong shape (expected a list of {len(items)}). Reply: '{raw_text[:200]}'")
+            return None
+
+        queries = [clean_query_text(query) if isinstance(query, str) else "" for query in parsed]
+        print(f"SUCCESS: Gemini generated {len(queries)} batched image queries: {queries}")
+        latency_per_query = (time.perf_counter() - started) / len(items)
+        for (heading, context_text), query in zip(items, queries):
+            if query:
+                local_query.record_gemini_query(original_topic, heading, clean_image_context(context_text), query,
+                                                latency_per_query, batched=True)
+        return queries
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        print(f"ERROR: Failed to generate batched image queries. Error: {e}\nTraceback:{tb_str}")
+        return None
+
+def generate_slot_queries(image_slots: list[dict], user_prompt: str) -> list[str]:
+    """
+    Produces one Bing query per image slot. In batch mode all slots share one Gemini call; slots the batch
+    could not answer (failed call, malformed reply or empty entry) go through the per-image path.
+    """
+    if IMAGE_QUERY_MODE == "local":
+        return [local_image_query(slot["heading"], slot["context"], user_prompt) for slot in image_slots]
+    if not resilience.has_time(resilience.IMAGE_QUERY_MIN_SECONDS):
+        # Degrade before spending the rest of the budget on Gemini
+        print(f"WARNING: Request time budget is running out. Building {len(image_slots)} image queries without Gemini.")
+        metrics.inc("image_query_fallback_total", len(image_slots), reason="deadline")
+        return [fallback_image_query(slot["heading"], slot["context"], user_prompt) for slot in image_slots]
+
+    queries = [""] * len(image_slots)
+    if IMAGE_QUERY_BATCH and len(image_slots) > 1:
+        batch = generate_image_search_queries_batch(
+            [(slot["heading"], slot["context"]) for slot in image_slots], user_prompt
+        )
+        metrics.inc("image_query_batch_total", outcome="ok" if batch is not None else "fallback")
+        if batch is not None:
+            queries = batch
+
+    missing = [position for position, query in enumerate(queries) if not query]
+    if missing:
+        if len(missing) != len(image_slots):
+            print(f"INFO: Batched image queries left {len(missing)} slot(s) empty. Using per-image query generation for them.")
+        per_image = run_concurrently(
+            lambda position: generate_image_search_query(
+                heading=image_slots[position]["heading"],
+                context_text=image_slots[position]["context"],
+                original_topic=user_prompt
+            ),
+            missing,
+            IMAGE_RESOLVE_CONCURRENCY
+        )
+        for position, query in zip(missing, per_image):
+            queries[position] = query
+    return queries
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.before_request
+def start_request_deadline():
+    resilience.start_deadline()
+
+@app.after_request
+def add_server_timing(response):
+    """Per-stage durations of the request as a Server-Timing header (streamed responses finish too late for headers)."""
+    request_stats = metrics.current_request()
+    if metrics.METRICS_ENABLED and request_stats is not None and not response.is_streamed:
+        response.headers["Server-Timing"] = metrics.server_timing_header(request_stats)
+    return response
 
 @app.route('/', methods=['GET'])
 def index():
-    if not model: 
+    # Only checks what is already known, so the page is served without loading the AI stack
+    if model_unavailable():
         return render_template('index.html', error="AI Service Error: The AI model could not be initialized. Please contact the administrator.")
     return render_template('index.html')
 
+def answer_is_cacheable(request_stats: metrics.RequestStats) -> bool:
+    """
+    False when the answer was degraded: an image slot came out as the image-error placeholder (failed fetch,
+    open Bing circuit, time budget spent) or an image query was built without Gemini's answer. Such pages are
+    only cached briefly (ANSWER_CACHE_DEGRADED_TTL) instead of repeating a passing outage for hours.
+    """
+    return not (request_stats.get("image_slots_failed_total") or request_stats.get("image_query_fallback_total"))
+
+def build_answer(user_prompt: str, deferred_images: bool = False) -> tuple[str | None, list[dict], str | None, bool]:
+    """
+    Runs the full pipeline for a prompt and returns (html, slot_descriptors, error_message, cacheable).
+    With deferred_images the images are not resolved; the HTML carries empty slots described by slot_descriptors.
+    """
+    request_stats = metrics.current_request() or metrics.start_request()
+    gemini_response_text = generate_explanation(user_prompt)
+    if gemini_response_text.startswith("Error:"):
+        return None, [], gemini_response_text, False
+    
+    # One Markdown pass over the whole explanation; image slots are filled into its parts afterwards
+    document = render_document(gemini_response_text, user_prompt)
+    image_slots = document.image_slots
+    slot_descriptors = []
+    if deferred_images:
+        planner = DeferredSlotPlanner(user_prompt)
+        slot_descriptors = [planner.describe(slot_number, slot) for slot_number, slot in enumerate(image_slots)]
+        image_html = [render_deferred_slot_html(descriptor) for descriptor in slot_descriptors]
+    else:
+        # Resolve every image up front (in parallel), then stitch the page together in document order
+        image_html = resolve_image_slots(image_slots, user_prompt)
+    final_html_content = document.assemble(image_html)
+
+    gemini_calls = request_stats.get("gemini_calls_total")
+    metrics.observe("gemini_calls_per_request", gemini_calls)
+    print(f"INFO: /prepare used {gemini_calls:g} Gemini call(s) for {len(image_slots)} image(s).")
+    return final_html_content, slot_descriptors, None, answer_is_cacheable(request_stats)
+
+def build_answer_html(user_prompt: str) -> tuple[str | None, str | None, bool]:
+    """
+    Runs the full pipeline for a prompt and returns (html, None, cacheable), or (None, error_message, False) on failure.
+    """
+    html, _, error, cacheable = build_answer(user_prompt, deferred_images=DEFERRED_IMAGES)
+    return html, error, cacheable
+
+def answer_cache_model_key(deferred_images: bool = DEFERRED_IMAGES) -> str:
+    """
+    Model name plus rendering mode, so eager and deferred pages are cached separately. Eager pages built
+    with local image queries or proxied image URLs (per signing key) are kept apart from the others.
+    """
+    if deferred_images:
+        return f"{GEMINI_MODEL_NAME}:deferred"
+    key = f"{GEMINI_MODEL_NAME}:local-queries" if IMAGE_QUERY_MODE == "local" else GEMINI_MODEL_NAME
+    return f"{key}:proxied-{image_proxy.key_id()}" if image_proxy.IMAGE_PROXY_ENABLED else key
+
+def answer_cache_bypass_requested() -> bool:
+    """
+    Admins can skip the answer cache lookup (the fresh answer is still stored) with ?nocache=1 or
+    Cache-Control: no-cache, authenticated by the X-Admin-Token header.
+    """
+    wants_bypass = request.values.get("nocache", "").lower() in ("1", "true", "yes") or \
+        "no-cache" in request.headers.get("Cache-Control", "").lower()
+    return wants_bypass and answer_cache.is_admin(request.headers.get("X-Admin-Token"))
+
 @app.route('/prepare', methods=['POST'])
 def prepare():
-    if not model: 
+    if not get_model():
         return render_template('index.html', error="AI Service Error: The AI model is not available. Please try again later or contact the administrator.")
 
     user_prompt = request.form.get('prompt')
     if not user_prompt:
         return render_template('index.html', error="Please enter a topic.")
 
-    gemini_response_text = generate_explanation(user_prompt)
-    if gemini_response_text.startswith("Error:"):
-        return render_template('index.html', error=gemini_response_text, prompt=user_prompt)
-    
-    # Split by [IMAGE] placeholder, keeping the placeholder as a delimiter
-    content_parts = re.split(r'(\[IMAGE\])', gemini_response_text)
-    
-    final_html_content = ""
-    
-    active_heading_text = user_prompt # Default heading is the user's initial prompt
-    active_heading_level = 0
-    first_h1_text = None 
-    main_image_url = None 
-    processed_first_h1_image = False 
-
-    heading_regex = re.compile(r"^\s*(#{1,6})\s*(.+?)\s*(?:#\s*)*$", re.MULTILINE)
-    image_counter_for_subheadings = 0 # Used to vary image index for non-H1 images
-
-    for i, part in enumerate(content_parts):
-        if not part.strip(): # Skip empty or whitespace-only parts
-            continue
-
-        if part == '[IMAGE]':
-            # This is an image placeholder.
-            # The context text is content_parts[i-1] (the text segment before this [IMAGE]).
-            preceding_text_segment = ""
-            if i > 0 and content_parts[i-1] != '[IMAGE]':
-                preceding_text_segment = content_parts[i-1]
-            
-            # Generate the AI-powered search query for Bing
-            ai_generated_bing_query = generate_image_search_query(
-                heading=active_heading_text, 
-                context_text=preceding_text_segment,
-                original_topic=user_prompt 
-            )
-            
-            query_for_bing = ai_generated_bing_query # Use the AI generated query
-            alt_text_description = active_heading_text # Base for alt text
-
-            image_url_to_display = None
-            image_fetch_index = 0 # Default index for fetching
-
-            # Determine if this image is for the main H1 title
-            is_main_h1_image_context = (active_heading_level == 1 and 
-                                        active_heading_text == first_h1_text and 
-                                        not processed_first_h1_image)
-
-            if is_main_h1_image_context:
-                alt_text = f"Main illustration for {first_h1_text}, based on query: {query_for_bing}"
-                print(f"INFO: Fetching MAIN image (AI query: '{query_for_bing}') for H1: '{first_h1_text}'")
-                image_url_to_display = get_best_image_url(query_for_bing, image_index_to_fetch=0)
-                if image_url_to_display:
-                    main_image_url = image_url_to_display 
-                    processed_first_h1_image = True
-            else: 
-                context_prefix_for_alt = first_h1_text if first_h1_text else user_prompt
-                alt_text = f"Visual for '{alt_text_description}' (related to {context_prefix_for_alt}), AI query: '{query_for_bing}'"
-                
-                print(f"INFO: Fetching SUB image (AI query: '{query_for_bing}') for heading '{active_heading_text}'")
-                
-                image_fetch_index = image_counter_for_subheadings 
-                image_url_to_display = get_best_image_url(query_for_bing, image_index_to_fetch=image_fetch_index)
-
-                # Deduplication: if sub-image is same as main, try next one
-                if image_url_to_display and main_image_url and image_url_to_display == main_image_url:
-                    print(f"INFO: Sub-image (AI query: '{query_for_bing}', index {image_fetch_index}) matched main image. Attempting next.")
-                    image_fetch_index += 1
-                    second_attempt_url = get_best_image_url(query_for_bing, image_index_to_fetch=image_fetch_index)
-                    if second_attempt_url and second_attempt_url != main_image_url:
-                        image_url_to_display = second_attempt_url
-                        print(f"SUCCESS: Fetched unique SUB image (index {image_fetch_index}): {second_attempt_url[:70]}...")
-                    else:
-                        print(f"WARNING: Could not fetch a unique different SUB image (index {image_fetch_index}) for '{query_for_bing}'. Using first found or it was also a duplicate.")
-                
-                if image_url_to_display: # If an image was successfully fetched (either first or second attempt)
-                    image_counter_for_subheadings = image_fetch_index + 1 # Next non-H1 image should try a new index
+    final_html_content, error, cache_outcome = answer_cache.answer_cache.get_or_compute(
+        user_prompt, answer_cache_model_key(), lambda: build_answer_html(user_prompt),
+        bypass=answer_cache_bypass_requested()
+    )
+    print(f"INFO: Answer cache {cache_outcome} for prompt '{user_prompt[:60]}'")
+    if error:
+        return render_template('index.html', error=error, prompt=user_prompt)
 
-            # Append image HTML or error message
-            if image_url_to_display:
-                safe_alt_text = Markup.escape(alt_text)
-                image_html = f'<div class="image-container"><img src="{image_url_to_display}" alt="{safe_alt_text}" loading="lazy"></div>'
-                final_html_content += image_html
-            else:
-                error_query_display = Markup.escape(query_for_bing)
-                final_html_content += f'<p class="image-error"><em>[Could not load image for AI-generated query: "{error_query_display}"]</em></p>'
-
-        else: # This part is a text segment
-            text_segment = part
-            
-            # Find the last heading in this segment to update active_heading_text
-            # This active_heading_text will be used as context for the *next* [IMAGE] tag
-            headings_in_segment = heading_regex.findall(text_segment)
-            if headings_in_segment:
-                # The last heading in a segment is the most current one
-                last_heading_hashes, last_heading_text_content = headings_in_segment[-1]
-                active_heading_text = last_heading_text_content.strip()
-                active_heading_level = len(last_heading_hashes)
-                
-                print(f"DEBUG: Active heading updated to (L{active_heading_level}): '{active_heading_text}' from text segment.")
-
-                if not first_h1_text and active_heading_level == 1:
-                    first_h1_text = active_heading_text
-                    print(f"DEBUG: Set first_h1_text to: '{first_h1_text}'")
-            # If no heading in this segment, active_heading_text and active_heading_level remain from previous segment or default.
-            
-            final_html_content += markdown2.markdown(text_segment, extras=["fenced-code-blocks", "tables", "cuddled-lists", "smarty-pants"])
-    
     safe_html_output = Markup(final_html_content)
     return render_template('index.html', result=safe_html_output, prompt=user_prompt)
 
+@app.route('/prepare/stream', methods=['POST'])
+def prepare_stream():
+    """
+    Streaming variant of /prepare (Server-Sent Events). Sections are sent as soon as Gemini has finished
+    writing them, each [IMAGE] as an empty slot; once the text is complete the slots are filled in order.
+    Events: section {html}, image {slot, html}, error {message}, done {}.
+    """
+    user_prompt = request.form.get('prompt')
+    bypass = answer_cache_bypass_requested()
+
+    def generate():
+        if not get_model():
+            yield sse_event("error", {"message": "AI Service Error: The AI model is not available. Please try again later or contact the administrator."})
+            return
+        if not user_prompt:
+            yield sse_event("error", {"message": "Please enter a topic."})
+            return
+
+        cached_html, cache_outcome, cache_flight = answer_cache.answer_cache.acquire(
+            user_prompt, answer_cache_model_key(), bypass=bypass
+        )
+        print(f"INFO: Answer cache {cache_outcome} for prompt '{user_prompt[:60]}'")
+        if cached_html is not None:
+            yield sse_event("section", {"html": cached_html})
+            yield sse_event("done", {})
+            return
+
+        final_html, cacheable = None, False
+        try:
+            final_html, cacheable = yield from generate_answer()
+        finally:
+            # Also runs when the client disconnects mid-stream; waiters then generate on their own
+            answer_cache.answer_cache.finish(cache_flight, final_html, cacheable)
+
+    def generate_answer():
+        request_stats = metrics.start_request()
+        splitter = MarkdownSectionSplitter()
+        headings = HeadingTracker(user_prompt)
+        image_slots = []
+        planner = DeferredSlotPlanner(user_prompt) if DEFERRED_IMAGES else None
+        page_parts = [] # Rendered sections in order; image slots are replaced once resolved
+        slot_part_positions = []
+        explanation_chunks = [] # The raw Markdown, rendered again in one pass for the answer cache
+        text_since_image = ""
+        sent_content = False
+
+        def emit(blocks):
+            nonlocal text_since_image, sent_content
+            for kind, text in blocks:
+                if kind == "text":
+                    text_since_image += text
+                    if text.strip():
+                        sent_content = True
+                        section_html = render_markdown(text)
+                        page_parts.append(section_html)
+                        yield sse_event("section", {"html": section_html})
+                else:
+                    # Same heading/context bookkeeping as render_document on the text since the previous [IMAGE]
+                    headings.update(text_since_image)
+                    slot_number = len(image_slots)
+                    image_slots.append(headings.image_slot(slot_number, text_since_image))
+                    text_since_image = ""
+                    sent_content = True
+                    if planner is not None:
+                        slot_html = render_deferred_slot_html(planner.describe(slot_number, image_slots[-1]))
+                    else:
+                        slot_html = f'<div class="image-slot" data-image-slot="{slot_number}"></div>'
+                    slot_part_positions.append(len(page_parts))
+                    page_parts.append(slot_html)
+                    yield sse_event("section", {"html": slot_html})
+
+        try:
+            for chunk in generate_explanation_stream(user_prompt):
+                explanation_chunks.append(chunk)
+                yield from emit(splitter.feed(chunk))
+            yield from emit(splitter.close())
+        except Exception as e:
+            yield sse_event("error", {"message": explanation_error_message(e)})
+            return None, False
+
+        if not sent_content:
+            yield sse_event("error", {"message": "Error: AI model returned an empty explanation. Please try rephrasing your prompt."})
+            return None, False
+
+        if planner is None:
+            for slot_number, image_html in enumerate(iter_image_slot_html(image_slots, user_prompt)):
+                page_parts[slot_part_positions[slot_number]] = image_html
+                yield sse_event("image", {"slot": slot_number, "html": image_html})
+
+        gemini_calls = request_stats.get("gemini_calls_total")
+        metrics.observe("gemini_calls_per_request", gemini_calls)
+        print(f"INFO: /prepare/stream used {gemini_calls:g} Gemini call(s) for {len(image_slots)} image(s).")
+        yield sse_event("done", {})
+        slot_html = [page_parts[position] for position in slot_part_positions]
+        return cacheable_page("".join(explanation_chunks), slot_html, user_prompt), answer_is_cacheable(request_stats)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def cacheable_page(explanation: str, slot_html: list[str], user_prompt: str) -> str | None:
+    """
+    The page /prepare would build from a streamed explanation and its resolved slots. Streamed sections are
+    rendered one by one, which splits lists and tables around an [IMAGE]; the cache gets one render_document()
+    pass over the whole text instead, so /prepare never serves the streamed rendering. None if the slots differ.
+    """
+    document = render_document(explanation, user_prompt)
+    if len(document.image_slots) != len(slot_html):
+        print(f"WARNING: Streamed answer has {len(slot_html)} image slot(s), the rendered document {len(document.image_slots)}. Not caching it.")
+        return None
+    return document.assemble(slot_html)
+
+API_PREPARE_CACHE_KEY = f"{GEMINI_MODEL_NAME}:api"
+
+@app.route('/api/prepare', methods=['POST'])
+def api_prepare():
+    """
+    JSON variant of /prepare that never waits for images: returns the explanation HTML with empty
+    image slots plus one descriptor per slot. Clients resolve slots on demand through /api/image.
+    """
+    payload = request.get_json(silent=True) or {}
+    user_prompt = payload.get("prompt") or request.form.get('prompt')
+    if not get_model():
+        return jsonify({"error": "AI Service Error: The AI model is not available. Please try again later or contact the administrator."}), 503
+    if not user_prompt:
+        return jsonify({"error": "Please enter a topic."}), 400
+
+    def compute():
+        html, slot_descriptors, error, cacheable = build_answer(user_prompt, deferred_images=True)
+        if error:
+            return None, error, False
+        return json.dumps({"prompt": user_prompt, "html": html, "slots": slot_descriptors}), None, cacheable
+
+    cached_json, error, cache_outcome = answer_cache.answer_cache.get_or_compute(
+        user_prompt, API_PREPARE_CACHE_KEY, compute, bypass=answer_cache_bypass_requested()
+    )
+    if error:
+        return jsonify({"error": error}), 502
+    return Response(cached_json, mimetype="application/json", headers={"X-Answer-Cache": cache_outcome})
+
+@app.route('/api/image', methods=['GET'])
+def api_image():
+    """
+    Resolves one deferred image slot. Query parameters mirror the slot descriptor (heading, context, topic,
+    first_h1, role, fetch_index) plus avoid_url: the main image's URL, so a sub-image never repeats it.
+    The response's main_url is the main image as of this slot (None if no main image was found yet, so
+    the next main candidate keeps the main role), and next_fetch_index the index the following sub-image should use.
+    """
+    if not get_model():
+        return jsonify({"error": "AI Service Error: The AI model is not available."}), 503
+    args = request.args
+    heading = args.get("heading", "").strip()[:300]
+    topic = args.get("topic", "").strip()[:500]
+    if not heading and not topic:
+        return jsonify({"error": "heading or topic is required"}), 400
+    try:
+        fetch_index = min(max(int(args.get("fetch_index", 0)), 0), 100)
+    except ValueError:
+        return jsonify({"error": "fetch_index must be an integer"}), 400
+    descriptor = {
+        "slot": args.get("slot"),
+        "heading": heading,
+        "context": args.get("context", "")[:1000],
+        "topic": topic or heading,
+        "first_h1": args.get("first_h1", "")[:300],
+        "role": "main" if args.get("role") == "main" else "sub",
+        "fetch_index": fetch_index,
+        "avoid_url": args.get("avoid_url", "")[:2000],
+    }
+    image_url, image_html, next_fetch_index = resolve_single_image(descriptor)
+    # The main image as of this slot: what later slots avoid, and None while no slot has found one
+    main_url = image_url if descriptor["role"] == "main" else (descriptor["avoid_url"] or None)
+    response = jsonify({"slot": descriptor["slot"], "url": image_url, "html": image_html,
+                        "main_url": main_url, "next_fetch_index": next_fetch_index})
+    # Identical slot requests resolve identically while the Bing result set is cached
+    response.headers["Cache-Control"] = "public, max-age=600"
+    return response
+
+@app.route('/img/<token>', methods=['GET'])
+def proxied_image(token):
+    """
+    Serves a result image through the image proxy: the downscaled original, or the Bing thumbnail when
+    the original is unavailable. Copies of originals are content-addressed, so they are cacheable for good.
+    Not found while the proxy is off, so the endpoint cannot be used to fetch arbitrary URLs.
+    """
+    if not image_proxy.IMAGE_PROXY_ENABLED:
+        return Response("Image proxy is disabled", status=404, mimetype="text/plain")
+    urls = image_proxy.read_token(token)
+    if urls is None:
+        return Response("Unknown image", status=404, mimetype="text/plain")
+    image, source = image_proxy.image_proxy.resolve(*urls)
+    if image is None:
+        # Short-lived so the browser can try again once the failure has been forgotten
+        return Response("Image unavailable", status=404, mimetype="text/plain", headers={"Cache-Control": "public, max-age=300"})
+    # A thumbnail stands in for an original that may come back, so it is only kept for a day
+    cache_control = "public, max-age=31536000, immutable" if source == "original" else "public, max-age=86400"
+    headers = {"Cache-Control": cache_control, "ETag": f'"{image.digest}"', "X-Image-Source": source}
+    if image.digest in (tag.strip().removeprefix("W/").strip('"') for tag in request.headers.get("If-None-Match", "").split(",")):
+        return Response(status=304, headers=headers)
+    return Response(image.data, mimetype=image.content_type, headers=headers)
+
+@app.route('/admin/answer-cache', methods=['GET'])
+def answer_cache_stats():
+    if not answer_cache.is_admin(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(answer_cache.answer_cache.stats())
+
+@app.route('/admin/answer-cache/purge', methods=['POST'])
+def answer_cache_purge():
+    """Purges one prompt's cached answer (form/JSON field 'prompt') or, without a prompt, the whole cache."""
+    if not answer_cache.is_admin(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "forbidden"}), 403
+    payload = request.get_json(silent=True) or {}
+    prompt = request.values.get("prompt") or payload.get("prompt")
+    if prompt:
+        purged = sum(answer_cache.answer_cache.purge(prompt, model_key)
+                     for model_key in (answer_cache_model_key(False), answer_cache_model_key(True), API_PREPARE_CACHE_KEY))
+    else:
+        purged = answer_cache.answer_cache.purge()
+    return jsonify({"purged": purged})
+
+def component_stats() -> dict:
+    """Point-in-time statistics of the caches and the HTTP client."""
+    client = http_client.get_client()
+    return {
+        "image_result_cache": image_search.result_set_cache.stats(),
+        "answer_cache": answer_cache.answer_cache.stats(),
+        "http_client": client.stats() if hasattr(client, "stats") else {},
+        "image_proxy_cache": image_proxy.image_proxy.store.stats(),
+        "image_proxy_http_client": image_proxy.image_http_client.stats(),
+        "circuit_breakers": {breaker.name: breaker.stats() for breaker in (resilience.gemini_breaker, resilience.bing_breaker)},
+    }
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus text exposition of every counter, summary and stage histogram, plus the cache and
+    HTTP client statistics as gauges. ?format=json returns the same data as JSON.
+    """
+    stats = component_stats()
+    if request.args.get("format") == "json":
+        snapshot = metrics.snapshot()
+        snapshot.update(stats)
+        return jsonify(snapshot)
+
+    gauges = {}
+    for component, values in stats.items():
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges[f"{component}_{name}"] = value
+    gauges["circuit_breaker_open"] = {
+        (("upstream", name),): int(breaker_stats["state"] != "closed")
+        for name, breaker_stats in stats["circuit_breakers"].items()
+    }
+    return Response(metrics.render_prometheus(gauges), mimetype="text/plain; version=0.0.4")
+
+if not LAZY_INIT:
+    get_model()
+if WARMUP_ON_START:
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
 if __name__ == '__main__':
-    if not model:
+    if not get_model():
         print("CRITICAL: AI Model failed to initialize. The application might not function correctly.")
     app.run(debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Micro-benchmark: targeted Bing extractor vs. the full BeautifulSoup parse.
+
+Run from the repository root:
+    python benchmarks/bench_bing_extractor.py [--repeat 50] [fixture.html ...]
+
+Every fixture is first parsed both ways and the resulting candidate lists are compared, so the
+script doubles as an equivalence check (it exits non-zero on any mismatch).
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_search  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def _quiet(func, *args):
+    # The parsers log per-page INFO lines; keep them out of the timing output
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args)
+
+
+def _time(func, html: str, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        _quiet(func, "benchmark", html)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="*", help="HTML files to parse (default: benchmarks/fixtures/bing_*.html)")
+    parser.add_argument("--repeat", type=int, default=30, help="timed parses per fixture and parser")
+    args = parser.parse_args()
+
+    paths = args.fixtures or sorted(
+        os.path.join(FIXTURES_DIR, name) for name in os.listdir(FIXTURES_DIR) if name.startswith("bing_") and name.endswith(".html")
+    )
+
+    mismatches = 0
+    print(f"{'fixture':<32}{'size KB':>9}{'soup ms':>10}{'fast ms':>10}{'speedup':>9}")
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+
+        soup_result = _quiet(image_search.parse_result_page_soup, "benchmark", html)
+        fast_result = _quiet(image_search.parse_result_page_fast, "benchmark", html)
+        same = (soup_result.murls == fast_result.murls and soup_result.fallback_srcs == fast_result.fallback_srcs)
+        if not same:
+            mismatches += 1
+            print(f"MISMATCH in {os.path.basename(path)}:\n  soup={soup_result.candidates}\n  fast={fast_result.candidates}")
+
+        soup_ms = statistics.median(_time(image_search.parse_result_page_soup, html, args.repeat)) * 1000
+        fast_ms = statistics.median(_time(image_search.parse_result_page_fast, html, args.repeat)) * 1000
+        print(f"{os.path.basename(path):<32}{len(html) / 1024:>9.0f}{soup_ms:>10.2f}{fast_ms:>10.2f}{soup_ms / fast_ms:>8.1f}x"
+              f"{'' if same else '  (MISMATCH)'}")
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
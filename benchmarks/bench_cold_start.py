@@ -0,0 +1,154 @@
+"""
+Cold-start benchmark: eager vs. lazy Gemini initialization.
+
+Run from the repository root:
+    python benchmarks/bench_cold_start.py [--runs 5] [--modes process,gunicorn] [--output results.json]
+
+Every run starts a fresh interpreter with LAZY_INIT=0 (model created and the Gemini SDK imported
+at import time) and LAZY_INIT=1 (both deferred to the first request that needs them), using a dummy
+GOOGLE_API_KEY so nothing is sent over the network. "process" runs time `import app`, the first
+GET / through the test client, the first model initialization (what the first /prepare pays on top
+of its Gemini call) and the wall time from spawning the interpreter until it exits after all three.
+"gunicorn" runs time a real single-worker server from spawn until GET / first answers 200.
+Medians over --runs are printed and optionally written as JSON.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+# Runs inside the fresh interpreter; prints one JSON line of timings in milliseconds
+CHILD_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get("/")
+first_response = time.perf_counter()
+assert response.status_code == 200, response.status_code
+model_started = time.perf_counter()
+app.get_model()
+model_ready = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_index_ms": (first_response - imported) * 1000,
+    "model_init_ms": (model_ready - model_started) * 1000,
+}))
+"""
+
+MODES = {"eager": "0", "lazy": "1"}
+
+
+def child_env(lazy_init: str) -> dict:
+    return dict(os.environ, LAZY_INIT=lazy_init, WARMUP_ON_START="0", GOOGLE_API_KEY="offline-benchmark",
+                PYTHONDONTWRITEBYTECODE="1")
+
+
+def run_process(lazy_init: str) -> dict:
+    spawned = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", CHILD_SCRIPT], cwd=REPO_ROOT, env=child_env(lazy_init),
+                            capture_output=True, text=True, timeout=120)
+    wall_ms = (time.perf_counter() - spawned) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"child failed:\n{result.stderr}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings["spawn_to_exit_ms"] = wall_ms
+    return timings
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_gunicorn(lazy_init: str) -> dict:
+    import requests
+
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/"
+    server_log = tempfile.NamedTemporaryFile(prefix="bench_cold_start_", suffix=".log", delete=False)
+    command = [sys.executable, "-m", "gunicorn", "--chdir", REPO_ROOT, "--bind", f"127.0.0.1:{port}",
+               "--workers", "1", "app:app"]
+    spawned = time.perf_counter()
+    server = subprocess.Popen(command, env=child_env(lazy_init), stdout=server_log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"gunicorn did not start; see {server_log.name}")
+            try:
+                if requests.get(url, timeout=1).status_code == 200:
+                    break
+            except requests.exceptions.RequestException:
+                time.sleep(0.01)
+        return {"spawn_to_first_200_ms": (time.perf_counter() - spawned) * 1000}
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        server_log.close()
+        os.unlink(server_log.name)
+
+
+def median_of(samples: list[dict]) -> dict:
+    return {key: round(statistics.median(sample[key] for sample in samples), 1) for key in samples[0]}
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per mode and initialization")
+    parser.add_argument("--modes", default="process,gunicorn", help="comma-separated: process, gunicorn")
+    parser.add_argument("--output", help="write results JSON here (default: print only)")
+    args = parser.parse_args()
+
+    runners = {"process": run_process, "gunicorn": run_gunicorn}
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    for mode in modes:
+        if mode not in runners:
+            parser.error(f"unknown mode: {mode}")
+
+    results = {}
+    for mode in modes:
+        for label, lazy_init in MODES.items():
+            samples = [runners[mode](lazy_init) for _ in range(args.runs)]
+            results[f"{mode}/{label}"] = median_of(samples)
+            timings = "  ".join(f"{key[:-3]} {value:8.1f} ms" for key, value in results[f"{mode}/{label}"].items())
+            print(f"{mode:>9} {label:<6} {timings}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "benchmark": "cold_start",
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "config": {key: value for key, value in vars(args).items() if key != "output"},
+                "medians": results,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
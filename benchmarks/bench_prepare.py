@@ -0,0 +1,288 @@
+"""
+Offline load test for the /prepare pipeline.
+
+Run from the repository root:
+    python benchmarks/bench_prepare.py [--modes testclient,gunicorn] [--concurrency 1,4,16]
+                                       [--requests 40] [--images 0,2,4,8] [--output results.json]
+
+Gemini is replaced by fakes.FakeGeminiModel (canned Markdown whose [IMAGE] count varies per topic
+over --images, with configurable per-call latency) and Bing by a local server returning the recorded
+pages in benchmarks/fixtures, so runs need no API key or network and are repeatable. Each concurrency level
+is driven through the Flask test client (in-process) and/or a real gunicorn server, and reports
+throughput plus p50/p95/p99 latency for the whole request and for each pipeline stage. The full
+results are written as JSON so runs before and after a change can be compared.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_wsgi import STAGES, install_stage_timers  # noqa: E402
+from fakes import BingStandInServer, FakeGeminiModel  # noqa: E402
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Linear-interpolated percentile (q in 0..100) of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(values: list[float]) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+    }
+
+
+def topics_for(run_name: str, count: int, distinct: int) -> list[str]:
+    # Unique topics per run keep the image result cache cold unless --distinct-topics asks for repeats
+    return [f"benchmark {run_name} topic {i % distinct if distinct else i}" for i in range(count)]
+
+
+def drive(send, topics: list[str], concurrency: int) -> tuple[list[float], int, float]:
+    """Sends one request per topic with `concurrency` client threads; returns (latencies, errors, wall seconds)."""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def one(topic: str) -> None:
+        nonlocal errors
+        started = time.perf_counter()
+        ok = send(topic)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            errors += 0 if ok else 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, topics))
+    return latencies, errors, time.perf_counter() - started
+
+
+def response_ok(status: int, body: str) -> bool:
+    return status == 200 and "data-error-message>" not in body and "<h1" in body
+
+
+class StageCollector:
+    """In-process stage recorder for the test client mode."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {stage: [] for stage in STAGES}
+
+    def __call__(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.samples = {stage: [] for stage in STAGES}
+
+
+def read_stage_log(path: str) -> dict:
+    samples = {stage: [] for stage in STAGES}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                samples[entry["stage"]].append(entry["seconds"])
+    return samples
+
+
+def build_run(mode: str, concurrency: int, latencies: list[float], errors: int, wall: float, stage_samples: dict) -> dict:
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "latency": summarize(latencies),
+        "stages": {stage: summarize(values) for stage, values in stage_samples.items() if values},
+    }
+
+
+def run_testclient(args, levels: list[int]) -> list[dict]:
+    import app as app_module
+
+    app_module.model = FakeGeminiModel(image_counts(args), args.explanation_latency, args.query_latency)
+    collector = StageCollector()
+    install_stage_timers(app_module, collector)
+
+    def send(topic: str) -> bool:
+        with app_module.app.test_client() as client:
+            response = client.post("/prepare", data={"prompt": topic})
+            return response_ok(response.status_code, response.get_data(as_text=True))
+
+    runs = []
+    for concurrency in levels:
+        with contextlib.redirect_stdout(io.StringIO()):  # The app logs several INFO lines per request
+            send(f"warmup testclient {concurrency}")
+            collector.reset()
+            topics = topics_for(f"testclient-c{concurrency}", args.requests, args.distinct_topics)
+            latencies, errors, wall = drive(send, topics, concurrency)
+        runs.append(build_run("testclient", concurrency, latencies, errors, wall, collector.samples))
+        print_run(runs[-1])
+    return runs
+
+
+def image_counts(args) -> list[int]:
+    return [int(count) for count in args.images.split(",")]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_gunicorn(args, levels: list[int]) -> list[dict]:
+    import requests
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    stage_log = tempfile.NamedTemporaryFile(prefix="bench_stages_", suffix=".jsonl", delete=False).name
+    server_log = tempfile.NamedTemporaryFile(prefix="bench_gunicorn_", suffix=".log", delete=False)
+    env = dict(os.environ, BENCH_STAGE_LOG=stage_log, BENCH_IMAGES=args.images,
+               BENCH_EXPLANATION_LATENCY=str(args.explanation_latency), BENCH_QUERY_LATENCY=str(args.query_latency))
+    command = [sys.executable, "-m", "gunicorn", "--chdir", BENCH_DIR, "--bind", f"127.0.0.1:{port}",
+               "--workers", str(args.workers), "--threads", str(args.threads), "--worker-class", "gthread",
+               "--timeout", "120", "bench_wsgi:create_app()"]
+    server = subprocess.Popen(command, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max(levels)))
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"gunicorn did not start; see {server_log.name}")
+            try:
+                if session.get(base_url + "/", timeout=1).status_code == 200:
+                    break
+            except requests.exceptions.RequestException:
+                time.sleep(0.2)
+
+        def send(topic: str) -> bool:
+            response = session.post(base_url + "/prepare", data={"prompt": topic}, timeout=120)
+            return response_ok(response.status_code, response.text)
+
+        runs = []
+        for concurrency in levels:
+            for worker in range(args.workers):  # Warm each worker's connection pool before measuring
+                send(f"warmup gunicorn {concurrency} {worker}")
+            open(stage_log, "w").close()
+            topics = topics_for(f"gunicorn-c{concurrency}", args.requests, args.distinct_topics)
+            latencies, errors, wall = drive(send, topics, concurrency)
+            time.sleep(0.1)  # Let workers finish writing stage lines for the last responses
+            runs.append(build_run("gunicorn", concurrency, latencies, errors, wall, read_stage_log(stage_log)))
+            print_run(runs[-1])
+        return runs
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        server_log.close()
+        os.unlink(stage_log)
+
+
+def print_run(run: dict) -> None:
+    latency = run["latency"]
+    print(f"{run['mode']:>10}  c={run['concurrency']:<3} {run['throughput_rps']:8.2f} req/s  "
+          f"p50 {latency['p50_ms']:8.1f}  p95 {latency['p95_ms']:8.1f}  p99 {latency['p99_ms']:8.1f} ms  "
+          f"errors {run['errors']}")
+    for stage, stats in run["stages"].items():
+        print(f"{'':>16}{stage:<18} n={stats['count']:<5} p50 {stats['p50_ms']:8.1f}  "
+              f"p95 {stats['p95_ms']:8.1f}  p99 {stats['p99_ms']:8.1f} ms")
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="testclient,gunicorn", help="comma-separated: testclient, gunicorn")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated client concurrency levels")
+    parser.add_argument("--requests", type=int, default=40, help="measured requests per concurrency level")
+    parser.add_argument("--images", default="0,2,4,8", help="comma-separated [IMAGE] counts the fake answers cycle through")
+    parser.add_argument("--explanation-latency", type=float, default=0.3, help="fake Gemini explanation latency (s)")
+    parser.add_argument("--query-latency", type=float, default=0.05, help="fake Gemini image query latency (s)")
+    parser.add_argument("--bing-latency", type=float, default=0.02, help="Bing stand-in response latency (s)")
+    parser.add_argument("--distinct-topics", type=int, default=0,
+                        help="cycle through this many topics (0 = every request unique)")
+    parser.add_argument("--answer-cache", action="store_true", help="leave the answer cache enabled")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--output", help="write results JSON here (default: print only)")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    bing = BingStandInServer(latency=args.bing_latency).start()
+    # Read by image_search/answer_cache at import, and inherited by the gunicorn workers
+    os.environ["BING_SEARCH_URL"] = bing.search_url
+    if not args.answer_cache:
+        os.environ["ANSWER_CACHE_ENABLED"] = "0"
+    os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+    os.environ.setdefault("IMAGE_PROXY_SECRET", "offline-benchmark")
+
+    runs = []
+    try:
+        for mode in modes:
+            if mode == "testclient":
+                runs += run_testclient(args, levels)
+            elif mode == "gunicorn":
+                runs += run_gunicorn(args, levels)
+            else:
+                parser.error(f"unknown mode: {mode}")
+    finally:
+        bing.stop()
+
+    results = {
+        "benchmark": "prepare",
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0 if all(run["errors"] == 0 for run in runs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Micro-benchmark: single-pass document renderer vs. the old per-segment rendering.
+
+Run from the repository root:
+    python benchmarks/bench_renderer.py [--repeat 20] [--images 10,50,150]
+
+The old path split the explanation on [IMAGE], ran the heading regex and markdown2 on every
+segment and built the page with string concatenation; renderer.render_document() scans the
+whole document once and converts it with a single Markdown instance. Documents come from fakes.canned_markdown (sections with lists, tables and
+code blocks, one [IMAGE] per section). The "one call" column converts the whole document with a
+single markdown2 call (RENDER_CHUNK_CHARS unbounded) to show why render_document() converts it in
+heading-bounded chunks. The single pass exists for correct output (lists and tables across [IMAGE]);
+on long documents it runs at about the speed of the per-segment path, not faster. The script also checks that both paths find the same image slots
+(heading and context) and exits non-zero if they differ.
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import markdown2  # noqa: E402
+
+import renderer  # noqa: E402
+from fakes import canned_markdown  # noqa: E402
+
+IMAGE_HTML = '<div class="image-container"><img src="https://example.com/image.jpg" alt="image" loading="lazy"></div>'
+
+
+def render_per_segment(text: str, user_prompt: str) -> tuple[str, list[dict]]:
+    """The pre-renderer pipeline: re.split on [IMAGE], one markdown2 call and heading scan per segment, +=."""
+    content_parts = re.split(r'(\[IMAGE\])', text)
+    slots = []
+    active_heading = user_prompt
+    for i, part in enumerate(content_parts):
+        if not part.strip():
+            continue
+        if part == '[IMAGE]':
+            preceding = content_parts[i - 1] if i > 0 and content_parts[i - 1] != '[IMAGE]' else ""
+            slots.append({"heading": active_heading, "context": preceding})
+        else:
+            headings = renderer.HEADING_REGEX.findall(part)
+            if headings:
+                active_heading = headings[-1][1].strip()
+                print(f"DEBUG: Active heading updated to: '{active_heading}' from text segment.")
+    html = ""
+    for part in content_parts:
+        if not part.strip():
+            continue
+        if part == '[IMAGE]':
+            html += IMAGE_HTML
+        else:
+            html += markdown2.markdown(part, extras=renderer.MARKDOWN_EXTRAS)
+    return html, slots
+
+
+def render_single_pass(text: str, user_prompt: str) -> tuple[str, list[dict]]:
+    document = renderer.render_document(text, user_prompt)
+    html = document.assemble([IMAGE_HTML] * len(document.image_slots))
+    return html, [{"heading": slot["heading"], "context": slot["context"]} for slot in document.image_slots]
+
+
+def render_one_call(text: str, user_prompt: str) -> tuple[str, list[dict]]:
+    chunk_chars, renderer.RENDER_CHUNK_CHARS = renderer.RENDER_CHUNK_CHARS, sys.maxsize
+    try:
+        return render_single_pass(text, user_prompt)
+    finally:
+        renderer.RENDER_CHUNK_CHARS = chunk_chars
+
+
+def _time(func, text: str, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # HeadingTracker logs a DEBUG line per heading
+            func(text, "benchmark topic")
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark whole-document vs. per-segment Markdown rendering.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--images", default="10,50,150", help="comma-separated [IMAGE] counts per document")
+    args = parser.parse_args()
+
+    mismatches = 0
+    print(f"{'images':>7} {'size KB':>8} {'per-segment ms':>15} {'one call ms':>12} {'single-pass ms':>15} {'speedup':>8}")
+    for images in (int(count) for count in args.images.split(",")):
+        text = canned_markdown("benchmark topic", images)
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, old_slots = render_per_segment(text, "benchmark topic")
+            _, new_slots = render_single_pass(text, "benchmark topic")
+        if old_slots != new_slots:
+            mismatches += 1
+            print(f"MISMATCH: image slots differ for {images} images")
+
+        old = statistics.median(_time(render_per_segment, text, args.repeat))
+        one_call = statistics.median(_time(render_one_call, text, args.repeat))
+        new = statistics.median(_time(render_single_pass, text, args.repeat))
+        print(f"{images:>7} {len(text) / 1024:>8.1f} {old * 1000:>15.2f} {one_call * 1000:>12.2f} "
+              f"{new * 1000:>15.2f} {old / new:>7.2f}x")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+WSGI entry point and stage timers for benchmarking the real app offline.
+
+gunicorn loads the factory with:
+    gunicorn --chdir benchmarks "bench_wsgi:create_app()"
+
+create_app() imports app.py with the fake Gemini model and image fetcher installed (configured from
+BENCH_* env vars, see fakes.FakeGeminiModel.from_env and fakes.FakeImageFetcher.from_env) and wraps the pipeline stages so every call's duration is
+appended as a JSON line to BENCH_STAGE_LOG. bench_prepare.py sets all of this up; the Bing stand-in
+is selected the normal way, through BING_SEARCH_URL.
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Pipeline stages timed per call, in pipeline order
+STAGES = ("explanation", "image_queries", "bing_fetch_parse", "markdown_render")
+
+
+def _timed(func, stage: str, record):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(stage, time.perf_counter() - started)
+    return wrapper
+
+
+def install_stage_timers(app_module, record) -> None:
+    """Wraps each pipeline stage of the imported app module so record(stage, seconds) is called per call."""
+    import image_search
+    app_module.generate_explanation = _timed(app_module.generate_explanation, "explanation", record)
+    app_module.generate_slot_queries = _timed(app_module.generate_slot_queries, "image_queries", record)
+    # Whole-document render for /prepare, per-section render for /prepare/stream
+    app_module.render_document = _timed(app_module.render_document, "markdown_render", record)
+    app_module.render_markdown = _timed(app_module.render_markdown, "markdown_render", record)
+    cache = image_search.result_set_cache
+    cache.fetcher = _timed(cache.fetcher, "bing_fetch_parse", record)
+
+
+class StageLog:
+    """Appends {"stage", "seconds"} JSON lines to a file shared by every worker process."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, stage: str, seconds: float) -> None:
+        line = json.dumps({"stage": stage, "seconds": seconds, "pid": os.getpid()}) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def create_app():
+    import app as app_module
+    import image_proxy
+    from fakes import FakeGeminiModel, FakeImageFetcher
+
+    app_module.model = FakeGeminiModel.from_env()
+    image_proxy.image_proxy.fetcher = FakeImageFetcher.from_env()
+    stage_log = os.getenv("BENCH_STAGE_LOG")
+    if stage_log:
+        install_stage_timers(app_module, StageLog(stage_log))
+    return app_module.app
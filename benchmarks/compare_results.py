@@ -0,0 +1,51 @@
+"""
+Compares two bench_prepare.py result files.
+
+Run from the repository root:
+    python benchmarks/compare_results.py before.json after.json
+
+Prints throughput and p50/p95/p99 request latency per (mode, concurrency) pair found in both files,
+with the relative change (negative latency / positive throughput changes are improvements).
+"""
+import argparse
+import json
+import sys
+
+
+def _load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        results = json.load(f)
+    return {(run["mode"], run["concurrency"]): run for run in results["runs"]}
+
+
+def _change(before: float, after: float) -> str:
+    if not before:
+        return "    n/a"
+    return f"{(after - before) / before * 100:+6.1f}%"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare two /prepare benchmark result files.")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    before, after = _load(args.before), _load(args.after)
+    shared = [key for key in before if key in after]
+    if not shared:
+        print("No (mode, concurrency) runs in common.")
+        return 1
+
+    for mode, concurrency in shared:
+        old, new = before[(mode, concurrency)], after[(mode, concurrency)]
+        print(f"{mode} c={concurrency}")
+        print(f"  {'throughput':<12}{old['throughput_rps']:10.2f} -> {new['throughput_rps']:10.2f} req/s "
+              f"{_change(old['throughput_rps'], new['throughput_rps'])}")
+        for field in ("p50_ms", "p95_ms", "p99_ms"):
+            old_value, new_value = old["latency"][field], new["latency"][field]
+            print(f"  {field:<12}{old_value:10.1f} -> {new_value:10.1f} ms    {_change(old_value, new_value)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Offline evaluation: local keyword image queries vs. recorded Gemini queries.
+
+Run from the repository root:
+    python benchmarks/eval_local_queries.py [records.jsonl ...] [--repeat 200] [--show 10]
+
+Records are JSON lines with topic, heading, context and the query Gemini produced, as written by the
+app with IMAGE_QUERY_RECORD_PATH set (latency_ms is the Gemini call time; batched calls are split
+evenly over their queries). Without arguments the script reads fixtures/image_queries_sample.jsonl,
+a small hand-written sample in the same format without latencies; record real traffic for numbers
+that mean something.
+
+For every record the local query and the old fallback (the bare heading) are compared with Gemini's
+query on content words (stopwords removed, plurals folded): precision, recall and F1 of the words,
+and the share of records where all of Gemini's words were found. Local query latency is measured
+in-process and printed next to the recorded Gemini latency.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_query  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+DEFAULT_RECORDS = os.path.join(FIXTURES_DIR, "image_queries_sample.jsonl")
+
+
+def _load(paths: list[str]) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return [record for record in records if record.get("query")]
+
+
+def _words(query: str) -> set[str]:
+    """Content-word stems of a query; visual words such as "diagram" count like any other word."""
+    return {local_query._stem(word.strip("'-")) for word in local_query._WORD_RE.findall(query)
+            if word.lower() not in local_query.STOPWORDS}
+
+
+def _overlap(candidate: str, reference: str) -> tuple[float, float, float]:
+    got, want = _words(candidate), _words(reference)
+    if not got or not want:
+        return 0.0, 0.0, 0.0
+    shared = len(got & want)
+    precision, recall = shared / len(got), shared / len(want)
+    f1 = 2 * precision * recall / (precision + recall) if shared else 0.0
+    return precision, recall, f1
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def _local(record: dict) -> str:
+    return local_query.generate_local_query(record["heading"], record["context"], record["topic"])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare local image queries with recorded Gemini queries.")
+    parser.add_argument("records", nargs="*", default=[DEFAULT_RECORDS], help="JSON lines files of recorded queries")
+    parser.add_argument("--repeat", type=int, default=200, help="timing runs per record")
+    parser.add_argument("--show", type=int, default=10, help="print this many records with the lowest local F1")
+    args = parser.parse_args()
+
+    records = _load(args.records)
+    if not records:
+        print("No records with a query found.")
+        return 1
+
+    rows = []
+    for record in records:
+        local = _local(record)
+        heading = record["heading"] or record["topic"]
+        rows.append((record, local, _overlap(local, record["query"]), _overlap(heading, record["query"])))
+
+    print(f"{len(records)} records")
+    print(f"{'':<14}{'precision':>10}{'recall':>8}{'F1':>8}{'all words':>11}")
+    for label, column in (("local", 2), ("heading only", 3)):
+        scores = [row[column] for row in rows]
+        full = sum(1 for score in scores if score[1] == 1.0) / len(scores)
+        print(f"{label:<14}{statistics.mean(s[0] for s in scores):>10.2f}{statistics.mean(s[1] for s in scores):>8.2f}"
+              f"{statistics.mean(s[2] for s in scores):>8.2f}{full:>10.0%}")
+
+    timings = []
+    for record in records:
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            _local(record)
+        timings.append((time.perf_counter() - started) / args.repeat)
+    print(f"\nlocal latency   p50 {_percentile(timings, 0.5) * 1e6:8.1f} us   p95 {_percentile(timings, 0.95) * 1e6:8.1f} us")
+    gemini_ms = [record["latency_ms"] for record in records if record.get("latency_ms") is not None]
+    if gemini_ms:
+        print(f"gemini latency  p50 {_percentile(gemini_ms, 0.5):8.1f} ms   p95 {_percentile(gemini_ms, 0.95):8.1f} ms"
+              f"   ({len(gemini_ms)} recorded)")
+    else:
+        print("gemini latency  not recorded in these files")
+
+    if args.show:
+        print("\nLowest local F1:")
+        for record, local, (_, _, f1), _ in sorted(rows, key=lambda row: row[2][2])[:args.show]:
+            print(f"  {f1:.2f}  gemini: {record['query']!r}\n        local:  {local!r}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
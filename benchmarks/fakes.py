@@ -0,0 +1,200 @@
+"""
+Offline stand-ins for the two upstreams of the /prepare pipeline.
+
+FakeGeminiModel replaces the google.generativeai model: it answers the explanation prompt with
+canned Markdown containing a configurable number of [IMAGE] placeholders, answers image query
+prompts (single and batched) from the headings in the prompt, and sleeps a configurable time per
+call so latency-bound behaviour can be measured. BingStandInServer serves the recorded result
+pages from benchmarks/fixtures over real HTTP, so the pooled HTTP client and the extractor run
+exactly as in production. FakeImageFetcher stands in for the image hosts behind the /img proxy.
+"""
+import json
+import os
+import functools
+import re
+import struct
+import threading
+import time
+import types
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def canned_markdown(topic: str, images: int) -> str:
+    """An explanation in the shape Gemini produces: H1, intro, H2/H3 sections, lists, a table, code and [IMAGE] lines."""
+    parts = [f"# {topic.title()}\n\n{topic.title()} is explained here in a direct, compact way. "
+             "This introduction sets up the key ideas before the sections go into detail.\n"]
+    if images:
+        parts.append("\n[IMAGE]\n")
+    for section in range(1, max(images, 3) + 1):
+        parts.append(f"\n## Part {section}: {topic} component {section}\n\n"
+                     f"Component {section} of {topic} works in stages. Each stage builds on the previous one, "
+                     "turning inputs into outputs while keeping the overall process efficient.\n\n"
+                     f"- Stage {section}.1 prepares the inputs\n- Stage {section}.2 transforms them\n"
+                     f"- Stage {section}.3 produces the result\n")
+        if section % 3 == 0:
+            parts.append("\n| Property | Value |\n|---|---|\n| Speed | High |\n| Cost | Low |\n")
+        if section % 4 == 0:
+            parts.append("\n```python\ndef stage(x):\n    return x * 2\n```\n")
+        if section < images:
+            parts.append("\n[IMAGE]\n")
+    return "".join(parts)
+
+
+class FakeGeminiModel:
+    """
+    Drop-in for genai.GenerativeModel with deterministic output and configurable latency (seconds).
+
+    `images` is the list of [IMAGE] counts answers cycle through; each topic always gets the same count.
+    Streaming responses spread the explanation latency over the chunks, with a short time to first chunk.
+    """
+
+    def __init__(self, images: list[int] = (0, 2, 4, 8), explanation_latency: float = 0.0, query_latency: float = 0.0,
+                 stream_chunk_chars: int = 80):
+        self.images = list(images)
+        self.explanation_latency = explanation_latency
+        self.query_latency = query_latency
+        self.stream_chunk_chars = stream_chunk_chars
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FakeGeminiModel":
+        return cls(
+            images=[int(count) for count in os.getenv("BENCH_IMAGES", "0,2,4,8").split(",")],
+            explanation_latency=float(os.getenv("BENCH_EXPLANATION_LATENCY", "0")),
+            query_latency=float(os.getenv("BENCH_QUERY_LATENCY", "0")),
+        )
+
+    def generate_content(self, prompt, safety_settings=None, generation_config=None, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        if "Explain the topic" in prompt:
+            topic = re.search(r'Explain the topic: "(.*?)"', prompt).group(1)
+            text = canned_markdown(topic, self.images_for(topic))
+            if stream:
+                return self._stream(text)
+            time.sleep(self.explanation_latency)
+            return types.SimpleNamespace(text=text)
+
+        time.sleep(self.query_latency)
+        if "JSON array" in prompt:
+            headings = re.findall(r'Heading: "(.*?)" \|', prompt)
+            return types.SimpleNamespace(text=json.dumps([f"{heading} diagram" for heading in headings]))
+        heading = re.search(r'section heading is: "(.*?)"', prompt).group(1)
+        return types.SimpleNamespace(text=f"{heading} diagram")
+
+    def images_for(self, topic: str) -> int:
+        return self.images[zlib.crc32(topic.encode("utf-8")) % len(self.images)]
+
+    def _stream(self, text: str):
+        chunks = [text[i:i + self.stream_chunk_chars] for i in range(0, len(text), self.stream_chunk_chars)]
+        per_chunk = self.explanation_latency / max(len(chunks), 1)
+        for chunk in chunks:
+            time.sleep(per_chunk)
+            yield types.SimpleNamespace(text=chunk)
+
+
+class BingStandInServer:
+    """
+    Local HTTP server answering /images/search with a recorded Bing results page.
+
+    Every query gets the main fixture with the query mixed into the image URLs, so different queries
+    yield different candidates while repeated queries stay identical.
+    """
+
+    def __init__(self, latency: float = 0.0, fixture: str = "bing_results.html", host: str = "127.0.0.1", port: int = 0):
+        with open(os.path.join(FIXTURES_DIR, fixture), encoding="utf-8") as f:
+            self.page = f.read()
+        self.latency = latency
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+                if server.latency:
+                    time.sleep(server.latency)
+                slug = re.sub(r"[^a-z0-9]+", "_", query.lower()).strip("_") or "empty"
+                body = server.page.replace("upload.example", f"{slug}.upload.example").encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def search_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/images/search"
+
+    def start(self) -> "BingStandInServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@functools.lru_cache(maxsize=16)
+def png_bytes(width: int, height: int, rgb: tuple[int, int, int]) -> bytes:
+    """A valid solid-colour RGB PNG, built without an imaging library."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    row = b"\x00" + bytes(rgb) * width
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b""))
+
+
+class FakeImageFetcher:
+    """
+    Drop-in for image_proxy.fetch_image: answers every URL with a PNG after `latency` seconds.
+    Originals are width x height pixels; Bing thumbnails (hosts under mm.bing.net) are small. With
+    dead_every=N, roughly one original in N fails with a connection error, as dead links do.
+    """
+
+    def __init__(self, latency: float = 0.0, width: int = 1600, height: int = 1200, dead_every: int = 0):
+        self.latency = latency
+        self.width = width
+        self.height = height
+        self.dead_every = dead_every
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FakeImageFetcher":
+        return cls(
+            latency=float(os.getenv("BENCH_IMAGE_LATENCY", "0")),
+            dead_every=int(os.getenv("BENCH_DEAD_IMAGE_EVERY", "0")),
+        )
+
+    def __call__(self, url: str) -> tuple[bytes, str]:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        checksum = zlib.crc32(url.encode("utf-8"))
+        colour = (checksum & 0xFF, (checksum >> 8) & 0xFF, (checksum >> 16) & 0xFF)
+        if ".mm.bing.net/" in url:
+            return png_bytes(160, 120, colour), "image/png"
+        if self.dead_every and checksum % self.dead_every == 0:
+            raise requests.exceptions.ConnectionError(f"stand-in: {url} is unreachable")
+        return png_bytes(self.width, self.height, colour), "image/png"
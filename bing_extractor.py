@@ -0,0 +1,82 @@
+"""
+Targeted extractor for Bing image result pages.
+
+Building a full BeautifulSoup tree of a Bing results page just to read a few attributes is
+expensive. This module makes one regex pass over the raw HTML, looks only at <a> and <img>
+start tags, and skips comments and <script>/<style> bodies the same way html.parser does.
+Attribute values are unescaped like BeautifulSoup would, so callers get identical results.
+"""
+import html
+import re
+
+# Start of anything the scanner cares about: a comment, a raw-text element or an <a>/<img> tag
+_START_RE = re.compile(r"<(?:(!--)|(script|style)(?=[\s/>])|(a|img)(?=[\s/>]))", re.IGNORECASE)
+# Rest of a start tag; quoted attribute values may contain '>' so the body alternates quoted and bare runs
+_TAG_BODY_RE = re.compile(r"""((?:[^>"']+|"[^"]*"|'[^']*')*)>""")
+_RAW_TEXT_END_RES = {name: re.compile(r"</" + name, re.IGNORECASE) for name in ("script", "style")}
+# Mirrors html.parser's attribute grammar: name, optional '=' and a quoted or bare value
+_ATTR_RE = re.compile(
+    r"""((?<=['"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*('[^']*'|"[^"]*"|(?!['"])[^>\s]*))?""",
+)
+_ABSOLUTE_URL_RE = re.compile(r'^https?://')
+
+
+def _attributes(tag_body: str) -> dict:
+    """Parses a start tag's attribute text into a dict (lowercased names, unescaped values, last duplicate wins)."""
+    attrs = {}
+    for match in _ATTR_RE.finditer(" " + tag_body):
+        name, has_value, value = match.groups()
+        if not has_value:
+            value = ""
+        elif value[:1] in ("'", '"') and value[-1:] == value[:1] and len(value) > 1:
+            value = value[1:-1]
+        attrs[name.lower()] = html.unescape(value) if "&" in value else value
+    return attrs
+
+
+def extract(page_html: str) -> tuple[list[str | None], list[str]]:
+    """
+    Returns (m_values, img_srcs) for a Bing results page.
+
+    m_values has one entry per <a> whose class list contains 'iusc' (its raw 'm' attribute, or None
+    when absent); img_srcs lists every <img> src starting with http:// or https://, in page order.
+    """
+    m_values = []
+    img_srcs = []
+    position = 0
+    while True:
+        match = _START_RE.search(page_html, position)
+        if match is None:
+            break
+        comment, raw_text_tag, tag = match.groups()
+
+        if comment:
+            end = page_html.find("-->", match.end())
+            position = len(page_html) if end < 0 else end + 3
+            continue
+
+        if raw_text_tag:
+            end_match = _RAW_TEXT_END_RES[raw_text_tag.lower()].search(page_html, match.end())
+            position = len(page_html) if end_match is None else end_match.start() + 2
+            continue
+
+        body_match = _TAG_BODY_RE.match(page_html, match.end())
+        if body_match is None:
+            position = match.end()
+            continue
+        position = body_match.end()
+        tag_body = body_match.group(1)
+
+        if tag.lower() == "a":
+            if "iusc" not in tag_body:
+                continue
+            attrs = _attributes(tag_body)
+            if "iusc" in attrs.get("class", "").split():
+                m_values.append(attrs.get("m"))
+        else:
+            if "src" not in tag_body.lower():
+                continue
+            src = _attributes(tag_body).get("src")
+            if src and _ABSOLUTE_URL_RE.search(src):
+                img_srcs.append(src)
+    return m_values, img_srcs
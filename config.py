@@ -0,0 +1,34 @@
+"""
+Environment-driven settings shared by the app modules.
+"""
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+def env_int(name: str, default: int) -> int:
+    """Reads an integer setting from the environment, falling back to the default when unset or invalid."""
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        print(f"WARNING: Invalid integer for {name}. Using default {default}.")
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    """Reads a float setting from the environment, falling back to the default when unset or invalid."""
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        print(f"WARNING: Invalid number for {name}. Using default {default}.")
+        return default
+
+
+def env_flag(name: str, default: bool) -> bool:
+    """Reads a boolean setting from the environment (1/true/yes/on)."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
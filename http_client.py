@@ -0,0 +1,187 @@
+"""
+Shared HTTP client for outbound fetches (Bing image search).
+
+One pooled requests.Session is reused by every worker thread so repeat requests to the same host
+skip the TCP+TLS handshake. Connections per host are bounded (callers block for a free connection
+instead of opening more), connect and read timeouts are separate, and idempotent requests are
+retried a limited number of times with jittered exponential backoff. Read timeouts are not retried:
+a slow upstream already cost a full read timeout, and another attempt would hold the worker again.
+
+Retries are made here rather than by urllib3 so they respect the request's time budget (see
+resilience): every attempt's timeouts are capped by the time left, and a retry is only started when
+the budget still covers its backoff and a full connect timeout.
+
+The client is pluggable: set_client() swaps in another object with a compatible get() so tests
+and benchmarks can talk to a local stand-in server or skip the network entirely.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError, ReadTimeoutError
+
+import metrics
+import resilience
+from config import env_int, env_float
+
+# Keep-alive connections kept per host; when all are busy further requests wait for one
+HTTP_POOL_MAXSIZE = max(1, env_int("HTTP_POOL_MAXSIZE", 10))
+# Number of distinct hosts whose connection pools are kept
+HTTP_POOL_HOSTS = max(1, env_int("HTTP_POOL_HOSTS", 10))
+HTTP_CONNECT_TIMEOUT = env_float("HTTP_CONNECT_TIMEOUT", 3.05)
+HTTP_READ_TIMEOUT = env_float("HTTP_READ_TIMEOUT", 6.0)
+# Retries after the first attempt (connection errors and 429/5xx responses; never read timeouts)
+HTTP_RETRIES = max(0, env_int("HTTP_RETRIES", 2))
+HTTP_BACKOFF_FACTOR = env_float("HTTP_BACKOFF_FACTOR", 0.25)
+HTTP_BACKOFF_JITTER = env_float("HTTP_BACKOFF_JITTER", 0.25)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def capped_timeout(timeout):
+    """A requests timeout (seconds or a (connect, read) pair) limited to the time left in the request's budget."""
+    if isinstance(timeout, tuple):
+        return tuple(resilience.cap_timeout(part) for part in timeout)
+    return resilience.cap_timeout(timeout)
+
+
+class PooledHttpClient:
+    """Thread-safe pooled HTTP client with bounded per-host connections, retries and timeouts."""
+
+    def __init__(self, pool_maxsize: int = HTTP_POOL_MAXSIZE, pool_hosts: int = HTTP_POOL_HOSTS,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT, read_timeout: float = HTTP_READ_TIMEOUT,
+                 retries: int = HTTP_RETRIES, backoff_factor: float = HTTP_BACKOFF_FACTOR,
+                 backoff_jitter: float = HTTP_BACKOFF_JITTER):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_jitter = backoff_jitter
+        # No retries inside urllib3; get() retries itself
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _retry_delay(self, retry_number: int) -> float | None:
+        """Backoff before the given retry (1-based), or None when no retry is left or the budget can't cover one."""
+        if retry_number > self.retries:
+            return None
+        delay = self.backoff_factor * (2 ** (retry_number - 1)) + random.uniform(0, self.backoff_jitter)
+        return delay if resilience.has_time(delay + self.timeout[0]) else None
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        timeout = kwargs.pop("timeout", self.timeout)
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        started = time.perf_counter()
+        try:
+            retry_number = 0
+            while True:
+                retry_number += 1
+                try:
+                    response = self.session.get(url, timeout=capped_timeout(timeout), **kwargs)
+                except requests.exceptions.RequestException as e:
+                    delay = self._retry_delay(retry_number) if is_connect_error(e) else None
+                    if delay is None:
+                        raise
+                else:
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        return response
+                    delay = self._retry_delay(retry_number)
+                    if delay is None:
+                        return response # The caller's raise_for_status() reports the last response
+                    response.close()
+                metrics.inc("http_retries_total", host=urlsplit(url).hostname or "unknown")
+                time.sleep(delay)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self.errors += 1
+            metrics.inc("http_errors_total")
+            raise
+        finally:
+            metrics.observe("http_request_seconds", time.perf_counter() - started)
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            client_stats = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "pool_maxsize": self.adapter._pool_maxsize,
+                "connect_timeout": self.timeout[0],
+                "read_timeout": self.timeout[1],
+            }
+        pools = {}
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle_connections": pool.pool.qsize() if pool.pool is not None else 0,
+            }
+        client_stats["pools"] = pools
+        return client_stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the process-wide client, creating the pooled default on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PooledHttpClient()
+    return _client
+
+
+def set_client(client) -> None:
+    """Replaces the process-wide client (anything with a requests-compatible get(url, **kwargs))."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return get_client().get(url, **kwargs)
+
+
+def _reason(e: Exception):
+    """The urllib3 error behind a requests exception raised for a MaxRetryError, if any."""
+    return getattr(e.args[0], "reason", None) if e.args else None
+
+
+def is_connect_error(e: Exception) -> bool:
+    """True when no connection could be made (refused, unresolvable, connect timeout): nothing was sent yet."""
+    return isinstance(e, requests.exceptions.ConnectTimeout) or (
+        isinstance(e, requests.exceptions.ConnectionError) and isinstance(_reason(e), ConnectTimeoutError))
+
+
+def is_timeout(e: Exception) -> bool:
+    """
+    True for connect and read timeouts. Once urllib3 has given up retrying, requests raises a read
+    timeout as ConnectionError wrapping MaxRetryError, so the underlying reason is checked as well.
+    """
+    if isinstance(e, requests.exceptions.Timeout):
+        return True
+    reason = _reason(e)
+    # NewConnectionError (refused, unresolvable) subclasses ConnectTimeoutError but is no timeout
+    return isinstance(reason, (ReadTimeoutError, ConnectTimeoutError)) and not isinstance(reason, NewConnectionError)
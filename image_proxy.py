@@ -0,0 +1,483 @@
+"""
+Image proxy: pages load result images from /img/<token> instead of hot-linking the originals.
+
+The token carries the chosen image's original URL ('murl') and Bing's thumbnail URL ('turl') from the
+same result, signed with IMAGE_PROXY_SECRET so the endpoint only fetches URLs this app handed out.
+Pages (and cached answers) rendered by one instance are served images by any other, so every instance
+must share the secret: the proxy is only turned on when IMAGE_PROXY_SECRET is set.
+The first request fetches the original once (size-limited), checks that the bytes really are an
+image, downscales it to IMAGE_PROXY_MAX_DIMENSION and stores the copy in a content-addressed disk
+cache shared by every worker. When the original is missing, too large or not an image, the Bing
+thumbnail is used instead. Cached copies are evicted least recently used first once the cache
+passes IMAGE_PROXY_CACHE_MAX_BYTES.
+
+Downscaling needs Pillow; without it, originals larger than IMAGE_PROXY_MAX_BYTES are refused and
+the (small) thumbnail is served. The upstream fetcher is pluggable (ImageProxy.fetcher) so tests
+and benchmarks can serve images from a local stand-in.
+"""
+import base64
+import contextlib
+import hashlib
+import hmac
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urljoin, urlsplit
+
+import requests
+
+import http_client
+import metrics
+import resilience
+from config import env_int, env_float, env_flag
+
+# Signing key for /img tokens, shared by every instance; without it the proxy stays off
+IMAGE_PROXY_SECRET = os.getenv("IMAGE_PROXY_SECRET", "")
+IMAGE_PROXY_ENABLED = env_flag("IMAGE_PROXY_ENABLED", True) and bool(IMAGE_PROXY_SECRET)
+if env_flag("IMAGE_PROXY_ENABLED", False) and not IMAGE_PROXY_SECRET:
+    print("WARNING: IMAGE_PROXY_ENABLED is set but IMAGE_PROXY_SECRET is not. Serving images directly; "
+          "set the same IMAGE_PROXY_SECRET on every instance to use the image proxy.")
+IMAGE_PROXY_CACHE_DIR = os.getenv("IMAGE_PROXY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bujji_image_cache"))
+IMAGE_PROXY_CACHE_MAX_BYTES = max(0, env_int("IMAGE_PROXY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Longest side of a stored copy (pixels) and the most bytes one stored copy may take
+IMAGE_PROXY_MAX_DIMENSION = max(64, env_int("IMAGE_PROXY_MAX_DIMENSION", 1024))
+IMAGE_PROXY_MAX_BYTES = max(1024, env_int("IMAGE_PROXY_MAX_BYTES", 400 * 1024))
+# Largest image (width x height) that is decoded at all; a small file can hold a huge image
+IMAGE_PROXY_MAX_PIXELS = max(1, env_int("IMAGE_PROXY_MAX_PIXELS", 24_000_000))
+# Originals larger than this are not downloaded; the thumbnail is served instead
+IMAGE_PROXY_MAX_SOURCE_BYTES = max(1024, env_int("IMAGE_PROXY_MAX_SOURCE_BYTES", 10 * 1024 * 1024))
+IMAGE_PROXY_CONNECT_TIMEOUT = env_float("IMAGE_PROXY_CONNECT_TIMEOUT", 2.0)
+IMAGE_PROXY_READ_TIMEOUT = env_float("IMAGE_PROXY_READ_TIMEOUT", 4.0)
+IMAGE_PROXY_MAX_REDIRECTS = max(0, env_int("IMAGE_PROXY_MAX_REDIRECTS", 3))
+# Image hosts whose keep-alive connections are kept
+IMAGE_PROXY_POOL_HOSTS = max(1, env_int("IMAGE_PROXY_POOL_HOSTS", 32))
+# Seconds a URL that could not be fetched or was not an image is not tried again
+IMAGE_PROXY_FAILURE_TTL = max(0, env_int("IMAGE_PROXY_FAILURE_TTL", 600))
+
+IMAGE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "image/avif,image/webp,image/png,image/jpeg,image/gif;q=0.9,*/*;q=0.5",
+}
+
+_SIGNATURE_BYTES = 16
+_FAILURES_MAX_ENTRIES = 4096
+
+
+class ImageRejected(Exception):
+    """The upstream answered, but not with an image this proxy will serve."""
+
+
+def sniff_image_type(data: bytes) -> str | None:
+    """MIME type from the image's magic bytes, or None if it is not a supported raster format."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return None  # SVG is deliberately not accepted: it can carry scripts
+
+
+def _is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])  # Drop an IPv6 zone index
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global
+
+
+def _is_public_url(url: str) -> bool:
+    """
+    http(s) URL whose host is not localhost and resolves only to public addresses. The connection
+    resolves the name again, so this keeps out private hosts and redirects to them, not DNS rebinding.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return False
+    host = parts.hostname.lower()
+    if host == "localhost" or host.endswith(".localhost"):
+        return False
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)}
+        return bool(addresses) and all(_is_public_address(address) for address in addresses)
+    except (OSError, UnicodeError, ValueError):
+        return False
+
+
+# Separate from http_client's session: arbitrary image hosts get no retries and do not push Bing's
+# keep-alive pool out of the per-host pool cache
+image_http_client = http_client.PooledHttpClient(
+    pool_hosts=IMAGE_PROXY_POOL_HOSTS,
+    connect_timeout=IMAGE_PROXY_CONNECT_TIMEOUT,
+    read_timeout=IMAGE_PROXY_READ_TIMEOUT,
+    retries=0,
+)
+
+
+def fetch_image(url: str) -> tuple[bytes, str | None]:
+    """
+    Downloads an image and returns (body, Content-Type header). Redirects are followed by hand (at most
+    IMAGE_PROXY_MAX_REDIRECTS) so every hop is checked to be public before it is requested. Raises
+    ImageRejected for non-public URLs and bodies over IMAGE_PROXY_MAX_SOURCE_BYTES, and requests
+    exceptions for network and HTTP errors.
+    """
+    for _ in range(IMAGE_PROXY_MAX_REDIRECTS + 1):
+        if not _is_public_url(url):
+            raise ImageRejected(f"not a public http(s) URL: {url[:70]}")
+        response = image_http_client.get(url, headers=IMAGE_HEADERS, stream=True, allow_redirects=False)
+        try:
+            if response.is_redirect:
+                url = urljoin(url, response.headers["Location"])
+                continue
+            response.raise_for_status()
+            declared_length = response.headers.get("Content-Length", "")
+            if declared_length.isdigit() and int(declared_length) > IMAGE_PROXY_MAX_SOURCE_BYTES:
+                raise ImageRejected(f"original is {int(declared_length)} bytes")
+            body = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                body += chunk
+                if len(body) > IMAGE_PROXY_MAX_SOURCE_BYTES:
+                    raise ImageRejected(f"original is over {IMAGE_PROXY_MAX_SOURCE_BYTES} bytes")
+            return bytes(body), response.headers.get("Content-Type")
+        finally:
+            response.close()
+    raise ImageRejected(f"more than {IMAGE_PROXY_MAX_REDIRECTS} redirects")
+
+
+def downscale(data: bytes, content_type: str) -> tuple[bytes, str]:
+    """
+    Returns the image (and its type) with its longest side at most IMAGE_PROXY_MAX_DIMENSION and at
+    most IMAGE_PROXY_MAX_BYTES, re-encoding only when needed. Images over IMAGE_PROXY_MAX_PIXELS are
+    refused from their header, before any pixel is decoded. Raises ImageRejected if that fails.
+    """
+    try:
+        from PIL import Image # Deferred to the first image that may need shrinking, to keep it out of the cold start
+    except ImportError:  # Optional: without Pillow images are size-checked but not downscaled
+        Image = None
+    if Image is None:
+        if len(data) > IMAGE_PROXY_MAX_BYTES:
+            raise ImageRejected(f"{len(data)} bytes and Pillow is not installed to downscale it")
+        return data, content_type
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            if width * height > IMAGE_PROXY_MAX_PIXELS:
+                raise ImageRejected(f"{width}x{height} pixels is over IMAGE_PROXY_MAX_PIXELS")
+            if max(width, height) <= IMAGE_PROXY_MAX_DIMENSION and len(data) <= IMAGE_PROXY_MAX_BYTES:
+                return data, content_type
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+            if image.mode in ("P", "1"):
+                # Palette images only resize with nearest-neighbour; convert first (one byte per pixel)
+                image = image.convert("RGBA" if has_alpha else "RGB")
+            image.draft("RGB", (IMAGE_PROXY_MAX_DIMENSION, IMAGE_PROXY_MAX_DIMENSION))  # JPEG: decode at reduced scale
+            image.thumbnail((IMAGE_PROXY_MAX_DIMENSION, IMAGE_PROXY_MAX_DIMENSION))
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        # Lower the JPEG quality and then the size until the copy fits the byte cap
+        for scale, quality in ((1.0, 82), (1.0, 65), (0.7, 65), (0.5, 50)):
+            side = int(IMAGE_PROXY_MAX_DIMENSION * scale)
+            if max(image.size) > side:
+                image.thumbnail((side, side))
+            out = io.BytesIO()
+            if has_alpha:
+                image.save(out, format="PNG", optimize=True)
+            else:
+                image.save(out, format="JPEG", quality=quality, optimize=True, progressive=True)
+            if out.tell() <= IMAGE_PROXY_MAX_BYTES:
+                return out.getvalue(), "image/png" if has_alpha else "image/jpeg"
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageRejected(f"could not decode image: {e}")
+    raise ImageRejected(f"still over {IMAGE_PROXY_MAX_BYTES} bytes after downscaling")
+
+
+class StoredImage:
+    """A processed image ready to serve; digest is the SHA-256 of data and doubles as the ETag."""
+    __slots__ = ("data", "content_type", "digest")
+
+    def __init__(self, data: bytes, content_type: str, digest: str):
+        self.data = data
+        self.content_type = content_type
+        self.digest = digest
+
+
+class ImageStore:
+    """
+    Content-addressed disk cache shared by every worker: blobs/<sha256> holds each distinct image once
+    and index/<sha256 of source URL> names the blob and type for a URL. Reads refresh the files'
+    mtime, and eviction removes the least recently used blobs once the total passes max_bytes.
+    The running total is a per-process estimate; every eviction pass recounts it from disk.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._blob_dir = os.path.join(directory, "blobs")
+        self._index_dir = os.path.join(directory, "index")
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Counted from disk on first write
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.write_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _index_path(self, url: str) -> str:
+        return os.path.join(self._index_dir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def get(self, url: str) -> StoredImage | None:
+        if not self.enabled:
+            return None
+        index_path = self._index_path(url)
+        try:
+            with open(index_path, encoding="ascii") as f:
+                digest, content_type = f.read().split(" ", 1)
+            blob_path = os.path.join(self._blob_dir, digest)
+            with open(blob_path, "rb") as f:
+                data = f.read()
+            os.utime(blob_path)
+            os.utime(index_path)
+        except FileNotFoundError:
+            if os.path.exists(index_path):  # Blob was evicted: drop the dangling index entry
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(index_path)
+            with self._lock:
+                self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Could not read cached image for {url[:70]}: {e}")
+            return None
+        with self._lock:
+            self.hits += 1
+        return StoredImage(data, content_type, digest)
+
+    def put(self, url: str, data: bytes, content_type: str) -> StoredImage:
+        digest = hashlib.sha256(data).hexdigest()
+        image = StoredImage(data, content_type, digest)
+        if not self.enabled:
+            return image
+        try:
+            os.makedirs(self._blob_dir, exist_ok=True)
+            os.makedirs(self._index_dir, exist_ok=True)
+            blob_path = os.path.join(self._blob_dir, digest)
+            added = 0
+            if not os.path.exists(blob_path):
+                _write_atomically(blob_path, data)
+                added = len(data)
+            _write_atomically(self._index_path(url), f"{digest} {content_type}".encode("ascii"))
+        except OSError as e:
+            with self._lock:
+                self.write_errors += 1
+            print(f"WARNING: Could not store image for {url[:70]} in {self.directory}: {e}")
+            return image
+
+        with self._lock:
+            self.writes += 1
+            if self._total_bytes is None:
+                self._total_bytes = self._disk_usage()
+            else:
+                self._total_bytes += added
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return image
+
+    def _disk_usage(self) -> int:
+        with contextlib.suppress(FileNotFoundError):
+            return sum(entry.stat().st_size for entry in os.scandir(self._blob_dir) if entry.is_file())
+        return 0
+
+    def _evict(self) -> None:
+        """Deletes least recently used blobs until the cache is at 90% of its budget. Caller holds _lock."""
+        blobs = []
+        with contextlib.suppress(FileNotFoundError):
+            for entry in os.scandir(self._blob_dir):
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    blobs.append((stat.st_mtime, stat.st_size, entry.path))
+        blobs.sort()
+        total = sum(size for _, size, _ in blobs)
+        cutoff = None
+        for mtime, size, path in blobs:
+            if total <= self.max_bytes * 0.9:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+            cutoff = mtime
+            self.evictions += 1
+            metrics.inc("image_proxy_cache_evictions_total")
+        self._total_bytes = total
+        if cutoff is not None:
+            # Index entries are touched together with their blob, so older ones point at evicted blobs
+            with contextlib.suppress(FileNotFoundError):
+                for entry in os.scandir(self._index_dir):
+                    if entry.stat().st_mtime <= cutoff:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(entry.path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "write_errors": self.write_errors,
+            }
+
+
+def _write_atomically(path: str, data: bytes) -> None:
+    temp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class _Flight:
+    """A fetch in progress that concurrent requests for the same URL wait on."""
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class ImageProxy:
+    """
+    Fetches, validates, downscales and caches proxied images. Concurrent requests for the same URL
+    share one fetch, and URLs that failed are not retried for IMAGE_PROXY_FAILURE_TTL seconds.
+    """
+
+    def __init__(self, store: ImageStore, fetcher=fetch_image, failure_ttl: float = IMAGE_PROXY_FAILURE_TTL):
+        self.store = store
+        self.fetcher = fetcher
+        self.failure_ttl = failure_ttl
+        self._lock = threading.Lock()
+        self._in_flight = {}  # url -> _Flight
+        self._failed_until = {}  # url -> time.monotonic() before which the URL is not fetched again
+
+    def get(self, url: str) -> StoredImage | None:
+        """The processed image for one URL, from the disk cache or fetched now; None if unavailable."""
+        image = self.store.get(url)
+        if image is not None:
+            metrics.inc("image_proxy_total", outcome="hit")
+            return image
+
+        with self._lock:
+            if self._failed_until.get(url, 0) > time.monotonic():
+                metrics.inc("image_proxy_total", outcome="known_bad")
+                return None
+            flight = self._in_flight.get(url)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[url] = _Flight()
+        if not leader:
+            flight.done.wait(resilience.cap_timeout(IMAGE_PROXY_CONNECT_TIMEOUT + IMAGE_PROXY_READ_TIMEOUT + 1))
+            return flight.result
+
+        try:
+            flight.result = self._fetch(url)
+            return flight.result
+        finally:
+            with self._lock:
+                self._in_flight.pop(url, None)
+                if flight.result is None and self.failure_ttl > 0:
+                    if len(self._failed_until) >= _FAILURES_MAX_ENTRIES:
+                        now = time.monotonic()
+                        self._failed_until = {key: until for key, until in self._failed_until.items() if until > now}
+                    self._failed_until[url] = time.monotonic() + self.failure_ttl
+            flight.done.set()
+
+    def _fetch(self, url: str) -> StoredImage | None:
+        try:
+            with metrics.timer("image_proxy_fetch"):
+                data, declared_type = self.fetcher(url)
+            content_type = sniff_image_type(data)
+            if content_type is None:
+                raise ImageRejected(f"body is not a supported image (Content-Type: {declared_type})")
+            with metrics.timer("image_proxy_resize"):
+                data, content_type = downscale(data, content_type)
+        except ImageRejected as e:
+            metrics.inc("image_proxy_total", outcome="rejected")
+            print(f"WARNING: Not proxying image {url[:70]}: {e}")
+            return None
+        except requests.exceptions.RequestException as e:
+            metrics.inc("image_proxy_total", outcome="timeout" if http_client.is_timeout(e) else "fetch_error")
+            print(f"WARNING: Could not fetch image {url[:70]}: {e}")
+            return None
+        metrics.inc("image_proxy_total", outcome="fetched")
+        return self.store.put(url, data, content_type)
+
+    def resolve(self, image_url: str, thumbnail_url: str | None) -> tuple[StoredImage | None, str]:
+        """The image for a token: the original, else the Bing thumbnail. Returns (image, "original"|"thumbnail"|"none")."""
+        image = self.get(image_url)
+        if image is not None:
+            return image, "original"
+        if thumbnail_url:
+            image = self.get(thumbnail_url)
+            if image is not None:
+                metrics.inc("image_proxy_thumbnail_fallback_total")
+                return image, "thumbnail"
+        return None, "none"
+
+
+def _signing_key() -> bytes:
+    return IMAGE_PROXY_SECRET.encode("utf-8")
+
+
+def key_id() -> str:
+    """Short fingerprint of the signing key, so answers cached under another key are not served."""
+    return hashlib.sha256(_signing_key()).hexdigest()[:12]
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def make_token(image_url: str, thumbnail_url: str | None = None) -> str:
+    """Signed, URL-safe token naming the original image and its optional thumbnail."""
+    payload = f"{image_url}\n{thumbnail_url or ''}".encode("utf-8")
+    signature = hmac.new(_signing_key(), payload, hashlib.sha256).digest()[:_SIGNATURE_BYTES]
+    return f"{_b64encode(payload)}.{_b64encode(signature)}"
+
+
+def read_token(token: str) -> tuple[str, str | None] | None:
+    """
+    (image_url, thumbnail_url) for a token made by make_token(), or None if it is malformed or forged.
+    Without IMAGE_PROXY_SECRET every token is refused: an empty HMAC key would let anyone sign one.
+    """
+    if not IMAGE_PROXY_SECRET:
+        return None
+    encoded_payload, _, encoded_signature = token.partition(".")
+    try:
+        payload = base64.urlsafe_b64decode(encoded_payload + "=" * (-len(encoded_payload) % 4))
+        signature = base64.urlsafe_b64decode(encoded_signature + "=" * (-len(encoded_signature) % 4))
+    except ValueError:
+        return None
+    expected = hmac.new(_signing_key(), payload, hashlib.sha256).digest()[:_SIGNATURE_BYTES]
+    if not hmac.compare_digest(signature, expected):
+        return None
+    image_url, _, thumbnail_url = payload.decode("utf-8", errors="replace").partition("\n")
+    return image_url, thumbnail_url or None
+
+
+def proxy_url(image_url: str, thumbnail_url: str | None = None) -> str:
+    """Path of the /img endpoint serving this image."""
+    return f"/img/{make_token(image_url, thumbnail_url)}"
+
+
+image_proxy = ImageProxy(ImageStore(IMAGE_PROXY_CACHE_DIR, IMAGE_PROXY_CACHE_MAX_BYTES))
@@ -0,0 +1,272 @@
+"""
+Bing image search result sets.
+
+Each query's Bing results page is fetched and parsed once into a BingResultSet holding every
+candidate URL in page order. Result sets are kept in a bounded, TTL-limited LRU cache so index
+lookups, dedupe retries and repeat queries across requests do not touch the network again.
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import bing_extractor
+import http_client
+import metrics
+import resilience
+from config import env_int
+
+# Number of distinct queries whose result sets are kept in memory (0 disables caching)
+IMAGE_RESULT_CACHE_SIZE = max(0, env_int("IMAGE_RESULT_CACHE_SIZE", 512))
+# Seconds a cached result set stays valid
+IMAGE_RESULT_CACHE_TTL = max(0, env_int("IMAGE_RESULT_CACHE_TTL", 3600))
+# Results page parser: "fast" (targeted extractor) or "soup" (full BeautifulSoup tree)
+BING_PARSER = os.getenv("BING_PARSER", "fast").strip().lower()
+
+# Results page endpoint; point it at a local stand-in server for tests and benchmarks
+BING_SEARCH_URL = os.getenv("BING_SEARCH_URL", "https://www.bing.com/images/search")
+
+BING_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"}
+FALLBACK_SRC_EXCLUDES = ('logo', 'icon', 'svg', 'spinner', 'loader', 'avatar')
+
+
+class BingResultSet:
+    """
+    Ordered image candidates from one Bing results page.
+
+    murls holds the 'murl' of every a.iusc element (None where the 'm' JSON is missing or broken);
+    fallback_srcs holds every absolute img src, with filtered-out entries kept as None so positions
+    line up with the page. thumbnails maps a murl to Bing's thumbnail ('turl') from the same 'm' JSON.
+    """
+    __slots__ = ("query", "murls", "fallback_srcs", "thumbnails")
+
+    def __init__(self, query: str, murls: list, fallback_srcs: list, thumbnails: dict | None = None):
+        self.query = query
+        self.murls = murls
+        self.fallback_srcs = fallback_srcs
+        self.thumbnails = thumbnails if thumbnails is not None else {}
+
+    @property
+    def candidates(self) -> list[str | None]:
+        """The list image indices refer to: iusc results when the page has any, otherwise the img fallback."""
+        return self.murls if self.murls else self.fallback_srcs
+
+
+def _build_result_set(search_query: str, m_values: list, img_srcs: list) -> BingResultSet:
+    """
+    Turns raw iusc 'm' attributes and absolute img srcs into a BingResultSet.
+    """
+    murls = []
+    thumbnails = {}
+    for position, m_data in enumerate(m_values):
+        image_url = None
+        if m_data:
+            try:
+                metadata = json.loads(m_data)
+                image_url = metadata.get("murl") or None
+                if image_url and metadata.get("turl"):
+                    thumbnails.setdefault(image_url, metadata["turl"])
+            except json.JSONDecodeError:
+                print(f"WARNING: Could not parse 'm' attribute JSON for image element at index {position} for query '{search_query}'.")
+        murls.append(image_url)
+
+    fallback_srcs = []
+    for src in img_srcs:
+        # Basic filter for meaningful images (size might not always be available)
+        if src and not any(x in src for x in FALLBACK_SRC_EXCLUDES) and not src.startswith('data:image'):
+            fallback_srcs.append(src)
+        else:
+            fallback_srcs.append(None)
+
+    if not murls:
+        print(f"INFO: No 'iusc' image elements found on Bing for query '{search_query}'. Using {len(fallback_srcs)} fallback img tags.")
+    return BingResultSet(search_query, murls, fallback_srcs, thumbnails)
+
+
+def parse_result_page_soup(search_query: str, html: str) -> BingResultSet:
+    """
+    Reference parser: builds a full BeautifulSoup tree of the page. Kept for BING_PARSER=soup and benchmarks.
+    """
+    from bs4 import BeautifulSoup # Only this parser needs bs4, so it is imported on first use
+    soup = BeautifulSoup(html, 'html.parser')
+    m_values = [element.get("m") for element in soup.find_all("a", {"class": "iusc"})]
+    img_srcs = [img_tag.get('src') for img_tag in soup.find_all('img', {'src': re.compile(r'^https?://')})]
+    return _build_result_set(search_query, m_values, img_srcs)
+
+
+def parse_result_page_fast(search_query: str, html: str) -> BingResultSet:
+    """
+    Default parser: a single targeted pass over the raw HTML (see bing_extractor).
+    """
+    m_values, img_srcs = bing_extractor.extract(html)
+    return _build_result_set(search_query, m_values, img_srcs)
+
+
+def parse_result_page(search_query: str, html: str) -> BingResultSet:
+    """
+    Extracts the iusc 'murl' list and the filtered img fallback list from a Bing results page.
+    """
+    if BING_PARSER == "soup":
+        return parse_result_page_soup(search_query, html)
+    return parse_result_page_fast(search_query, html)
+
+
+def is_bing_outage(e: Exception) -> bool:
+    """Timeouts, connection failures and 429/5xx responses count towards opening the Bing circuit."""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in http_client.RETRY_STATUS_CODES
+    return isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+
+def fetch_result_set(search_query: str) -> BingResultSet | None:
+    """
+    Downloads and parses the Bing results page for the query. Returns None if the request fails, the
+    Bing circuit is open, or too little of the request's time budget is left to fetch.
+    """
+    if not resilience.has_time(resilience.IMAGE_FETCH_MIN_SECONDS):
+        print(f"WARNING: Request time budget is running out. Skipping Bing fetch for query: '{search_query}'")
+        metrics.inc("image_fetch_skipped_total", reason="deadline")
+        return None
+    print(f"INFO: Fetching Bing image results for query: '{search_query}'")
+    encoded_query = requests.utils.quote(search_query)
+    url = f"{BING_SEARCH_URL}?q={encoded_query}&form=HDRSC2"
+    try:
+        with metrics.timer("bing_fetch"), resilience.bing_breaker.guard(is_failure=is_bing_outage):
+            response = http_client.get(url, headers=BING_HEADERS)
+            response.raise_for_status()
+        with metrics.timer("bing_parse"):
+            return parse_result_page(search_query, response.text)
+    except resilience.CircuitOpenError as e:
+        metrics.inc("image_fetch_skipped_total", reason="circuit_open")
+        print(f"WARNING: Skipping Bing fetch for query '{search_query}': {e}")
+    except requests.exceptions.RequestException as e:
+        if http_client.is_timeout(e):
+            metrics.inc("bing_fetch_errors_total", reason="timeout")
+            print(f"WARNING: Request timed out for Bing Image Search ('{search_query}'). Error: {e}")
+        else:
+            metrics.inc("bing_fetch_errors_total", reason="http" if isinstance(e, requests.exceptions.HTTPError) else "connection")
+            print(f"WARNING: Request failed for Bing Image Search ('{search_query}'). Error: {e}")
+    except Exception as e:
+        metrics.inc("bing_fetch_errors_total", reason="parse")
+        print(f"WARNING: An unexpected error occurred while processing Bing Image Search ('{search_query}'). Error: {e}")
+    return None
+
+
+class _Flight:
+    """A fetch in progress that concurrent callers for the same query wait on."""
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class ResultSetCache:
+    """
+    Thread-safe LRU cache of BingResultSet objects with a per-entry TTL.
+
+    Concurrent lookups of the same missing query share a single fetch. Failed fetches are not cached.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, fetcher=fetch_result_set):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.fetcher = fetcher
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # normalized query -> (expires_at, BingResultSet)
+        self._in_flight = {}  # normalized query -> _Flight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _normalize(search_query: str) -> str:
+        return " ".join(search_query.split()).lower()
+
+    def _record(self, outcome: str) -> None:
+        metrics.inc("image_result_cache_total", outcome=outcome)
+
+    def get(self, search_query: str) -> BingResultSet | None:
+        key = self._normalize(search_query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, result_set = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self._record("hit")
+                    return result_set
+                del self._entries[key]
+                self.expirations += 1
+                self._record("expired")
+
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+                self.misses += 1
+                self._record("miss")
+            else:
+                self.coalesced += 1
+                self._record("coalesced")
+
+        if not leader:
+            # Another thread is already fetching this query; share its result (within this request's budget)
+            flight.done.wait(resilience.cap_timeout(None))
+            return flight.result
+
+        try:
+            flight.result = self.fetcher(search_query)
+            if flight.result is not None:
+                self.put(key, flight.result)
+            return flight.result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.done.set()
+
+    def put(self, key: str, result_set: BingResultSet) -> None:
+        if self.max_entries <= 0 or self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, result_set)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                self._record("eviction")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "coalesced": self.coalesced,
+            }
+
+
+result_set_cache = ResultSetCache(IMAGE_RESULT_CACHE_SIZE, IMAGE_RESULT_CACHE_TTL)
+
+
+def get_result_set(search_query: str) -> BingResultSet | None:
+    """Returns the (possibly cached) result set for the query, or None if it could not be fetched."""
+    if not search_query:
+        print("WARNING: Empty search query provided to get_result_set.")
+        return None
+    return result_set_cache.get(search_query)
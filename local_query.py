@@ -0,0 +1,223 @@
+"""
+In-process image search queries: keyword extraction over the section heading, the text before the
+[IMAGE] placeholder and the user's topic, without a Gemini round-trip.
+
+Text is split into candidate phrases at stopwords and punctuation (runs of content words, as in
+RAKE). Words are weighted by where they occur (heading > topic > context) and by a cheap noun test
+(suffixes such as -tion/-sis/-ism, capitalised words); context words that look like verbs or adverbs
+are dropped. The query keeps the heading words (plus the topic when the heading is a single word),
+adds the best-scoring context phrase, ends with "diagram" or "map" when the section calls for one
+and stays within 3-7 words.
+
+With IMAGE_QUERY_RECORD_PATH set, every query Gemini generates is appended to that file as one JSON
+line (topic, heading, context, query, latency), which benchmarks/eval_local_queries.py reads to
+compare the local queries against Gemini's.
+"""
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+import metrics
+
+MIN_QUERY_WORDS = 3
+MAX_QUERY_WORDS = 7
+
+# Where a word was found; a heading word is worth three context words
+HEADING_WEIGHT = 3.0
+TOPIC_WEIGHT = 2.0
+CONTEXT_WEIGHT = 1.0
+
+IMAGE_QUERY_RECORD_PATH = os.getenv("IMAGE_QUERY_RECORD_PATH", "").strip()
+
+STOPWORDS = frozenset("""
+a about above after again against all almost along also although always am among an and another any are
+around as at be became because become becomes been before being below between both but by can cannot
+could did do does doing done down during each either else enough etc even ever every few for from
+further get gets getting given gives go goes going had has have having he her here hers herself him
+himself his how however i if in into is it its itself just least less let like made mainly make makes
+making many may me might more most mostly much must my myself near need needs neither no nor not now of
+off often on once one only onto or other others otherwise our ours ourselves out over own per perhaps
+quite rather really same see seen several shall she should since so some something sometimes still such
+than that the their theirs them themselves then there therefore these they this those though through
+thus to together too toward towards under unless until up upon us use used uses using usually various
+very via was we well were what whatever when where whether which while who whom whose why will with
+within without would yet you your yours yourself
+""".split())
+
+# Words that say what kind of section it is rather than what it shows, and filler verbs and adjectives
+GENERIC_WORDS = frozenset("""
+introduction overview conclusion summary basics fundamentals definition definitions key main important
+importance understanding explained explanation example examples role things thing way ways aspect aspects
+feature features part parts type types kind kinds different general common specific new first second
+third final called known two three four five six seven eight nine ten left right multiple large small significant essential certain simple basic particular
+occur occurs allow allows include includes provide provides contain contains involve involves create
+creates help helps form forms take takes play plays show shows describe describes refer refers mean means
+consist consists depend depends enable enables require requires support supports produce produces
+break breaks convert converts lead leads result results become becomes work works exist exists keep keeps
+""".split())
+
+# Words that already ask for a kind of picture
+VISUAL_WORDS = frozenset("""
+diagram diagrams chart charts graph graphs map maps illustration illustrations photo photos photograph
+image images picture pictures infographic infographics flowchart schematic timeline
+""".split())
+
+# Section words that make a diagram the most useful kind of picture, and heading words that make it a map
+DIAGRAM_HINTS = frozenset("""
+process cycle stage step structure anatomy mechanism architecture flow pathway layer component system
+model workflow lifecycle circuit reaction chain network membrane organ chamber cell molecule
+""".split())
+MAP_HINTS = frozenset("""
+empire kingdom country countries continent region border boundary route territory
+""".split())
+
+_NOUN_SUFFIXES = ("tion", "sion", "ment", "ness", "ity", "ism", "ist", "sis", "ogy", "ure", "ance",
+                  "ence", "ship", "hood", "graphy", "meter", "cycle", "ase", "ose", "ide", "ine")
+_WEAK_SUFFIXES = ("ly", "ing", "ed", "ize", "ise", "ful", "ous", "ive")
+
+_MARKUP_RE = re.compile(r"\[IMAGE\]|!?\[([^\]]*)\]\([^)]*\)|[*_`>|#~]+")
+# Sentence and clause punctuation ends a candidate phrase
+_CLAUSE_RE = re.compile(r"[.,;:!?()\[\]{}\"–—]|\s-\s|\.\.\.")
+_WORD_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9'+\-]*")
+
+_record_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=4096)
+def _stem(word: str) -> str:
+    """Lowercased word with a plural or possessive ending removed, so "Cells" and "cell's" count as one."""
+    word = word.lower()
+    if word.endswith("'s"):
+        word = word[:-2]
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ses", "xes", "ches", "shes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+_DIAGRAM_HINT_STEMS = frozenset(_stem(word) for word in DIAGRAM_HINTS)
+_MAP_HINT_STEMS = frozenset(_stem(word) for word in MAP_HINTS)
+
+
+def _is_content_word(lowered: str) -> bool:
+    if lowered.endswith("'s"):
+        lowered = lowered[:-2]
+    if lowered in STOPWORDS or lowered in GENERIC_WORDS:
+        return False
+    if lowered.isdigit():
+        return len(lowered) == 4  # Years are worth searching for, counts and list numbers are not
+    return len(lowered) > 1
+
+
+def _noun_weight(word: str, lowered: str, sentence_start: bool) -> float:
+    if word[0].isupper() and not sentence_start:
+        return 1.3  # Proper noun or term of art
+    if lowered.endswith(_NOUN_SUFFIXES):
+        return 1.5
+    if lowered.endswith(_WEAK_SUFFIXES):
+        return 0.5
+    return 1.0
+
+
+def _phrases(text: str, weight: float, scores: dict) -> list[list[str]]:
+    """
+    Runs of consecutive content words, split at stopwords and clause punctuation (and, in the context,
+    at words that look like verbs or adverbs). Adds each kept word's weight (source weight times noun
+    weight) to scores, keyed by its stem.
+    """
+    phrases = []
+    for clause in _CLAUSE_RE.split(_MARKUP_RE.sub(r" \1 ", text)):
+        current = []
+        for position, word in enumerate(_WORD_RE.findall(clause)):
+            word = word.strip("'-")
+            lowered = word.lower()
+            noun_weight = _noun_weight(word, lowered, position == 0) if word and _is_content_word(lowered) else 0.0
+            if noun_weight and (noun_weight > 0.5 or weight > CONTEXT_WEIGHT):
+                current.append(word)
+                key = _stem(lowered)
+                scores[key] = scores.get(key, 0.0) + weight * noun_weight
+            elif current:
+                phrases.append(current)
+                current = []
+        if current:
+            phrases.append(current)
+    return phrases
+
+
+def generate_local_query(heading: str, context_text: str, original_topic: str) -> str:
+    """
+    Builds a 3-7 word Bing image query from the heading, the (cleaned) preceding text and the topic.
+    Falls back to the heading, then the topic, when neither has a content word.
+    """
+    with metrics.timer("image_query_local"):
+        scores = {}
+        heading_words = [word for phrase in _phrases(heading, HEADING_WEIGHT, scores) for word in phrase]
+        topic_words = [word for phrase in _phrases(original_topic, TOPIC_WEIGHT, scores) for word in phrase]
+        context_phrases = _phrases(context_text, CONTEXT_WEIGHT, scores)
+        query, seen = [], set()
+
+        def add(words: list[str], limit: int = MAX_QUERY_WORDS) -> None:
+            for word in words:
+                key = _stem(word)
+                if key not in seen and len(query) < limit:
+                    seen.add(key)
+                    query.append(word)
+
+        # A heading of one content word ("History", "Functions") needs the topic to mean anything
+        heading_stems = {_stem(word) for word in heading_words}
+        topic_stems = {_stem(word) for word in topic_words}
+        if len(heading_stems) < 2 and heading_stems.isdisjoint(topic_stems):
+            add(topic_words, limit=3)
+        add(heading_words, limit=len(query) + 4)
+
+        # Then the context phrase that carries the most weight per word, longer phrases slightly preferred
+        ranked = sorted(
+            (phrase[:3] for phrase in context_phrases),
+            key=lambda phrase: sum(scores.get(_stem(word), 0.0) for word in phrase) / len(phrase) * (1 + 0.25 * (len(phrase) - 1)),
+            reverse=True,
+        )
+        target = max(MIN_QUERY_WORDS, min(MAX_QUERY_WORDS - 2, len(query) + 2))
+        for phrase in ranked:
+            if len(query) >= target:
+                break
+            new_words = sum(1 for word in phrase if _stem(word) not in seen)
+            if len(query) + new_words <= target or len(query) < MIN_QUERY_WORDS:
+                add(phrase, limit=MAX_QUERY_WORDS - 1)
+
+        if not query:
+            return heading.strip() or original_topic.strip()
+
+        lowered = {word.lower() for word in query}
+        if len(query) < MAX_QUERY_WORDS and not lowered & VISUAL_WORDS:
+            if not _MAP_HINT_STEMS.isdisjoint(heading_stems):
+                query.append("map")
+            elif not _DIAGRAM_HINT_STEMS.isdisjoint(scores):
+                query.append("diagram")
+        return " ".join(query)
+
+
+def record_gemini_query(original_topic: str, heading: str, context_text: str, query: str,
+                        latency_seconds: float, batched: bool = False) -> None:
+    """Appends one Gemini-generated query to IMAGE_QUERY_RECORD_PATH (no-op when unset)."""
+    if not IMAGE_QUERY_RECORD_PATH:
+        return
+    record = {
+        "topic": original_topic,
+        "heading": heading,
+        "context": context_text,
+        "query": query,
+        "latency_ms": round(latency_seconds * 1000, 1),
+        "batched": batched,
+        "recorded_at": time.time(),
+    }
+    try:
+        with _record_lock, open(IMAGE_QUERY_RECORD_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"WARNING: Could not record image query to {IMAGE_QUERY_RECORD_PATH}: {e}")
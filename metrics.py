@@ -0,0 +1,222 @@
+"""
+Lightweight in-process metrics for the search pipeline.
+
+Counters, summaries and histograms are process-wide and thread-safe. A RequestStats object can be
+attached to the current request (via a context variable) to tally per-request numbers, such as how
+many Gemini calls a single /prepare made and how long each pipeline stage took (for Server-Timing).
+
+Pipeline stages are timed with `with metrics.timer("stage"):`. With METRICS_ENABLED=0 the timers are
+a shared no-op context manager and only the per-request counter tallies are kept.
+"""
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+from config import env_flag
+
+METRICS_ENABLED = env_flag("METRICS_ENABLED", True)
+
+# Upper bounds (seconds) of the stage duration histogram buckets; +Inf is implicit
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_HISTOGRAM = "stage_duration_seconds"
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_summaries = {}  # (name, labels) -> [count, sum]
+_histograms = {}  # (name, labels) -> [bucket counts (last one is +Inf), count, sum, bucket bounds]
+
+_current_request_stats = contextvars.ContextVar("current_request_stats", default=None)
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_key(key: tuple) -> str:
+    name, labels = key
+    return name + _format_labels(labels)
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Increments a process-wide counter and, if one is active, the current request's tally."""
+    if METRICS_ENABLED:
+        key = _key(name, labels)
+        with _lock:
+            _counters[key] = _counters.get(key, 0) + value
+    stats = _current_request_stats.get()
+    if stats is not None:
+        stats.add(name, value)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Records one observation in a count/sum summary."""
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.setdefault(key, [0, 0.0])
+        summary[0] += 1
+        summary[1] += value
+
+
+def observe_histogram(name: str, value: float, buckets: tuple = DURATION_BUCKETS, **labels) -> None:
+    """Records one observation in a histogram with the given bucket upper bounds."""
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    position = bisect.bisect_left(buckets, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(buckets) + 1), 0, 0.0, buckets]
+        histogram[0][position] += 1
+        histogram[1] += 1
+        histogram[2] += value
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Adds one stage duration to the stage histogram and to the current request's timings."""
+    observe_histogram(STAGE_HISTOGRAM, seconds, stage=stage)
+    stats = _current_request_stats.get()
+    if stats is not None:
+        stats.add_timing(stage, seconds)
+
+
+class _StageTimer:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_stage(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def timer(stage: str):
+    """Context manager timing one pipeline stage (a no-op when metrics are disabled)."""
+    return _StageTimer(stage) if METRICS_ENABLED else _NULL_TIMER
+
+
+def snapshot() -> dict:
+    """Returns a point-in-time copy of every counter, summary and histogram."""
+    with _lock:
+        histograms = {}
+        for key, (bucket_counts, count, total, buckets) in _histograms.items():
+            cumulative, running = {}, 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], bucket_counts):
+                running += bucket_count
+                cumulative[str(bound)] = running
+            histograms[_format_key(key)] = {"count": count, "sum": total, "buckets": cumulative}
+        return {
+            "counters": {_format_key(key): value for key, value in _counters.items()},
+            "summaries": {_format_key(key): {"count": count, "sum": total} for key, (count, total) in _summaries.items()},
+            "histograms": histograms,
+        }
+
+
+def render_prometheus(gauges: dict | None = None) -> str:
+    """
+    Renders every metric in the Prometheus text exposition format (0.0.4).
+    `gauges` adds point-in-time values: {"name": value} or {"name": {label_tuple: value}}.
+    """
+    lines = []
+
+    def type_line(name: str, metric_type: str, seen: set) -> None:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    with _lock:
+        counters = sorted(_counters.items())
+        summaries = sorted(_summaries.items())
+        histograms = sorted((key, (list(counts), count, total, buckets))
+                            for key, (counts, count, total, buckets) in _histograms.items())
+
+    seen = set()
+    for (name, labels), value in counters:
+        type_line(name, "counter", seen)
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), (count, total) in summaries:
+        type_line(name, "summary", seen)
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+    for (name, labels), (bucket_counts, count, total, buckets) in histograms:
+        type_line(name, "histogram", seen)
+        running = 0
+        for bound, bucket_count in zip(list(buckets) + ["+Inf"], bucket_counts):
+            running += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {running}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+    for name, value in sorted((gauges or {}).items()):
+        type_line(name, "gauge", seen)
+        labelled = value if isinstance(value, dict) else {(): value}
+        for labels, labelled_value in labelled.items():
+            lines.append(f"{name}{_format_labels(labels)} {labelled_value:g}")
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """Thread-safe tally of counter increments and stage timings made while handling one request."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._timings = {}  # stage -> [calls, total seconds], in first-seen order
+        self.started = time.perf_counter()
+
+    def add(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def add_timing(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            timing = self._timings.setdefault(stage, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+    def timings(self) -> dict:
+        with self._lock:
+            return {stage: (calls, total) for stage, (calls, total) in self._timings.items()}
+
+
+def start_request() -> RequestStats:
+    """Attaches a fresh RequestStats to the current context and returns it."""
+    stats = RequestStats()
+    _current_request_stats.set(stats)
+    return stats
+
+
+def current_request() -> RequestStats | None:
+    return _current_request_stats.get()
+
+
+def server_timing_header(stats: RequestStats) -> str:
+    """
+    Server-Timing value for a request: one entry per stage with the summed duration in ms (stages that
+    ran concurrently can add up to more than the total), the call count, and the total request time.
+    """
+    entries = [f'{stage};dur={total * 1000:.1f};desc="{calls}x"' for stage, (calls, total) in stats.timings().items()]
+    entries.append(f"total;dur={(time.perf_counter() - stats.started) * 1000:.1f}")
+    return ", ".join(entries)
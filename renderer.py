@@ -0,0 +1,231 @@
+"""
+Single-pass rendering of a Gemini explanation into HTML.
+
+render_document() walks the Markdown once: it follows the active heading, records the heading and
+preceding text of every [IMAGE] placeholder, and swaps each placeholder for a sentinel token, so
+lists, tables and fenced code blocks around a placeholder render as a unit. The HTML is then cut at
+the sentinels into a list of parts with one empty position per image slot. Placeholders inside
+fenced code blocks are left as text, as in the streaming splitter.
+
+markdown2 slows down more than linearly on long documents, so the converted text is fed to one
+Markdown instance in chunks of about RENDER_CHUNK_CHARS. A chunk only ends before an unindented
+heading line that follows a blank line and is outside fenced code, raw HTML blocks and HTML comments:
+such a heading cannot belong to a list item, paragraph or HTML block above it, so the result is the same
+as converting the document in one go. The single pass is about correctness, not speed: with chunking it
+takes about as long as the old per-segment rendering (see benchmarks/bench_renderer.py), where one
+markdown2 call over the whole document takes about twice as long for long explanations.
+"""
+import re
+import secrets
+
+import metrics
+from streaming import IMAGE_PLACEHOLDER
+
+MARKDOWN_EXTRAS = ["fenced-code-blocks", "tables", "cuddled-lists", "smarty-pants"]
+HEADING_REGEX = re.compile(r"^\s*(#{1,6})\s*(.+?)\s*(?:#\s*)*$", re.MULTILINE)
+
+# Converted text per markdown2 call; chunks only end before a heading, so they can be larger
+RENDER_CHUNK_CHARS = 2000
+
+_FENCE_RE = re.compile(r"^\s{0,3}(`{3,}|~{3,})")
+# Headings a chunk may start with; indented ones can be part of a list item
+_CHUNK_HEADING_RE = re.compile(r"^#{1,6}(\s|$)")
+# A line opening a raw HTML block, which runs until the tag is closed again
+_HTML_BLOCK_RE = re.compile(r"^\s{0,3}<([A-Za-z][A-Za-z0-9-]*)[\s/>]")
+_VOID_TAGS = frozenset("area base br col embed hr img input link meta source track wbr".split())
+# Reference-style link definitions apply to the whole document, so chunking is skipped when present
+_LINK_DEFINITION_RE = re.compile(r"^\s{0,3}\[[^\]]+\]:\s*\S")
+# Lines a placeholder directly below stays attached to (list items and their indented continuations)
+_LIST_LINE_RE = re.compile(r"^(\s+\S|\s{0,3}([-*+]|\d+[.)])\s)")
+
+
+def render_markdown(text_segment: str) -> str:
+    import markdown2 # Deferred to the first render to keep it out of the cold start
+    with metrics.timer("markdown_render"):
+        return markdown2.markdown(text_segment, extras=MARKDOWN_EXTRAS)
+
+
+def _convert_chunks(chunks: list[list[str]]) -> str:
+    import markdown2
+    with metrics.timer("markdown_render"):
+        converter = markdown2.Markdown(extras=MARKDOWN_EXTRAS) # convert() resets it; not shared between threads
+        # Blocks are separated by a blank line, as convert() does within one chunk
+        return "\n".join(converter.convert("".join(chunk)) for chunk in chunks if any(piece.strip() for piece in chunk))
+
+
+class HeadingTracker:
+    """
+    Follows the active heading through the explanation so each [IMAGE] knows which section it belongs to.
+    Lines inside fenced code blocks (e.g. "# comment" in Python) are not headings.
+    """
+
+    def __init__(self, user_prompt: str):
+        self.active_heading_text = user_prompt # Default heading is the user's initial prompt
+        self.active_heading_level = 0
+        self.first_h1_text = None
+        self._fence = None # Opening fence marker while inside a fenced code block
+
+    @property
+    def in_code_block(self) -> bool:
+        return self._fence is not None
+
+    def update(self, text_segment: str) -> None:
+        # The last heading seen becomes the context for the *next* [IMAGE] tag
+        for line in text_segment.splitlines():
+            if self._fence is not None:
+                if line.strip().startswith(self._fence):
+                    self._fence = None
+                continue
+            fence_match = ("`" in line or "~" in line) and _FENCE_RE.match(line)
+            if fence_match:
+                self._fence = fence_match.group(1)
+                continue
+            heading_match = "#" in line and HEADING_REGEX.match(line)
+            if heading_match:
+                self._set_heading(len(heading_match.group(1)), heading_match.group(2).strip())
+
+    def _set_heading(self, level: int, text: str) -> None:
+        self.active_heading_text = text
+        self.active_heading_level = level
+        print(f"DEBUG: Active heading updated to (L{self.active_heading_level}): '{self.active_heading_text}' from text segment.")
+
+        if not self.first_h1_text and self.active_heading_level == 1:
+            self.first_h1_text = self.active_heading_text
+            print(f"DEBUG: Set first_h1_text to: '{self.first_h1_text}'")
+
+    def image_slot(self, part_index: int, context: str) -> dict:
+        return {
+            "part_index": part_index,
+            "heading": self.active_heading_text,
+            "heading_level": self.active_heading_level,
+            "first_h1_text": self.first_h1_text,
+            "context": context,
+        }
+
+
+class RenderedDocument:
+    """
+    Rendered HTML of a whole explanation, held as a list of parts with an empty position per image slot.
+    image_slots[n] (heading, context, ...) describes the placeholder filled by image_html[n] in assemble().
+    """
+
+    def __init__(self, parts: list[str], slot_positions: list[int], image_slots: list[dict]):
+        self.parts = parts
+        self.slot_positions = slot_positions
+        self.image_slots = image_slots
+
+    def assemble(self, image_html: list[str]) -> str:
+        parts = list(self.parts)
+        for position, html in zip(self.slot_positions, image_html):
+            parts[position] = html
+        return "".join(parts)
+
+
+def _track_html_block(html_block: list | None, line: str) -> list | None:
+    """Follows raw HTML blocks line by line: returns [tag, open count] while one is open, else None."""
+    if html_block is None:
+        match = "<" in line and _HTML_BLOCK_RE.match(line)
+        if not match or match.group(1).lower() in _VOID_TAGS:
+            return None
+        html_block = [match.group(1).lower(), 0]
+    tag = html_block[0]
+    html_block[1] += len(re.findall(rf"<{tag}[\s/>]", line, re.IGNORECASE))
+    html_block[1] -= len(re.findall(rf"</{tag}\s*>", line, re.IGNORECASE))
+    return html_block if html_block[1] > 0 else None
+
+
+def _in_html_comment(in_comment: bool, line: str) -> bool:
+    """Follows <!-- ... --> comments line by line: True if one is still open after the line."""
+    position = 0
+    while True:
+        if in_comment:
+            end = line.find("-->", position)
+            if end < 0:
+                return True
+            in_comment, position = False, end + 3
+        else:
+            start = line.find("<!--", position)
+            if start < 0:
+                return False
+            in_comment, position = True, start + 4
+
+
+def render_document(text: str, user_prompt: str) -> RenderedDocument:
+    """
+    Renders the full explanation once and returns it with the image slots found in the same pass.
+    """
+    sentinel = f"BUJJIIMAGE{secrets.token_hex(4)}N" # Word characters only, so markdown2 passes it through
+    headings = HeadingTracker(user_prompt)
+    image_slots = []
+    chunks = [[]] # Markdown with placeholders replaced by sentinels, cut before headings
+    source = chunks[0]
+    chunk_chars = 0
+    has_link_definitions = False
+    html_block = None # [tag, depth] while inside a raw HTML block
+    in_comment = False # Inside an HTML comment, which markdown2 passes through across blank lines
+    context = [] # Raw text since the previous placeholder
+    previous_line = ""
+
+    for line in text.splitlines(keepends=True):
+        if not headings.in_code_block:
+            if (chunk_chars >= RENDER_CHUNK_CHARS and html_block is None and not in_comment
+                    and not previous_line.strip() and _CHUNK_HEADING_RE.match(line)):
+                source = []
+                chunks.append(source)
+                chunk_chars = 0
+            if "]:" in line and _LINK_DEFINITION_RE.match(line):
+                has_link_definitions = True
+            if not in_comment:
+                html_block = _track_html_block(html_block, line)
+            if "<!--" in line or in_comment:
+                in_comment = _in_html_comment(in_comment, line)
+        chunk_chars += len(line)
+
+        if headings.in_code_block or IMAGE_PLACEHOLDER not in line:
+            headings.update(line)
+            source.append(line)
+            context.append(line)
+            previous_line = line
+            continue
+
+        standalone = line.strip() == IMAGE_PLACEHOLDER
+        for position, piece in enumerate(line.split(IMAGE_PLACEHOLDER)):
+            if position:
+                slot_number = len(image_slots)
+                image_slots.append(headings.image_slot(slot_number, "".join(context)))
+                context = []
+                token = f"{sentinel}{slot_number}E"
+                if standalone and _LIST_LINE_RE.match(previous_line):
+                    token += "\n" # Stays in the list item above, so the list (and its numbering) continues
+                elif standalone:
+                    token = f"\n{token}\n\n" # Own block: ends the paragraph above and starts a new one below
+                source.append(token)
+            if piece:
+                headings.update(piece)
+                context.append(piece)
+                if not standalone:
+                    source.append(piece)
+        previous_line = line
+
+    if has_link_definitions:
+        chunks = [[piece for chunk in chunks for piece in chunk]]
+    html = _convert_chunks(chunks)
+
+    parts, positions = [], {}
+    slot_re = re.compile(rf"<p>\s*{sentinel}(\d+)E\s*</p>|{sentinel}(\d+)E")
+    last_end = 0
+    for match in slot_re.finditer(html):
+        parts.append(html[last_end:match.start()])
+        positions[int(match.group(1) or match.group(2))] = len(parts)
+        parts.append("")
+        last_end = match.end()
+    parts.append(html[last_end:])
+
+    slot_positions = []
+    for slot_number in range(len(image_slots)):
+        if slot_number not in positions:
+            print(f"WARNING: Image slot {slot_number} was lost while rendering Markdown. Appending it at the end.")
+            positions[slot_number] = len(parts)
+            parts.append("")
+        slot_positions.append(positions[slot_number])
+    return RenderedDocument(parts, slot_positions, image_slots)
@@ -0,0 +1,187 @@
+"""
+Request deadlines and circuit breakers for the upstream calls (Gemini and Bing).
+
+Every request gets an end-to-end time budget (REQUEST_BUDGET_SECONDS). The deadline lives in a
+context variable, so it follows the request into the image worker threads, and each stage asks
+time_left() / has_time() before starting upstream work and caps its timeouts with it.
+
+A CircuitBreaker per upstream bounds the calls in flight (callers wait at most
+CIRCUIT_QUEUE_TIMEOUT for a slot) and opens after CIRCUIT_FAILURE_THRESHOLD consecutive failures.
+While open, calls fail immediately with CircuitOpenError; after CIRCUIT_RESET_SECONDS one trial
+call is let through and its outcome closes or re-opens the circuit.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+
+import metrics
+from config import env_int, env_float
+
+# End-to-end time budget of one request (seconds); 0 disables deadlines
+REQUEST_BUDGET_SECONDS = env_float("REQUEST_BUDGET_SECONDS", 30.0)
+# Budget that must be left to still ask Gemini for image queries; below it the heading is the query
+IMAGE_QUERY_MIN_SECONDS = env_float("IMAGE_QUERY_MIN_SECONDS", 8.0)
+# Budget that must be left to still fetch Bing results; below it images render as image-error
+IMAGE_FETCH_MIN_SECONDS = env_float("IMAGE_FETCH_MIN_SECONDS", 2.0)
+
+GEMINI_MAX_IN_FLIGHT = max(1, env_int("GEMINI_MAX_IN_FLIGHT", 32))
+BING_MAX_IN_FLIGHT = max(1, env_int("BING_MAX_IN_FLIGHT", 16))
+CIRCUIT_FAILURE_THRESHOLD = max(1, env_int("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_SECONDS = env_float("CIRCUIT_RESET_SECONDS", 30.0)
+CIRCUIT_QUEUE_TIMEOUT = env_float("CIRCUIT_QUEUE_TIMEOUT", 2.0)
+
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+def start_deadline(budget_seconds: float = REQUEST_BUDGET_SECONDS) -> float | None:
+    """Sets the current context's deadline (a time.monotonic() value) budget_seconds from now."""
+    deadline = time.monotonic() + budget_seconds if budget_seconds > 0 else None
+    _current_deadline.set(deadline)
+    return deadline
+
+
+def time_left() -> float | None:
+    """Seconds left in the current request's budget (never negative), or None without a deadline."""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def has_time(min_seconds: float) -> bool:
+    remaining = time_left()
+    return remaining is None or remaining >= min_seconds
+
+
+def cap_timeout(timeout: float | None) -> float | None:
+    """The given timeout limited to the time left in the budget."""
+    remaining = time_left()
+    if remaining is None:
+        return timeout
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open or whose in-flight limit is reached."""
+
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream} unavailable ({reason})")
+        self.upstream = upstream
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a bounded number of calls in flight."""
+
+    def __init__(self, name: str, max_in_flight: int, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS, queue_timeout: float = CIRCUIT_QUEUE_TIMEOUT):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None # time.monotonic() when the circuit opened, None while closed
+        self._trial_running = False
+        self.rejected = 0
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def _reject(self, reason: str):
+        with self._lock:
+            self.rejected += 1
+        metrics.inc("circuit_breaker_rejections_total", upstream=self.name, reason=reason)
+        return CircuitOpenError(self.name, reason)
+
+    def _admit(self) -> bool:
+        """Admits the call, returning True if it is the half-open trial call; raises if the circuit is open."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+        raise self._reject("open")
+
+    def record_success(self, trial: bool = False) -> None:
+        with self._lock:
+            self._failures = 0
+            if self._opened_at is not None:
+                print(f"INFO: Circuit for {self.name} closed again.")
+            self._opened_at = None
+            if trial:
+                self._trial_running = False
+
+    def record_failure(self, trial: bool = False) -> None:
+        with self._lock:
+            self._failures += 1
+            if trial:
+                self._trial_running = False
+            if trial or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.times_opened += 1
+                print(f"WARNING: Circuit for {self.name} opened after {self._failures} consecutive failure(s). "
+                      f"Failing fast for {self.reset_seconds:g}s.")
+                metrics.inc("circuit_breaker_opened_total", upstream=self.name)
+
+    @contextlib.contextmanager
+    def guard(self, is_failure=lambda e: True):
+        """
+        Runs the block as one upstream call: waits (bounded by CIRCUIT_QUEUE_TIMEOUT and the request
+        budget) for an in-flight slot and records the outcome. Exceptions for which is_failure(e)
+        returns True count as failures; they are re-raised either way.
+        """
+        trial = self._admit()
+        wait = cap_timeout(self.queue_timeout)
+        if not self._slots.acquire(timeout=wait):
+            if trial:
+                with self._lock:
+                    self._trial_running = False
+            raise self._reject("saturated")
+        try:
+            yield
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure(trial)
+            elif trial:
+                self.record_success(trial)
+            raise
+        except BaseException:
+            # Cancelled without a verdict (e.g. GeneratorExit when a streaming client goes away)
+            if trial:
+                with self._lock:
+                    self._trial_running = False
+            raise
+        else:
+            self.record_success(trial)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self._state(),
+                "consecutive_failures": self._failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "max_in_flight": self.max_in_flight,
+            }
+
+
+gemini_breaker = CircuitBreaker("gemini", GEMINI_MAX_IN_FLIGHT)
+bing_breaker = CircuitBreaker("bing", BING_MAX_IN_FLIGHT)
@@ -0,0 +1,93 @@
+"""
+Helpers for streaming an explanation to the browser while Gemini is still generating it.
+
+MarkdownSectionSplitter turns the model's text chunks into complete blocks that can be rendered
+on their own: a block ends at a heading, at an [IMAGE] placeholder, or at a blank line that is
+not followed by a list item or indented continuation. Fenced code blocks are never split.
+"""
+import json
+import re
+
+IMAGE_PLACEHOLDER = "[IMAGE]"
+
+_HEADING_LINE_RE = re.compile(r"^\s{0,3}#{1,6}(\s|$)")
+_FENCE_RE = re.compile(r"^\s{0,3}(`{3,}|~{3,})")
+# Lines that continue the previous block after a blank line (loose lists, indented content, tables)
+_CONTINUATION_RE = re.compile(r"^(\s+\S|\s{0,3}([-*+]|\d+[.)])\s|\s{0,3}\|)")
+
+
+class MarkdownSectionSplitter:
+    """
+    Incrementally splits streamed Markdown into ("text", markdown) and ("image", None) blocks.
+
+    feed() returns the blocks completed by the new chunk; close() flushes whatever is left.
+    Concatenating every text block and an [IMAGE] per image block reproduces the input.
+    """
+
+    def __init__(self):
+        self._pending = ""  # Incomplete last line
+        self._lines = []  # Complete lines of the current block
+        self._fence = None  # Opening fence marker while inside a fenced code block
+        self._after_blank = False
+
+    def feed(self, chunk: str) -> list[tuple[str, str | None]]:
+        blocks = []
+        self._pending += chunk
+        *complete_lines, self._pending = self._pending.split("\n")
+        for line in complete_lines:
+            self._consume_line(line + "\n", blocks)
+        return blocks
+
+    def close(self) -> list[tuple[str, str | None]]:
+        blocks = []
+        if self._pending:
+            line, self._pending = self._pending, ""
+            self._consume_line(line, blocks)
+        self._flush(blocks)
+        return blocks
+
+    def _flush(self, blocks: list) -> None:
+        if self._lines:
+            blocks.append(("text", "".join(self._lines)))
+            self._lines = []
+
+    def _consume_line(self, line: str, blocks: list) -> None:
+        stripped = line.strip()
+
+        if self._fence is not None:
+            self._lines.append(line)
+            if stripped.startswith(self._fence):
+                self._fence = None
+            return
+
+        fence_match = _FENCE_RE.match(line)
+        if fence_match:
+            if self._after_blank:
+                self._flush(blocks)
+            self._fence = fence_match.group(1)
+            self._lines.append(line)
+            self._after_blank = False
+            return
+
+        if _HEADING_LINE_RE.match(line) or (self._after_blank and stripped and not _CONTINUATION_RE.match(line)):
+            self._flush(blocks)
+
+        if IMAGE_PLACEHOLDER in line:
+            # Text around the placeholder stays in the neighbouring blocks, as with re.split on [IMAGE]
+            pieces = line.split(IMAGE_PLACEHOLDER)
+            for position, piece in enumerate(pieces):
+                if position:
+                    self._flush(blocks)
+                    blocks.append(("image", None))
+                if piece:
+                    self._lines.append(piece)
+            self._after_blank = False
+            return
+
+        self._lines.append(line)
+        self._after_blank = not stripped
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,129 @@
+import http.server
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+
+class StandInServer:
+    """Local HTTP server whose response delay, status and body the test sets; counts the requests it gets."""
+
+    def __init__(self):
+        self.delay = 0.0
+        self.status = 200
+        self.body = b"<html></html>"
+        self.content_type = "text/html"
+        self.redirects = {}  # path -> Location header of a 302 answer
+        self.paths = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.paths.append(self.path)
+                time.sleep(server.delay)
+                location = server.redirects.get(self.path.split("?")[0])
+                self.send_response(302 if location else server.status)
+                if location:
+                    self.send_header("Location", location)
+                self.send_header("Content-Type", server.content_type)
+                self.send_header("Content-Length", str(len(server.body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(server.body)
+                except OSError:
+                    pass  # The client gave up waiting
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def hits(self) -> int:
+        return len(self.paths)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stand_in_server():
+    server = StandInServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    """Circuit breakers are process-wide; failures from one test must not open the circuit for the next."""
+    import resilience
+    monkeypatch.setattr(resilience, "gemini_breaker", resilience.CircuitBreaker("gemini", resilience.GEMINI_MAX_IN_FLIGHT))
+    monkeypatch.setattr(resilience, "bing_breaker", resilience.CircuitBreaker("bing", resilience.BING_MAX_IN_FLIGHT))
+
+
+@pytest.fixture(autouse=True)
+def fresh_request_context():
+    """Requests made through Flask's test client set the deadline and request stats in the test's own context."""
+    import metrics
+    import resilience
+    deadline_token = resilience._current_deadline.set(None)
+    stats_token = metrics._current_request_stats.set(None)
+    yield
+    metrics._current_request_stats.reset(stats_token)
+    resilience._current_deadline.reset(deadline_token)
+
+
+# --- The app against offline stand-ins for Gemini and Bing (see benchmarks/fakes.py) ---
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """Stand-in Gemini model: every topic gets an explanation with three [IMAGE] slots."""
+    import app
+    from fakes import FakeGeminiModel
+    model = FakeGeminiModel(images=[3])
+    monkeypatch.setattr(app, "model", model)
+    monkeypatch.setattr(app, "IMAGE_QUERY_MODE", "auto")
+    return model
+
+
+@pytest.fixture
+def bing_results(monkeypatch):
+    """Bing stand-in serving the recorded results page, with an empty result set cache and a fresh HTTP pool."""
+    import http_client
+    import image_search
+    from fakes import BingStandInServer
+    server = BingStandInServer().start()
+    monkeypatch.setattr(image_search, "BING_SEARCH_URL", server.search_url)
+    monkeypatch.setattr(image_search, "result_set_cache", image_search.ResultSetCache(512, 3600))
+    monkeypatch.setattr(http_client, "_client", http_client.PooledHttpClient(backoff_factor=0, backoff_jitter=0))
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def answers(tmp_path, monkeypatch):
+    """Empty answer cache of the app that does not keep degraded answers."""
+    import answer_cache
+    cache = answer_cache.AnswerCache(str(tmp_path / "answers.sqlite3"), ttl_seconds=3600, max_bytes=1024 * 1024,
+                                     wait_timeout=5)
+    monkeypatch.setattr(answer_cache, "answer_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def web(fake_model, answers, monkeypatch):
+    """Flask test client of the app, with the image proxy off so pages carry the original image URLs."""
+    import app
+    import image_proxy
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_ENABLED", False)
+    return app.app.test_client()
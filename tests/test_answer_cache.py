@@ -0,0 +1,209 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache
+
+MODEL = "test-model"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnswerCache(str(tmp_path / "answers.sqlite3"), ttl_seconds=3600, max_bytes=1024 * 1024, wait_timeout=5)
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(answer_cache, "_POLL_INTERVAL", 0.01)
+
+
+def run_threads(count: int, target) -> list:
+    results = [None] * count
+    errors = [None] * count
+
+    def run(index):
+        try:
+            results[index] = target(index)
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return list(zip(results, errors))
+
+
+def lease_owner(cache: AnswerCache, prompt: str) -> str | None:
+    with sqlite3.connect(cache.path) as connection:
+        row = connection.execute("SELECT owner FROM leases WHERE key = ?", (cache.key_for(prompt, MODEL),)).fetchone()
+    return row[0] if row else None
+
+
+def test_concurrent_identical_prompts_generate_once(cache):
+    generations = []
+
+    def compute():
+        generations.append(1)
+        time.sleep(0.2)
+        return "<p>answer</p>", None, True
+
+    outcomes = run_threads(8, lambda _: cache.get_or_compute("What is DNA?", MODEL, compute))
+
+    assert len(generations) == 1
+    assert all(error is None for _, error in outcomes)
+    assert all(result[0] == "<p>answer</p>" for result, _ in outcomes)
+    assert sorted(result[2] for result, _ in outcomes) == ["coalesced"] * 7 + ["miss"]
+
+
+def test_prompts_differing_in_case_and_spacing_share_an_answer(cache):
+    cache.get_or_compute("What is  DNA?", MODEL, lambda: ("<p>answer</p>", None, True))
+    html, error, outcome = cache.get_or_compute(" what is dna? ", MODEL, lambda: pytest.fail("regenerated"))
+    assert (html, error, outcome) == ("<p>answer</p>", None, "hit")
+
+
+def test_waiters_regenerate_when_the_leader_fails(cache):
+    calls = []
+    calls_lock = threading.Lock()
+
+    def compute():
+        with calls_lock:
+            calls.append(1)
+            leader = len(calls) == 1
+        if leader:
+            time.sleep(0.2)  # Let the other threads start waiting on this flight
+            raise RuntimeError("leader failed")
+        return "<p>retry</p>", None, True
+
+    outcomes = run_threads(4, lambda _: cache.get_or_compute("Photosynthesis", MODEL, compute))
+
+    failures = [error for _, error in outcomes if error is not None]
+    assert len(failures) == 1 and str(failures[0]) == "leader failed"
+    assert [result[0] for result, error in outcomes if error is None] == ["<p>retry</p>"] * 3
+    assert len(calls) == 4
+    assert cache.get(cache.key_for("Photosynthesis", MODEL)) == "<p>retry</p>"
+    assert not cache._local_flights
+
+
+def test_failed_generation_is_not_stored_and_releases_the_lease(cache):
+    html, outcome, flight = cache.acquire("Volcanoes", MODEL)
+    assert (html, outcome) == (None, "miss")
+    assert lease_owner(cache, "Volcanoes") == flight.owner
+
+    cache.finish(flight, None)
+
+    assert lease_owner(cache, "Volcanoes") is None
+    assert cache.acquire("Volcanoes", MODEL)[1] == "miss"
+
+
+def test_page_with_failed_images_is_not_stored(cache):
+    html, error, outcome = cache.get_or_compute("Auroras", MODEL, lambda: ("<p>no images</p>", None, False))
+
+    assert (html, error, outcome) == ("<p>no images</p>", None, "miss")
+    assert cache.get(cache.key_for("Auroras", MODEL)) is None
+    assert lease_owner(cache, "Auroras") is None
+    assert cache.get_or_compute("Auroras", MODEL, lambda: ("<p>images</p>", None, True))[1:] == (None, "miss")
+    assert cache.get(cache.key_for("Auroras", MODEL)) == "<p>images</p>"
+
+
+def test_page_with_failed_images_is_kept_only_for_the_degraded_ttl(tmp_path):
+    cache = AnswerCache(str(tmp_path / "degraded.sqlite3"), ttl_seconds=3600, max_bytes=1024, wait_timeout=1,
+                        degraded_ttl_seconds=0.1)
+    _, _, flight = cache.acquire("Eclipses", MODEL)
+    cache.finish(flight, "<p>no images</p>", cacheable=False)
+    assert cache.get(cache.key_for("Eclipses", MODEL)) == "<p>no images</p>"
+
+    time.sleep(0.15)
+
+    assert cache.get(cache.key_for("Eclipses", MODEL)) is None
+
+
+def test_expired_lease_of_another_worker_is_taken_over(cache):
+    key = cache.key_for("Black holes", MODEL)
+    connection = cache._connect()
+    connection.execute("INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?)", (key, "dead-worker", time.time() - 1))
+    connection.close()
+
+    started = time.monotonic()
+    html, outcome, flight = cache.acquire("Black holes", MODEL)
+
+    assert (html, outcome) == (None, "miss")
+    assert time.monotonic() - started < 1
+    assert lease_owner(cache, "Black holes") == flight.owner
+    cache.finish(flight, "<p>black holes</p>")
+    assert lease_owner(cache, "Black holes") is None
+
+
+def test_lease_that_runs_out_while_waiting_is_taken_over(cache):
+    key = cache.key_for("Glaciers", MODEL)
+    connection = cache._connect()
+    connection.execute("INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?)", (key, "stuck-worker", time.time() + 0.3))
+    connection.close()
+
+    started = time.monotonic()
+    html, outcome, flight = cache.acquire("Glaciers", MODEL)
+
+    assert (html, outcome) == (None, "miss")
+    assert 0.2 < time.monotonic() - started < cache.wait_timeout
+    assert lease_owner(cache, "Glaciers") == flight.owner
+    cache.finish(flight, None)
+
+
+def test_answer_from_another_worker_is_coalesced(cache):
+    other_worker = AnswerCache(cache.path, cache.ttl_seconds, cache.max_bytes, cache.wait_timeout)
+    _, _, other_flight = other_worker.acquire("Tides", MODEL)
+    threading.Timer(0.2, other_worker.finish, args=(other_flight, "<p>tides</p>")).start()
+
+    html, outcome, flight = cache.acquire("Tides", MODEL)
+
+    assert (html, outcome, flight) == ("<p>tides</p>", "coalesced", None)
+    assert not cache._local_flights
+
+
+def test_bypass_generates_and_still_stores_the_answer(cache):
+    cache.put(cache.key_for("Magnets", MODEL), "Magnets", MODEL, "<p>old</p>")
+
+    html, error, outcome = cache.get_or_compute("Magnets", MODEL, lambda: ("<p>new</p>", None, True), bypass=True)
+
+    assert (html, error, outcome) == ("<p>new</p>", None, "bypass")
+    assert cache.acquire("Magnets", MODEL)[:2] == ("<p>new</p>", "hit")
+
+
+def test_entries_expire_after_the_ttl(tmp_path):
+    cache = AnswerCache(str(tmp_path / "ttl.sqlite3"), ttl_seconds=0.1, max_bytes=1024, wait_timeout=1)
+    key = cache.key_for("Comets", MODEL)
+    cache.put(key, "Comets", MODEL, "<p>comets</p>")
+    assert cache.get(key) == "<p>comets</p>"
+
+    time.sleep(0.15)
+
+    assert cache.get(key) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_are_evicted_past_the_size_budget(tmp_path):
+    cache = AnswerCache(str(tmp_path / "lru.sqlite3"), ttl_seconds=3600, max_bytes=100, wait_timeout=1)
+    keys = {prompt: cache.key_for(prompt, MODEL) for prompt in ("a", "b", "c")}
+    cache.put(keys["a"], "a", MODEL, "x" * 40)
+    time.sleep(0.01)
+    cache.put(keys["b"], "b", MODEL, "y" * 40)
+    time.sleep(0.01)
+    cache.get(keys["a"])  # "a" is now more recently used than "b"
+    time.sleep(0.01)
+    cache.put(keys["c"], "c", MODEL, "z" * 40)
+
+    assert cache.get(keys["a"]) == "x" * 40
+    assert cache.get(keys["b"]) is None
+    assert cache.get(keys["c"]) == "z" * 40
+    assert cache.stats()["bytes"] == 80
+
+
+def test_answers_larger_than_the_budget_are_not_stored(tmp_path):
+    cache = AnswerCache(str(tmp_path / "big.sqlite3"), ttl_seconds=3600, max_bytes=10, wait_timeout=1)
+    key = cache.key_for("Everything", MODEL)
+    cache.put(key, "Everything", MODEL, "x" * 11)
+    assert cache.get(key) is None
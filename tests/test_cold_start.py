@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported on first use, never by `import app` (LAZY_INIT)
+DEFERRED_MODULES = ("google.generativeai", "markdown2", "bs4", "PIL")
+
+
+def test_importing_the_app_does_not_load_heavy_modules():
+    script = f"import json, sys, app; print(json.dumps([name for name in {DEFERRED_MODULES!r} if name in sys.modules]))"
+    environment = dict(os.environ, LAZY_INIT="1", WARMUP_ON_START="0", IMAGE_PROXY_SECRET="shared-secret")
+    result = subprocess.run([sys.executable, "-c", script], cwd=REPO_ROOT, env=environment,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-1] == "[]"
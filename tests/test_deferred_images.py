@@ -0,0 +1,127 @@
+import pytest
+
+import app
+import image_search
+from renderer import render_document
+
+PROMPT = "Volcanoes"
+
+# Two main-image candidates under the title, then a sub-image section
+TWO_SLOTS_UNDER_THE_TITLE = """# Volcanoes
+
+Krakatoa erupted with enormous force.
+
+[IMAGE]
+
+Basalt lava flows slowly downhill.
+
+[IMAGE]
+
+## Ash
+
+Ash clouds spread far.
+
+[IMAGE]
+
+## Calderas
+
+Calderas form when the summit collapses.
+
+[IMAGE]
+"""
+
+
+@pytest.fixture
+def explanation(fake_model, bing_results, monkeypatch):
+    """Makes the stand-in model answer every topic with the given Markdown."""
+    import fakes
+
+    def use(text: str) -> str:
+        monkeypatch.setattr(fakes, "canned_markdown", lambda topic, images: text)
+        return text
+    return use
+
+
+def eager_page(text: str) -> tuple[str, list[str]]:
+    """The page and slot HTML /prepare builds, resolving every slot up front in one serial walk."""
+    document = render_document(text, PROMPT)
+    image_html = app.resolve_image_slots(document.image_slots, PROMPT)
+    return document.assemble(image_html), image_html
+
+
+def deferred_page(web) -> tuple[str, list[str], list[dict]]:
+    """
+    The page the browser ends up with after /api/prepare, resolving slots through /api/image in slot order
+    the way resolveImageSlot() in templates/index.html does. Returns (page, slot HTML, /api/image replies).
+    """
+    answer = web.post("/api/prepare", json={"prompt": PROMPT}).get_json()
+    page, replies = answer["html"], {}
+    for descriptor in answer["slots"]:
+        role, avoid_url = descriptor["role"], ""
+        if descriptor["main_slot"] is not None:
+            avoid_url = replies[descriptor["main_slot"]]["main_url"] or ""
+            if avoid_url:
+                role = "sub"
+        fetch_index = descriptor["fetch_index"]
+        if descriptor["previous_sub_slot"] is not None:
+            fetch_index = replies[descriptor["previous_sub_slot"]]["next_fetch_index"]
+        reply = web.get("/api/image", query_string={
+            "slot": descriptor["slot"], "heading": descriptor["heading"], "context": descriptor["context"],
+            "topic": descriptor["topic"], "first_h1": descriptor["first_h1"], "role": role,
+            "fetch_index": fetch_index, "avoid_url": avoid_url,
+        }).get_json()
+        replies[descriptor["slot"]] = reply
+        page = page.replace(app.render_deferred_slot_html(descriptor), reply["html"])
+    ordered = [replies[slot] for slot in sorted(replies)]
+    return page, [reply["html"] for reply in ordered], ordered
+
+
+def fail_queries_containing(word: str, monkeypatch) -> None:
+    cache = image_search.result_set_cache
+    fetch = cache.fetcher
+    monkeypatch.setattr(cache, "fetcher", lambda query: None if word in query else fetch(query))
+
+
+def test_deferred_slots_resolve_like_prepare(web, explanation):
+    from fakes import canned_markdown
+    text = explanation(canned_markdown(PROMPT, 6))
+    page, image_html, replies = deferred_page(web)
+    assert (page, image_html) == eager_page(text)
+    assert all(reply["url"] for reply in replies)
+
+
+def test_sub_image_skips_the_main_image(web, explanation):
+    # Both slots under the title share a query, so the second slot's first candidate is the main image
+    text = explanation(TWO_SLOTS_UNDER_THE_TITLE)
+    page, image_html, replies = deferred_page(web)
+    assert (page, image_html) == eager_page(text)
+
+    main_url = replies[0]["url"]
+    assert main_url and replies[1]["url"] and replies[1]["url"] != main_url
+    assert [reply["main_url"] for reply in replies] == [main_url] * 4
+    # The dedupe moved slot 1 to index 1, so the next sub-image continues at index 2, not the planned 1
+    assert [reply["next_fetch_index"] for reply in replies[1:]] == [2, 3, 4]
+
+
+def test_next_main_candidate_takes_the_main_image_when_the_main_lookup_fails(web, explanation, monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_QUERY_MODE", "local")  # Queries differ per slot, so only the first one fails
+    text = explanation(TWO_SLOTS_UNDER_THE_TITLE)
+    fail_queries_containing("Krakatoa", monkeypatch)
+    page, image_html, replies = deferred_page(web)
+    assert (page, image_html) == eager_page(text)
+
+    assert replies[0]["url"] is None and replies[0]["main_url"] is None
+    assert replies[1]["url"] and replies[1]["main_url"] == replies[1]["url"]
+    assert "Main illustration" in replies[1]["html"]
+    assert replies[2]["main_url"] == replies[1]["url"]
+
+
+def test_failed_sub_image_does_not_advance_the_index(web, explanation, monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_QUERY_MODE", "local")
+    text = explanation(TWO_SLOTS_UNDER_THE_TITLE)
+    fail_queries_containing("Ash", monkeypatch)
+    page, image_html, replies = deferred_page(web)
+    assert (page, image_html) == eager_page(text)
+
+    assert replies[2]["url"] is None
+    assert replies[2]["next_fetch_index"] == replies[1]["next_fetch_index"]
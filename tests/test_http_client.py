@@ -0,0 +1,57 @@
+import socket
+
+import pytest
+import requests
+
+import http_client
+import image_search
+import metrics
+
+
+def counter(name: str) -> float:
+    return metrics.snapshot()["counters"].get(name, 0)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = http_client.PooledHttpClient(connect_timeout=1, read_timeout=0.3, backoff_factor=0, backoff_jitter=0)
+    monkeypatch.setattr(http_client, "_client", client)
+    return client
+
+
+def unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_read_timeout_is_tried_once_and_classified_as_timeout(client, stand_in_server):
+    stand_in_server.delay = 1.0
+    with pytest.raises(requests.exceptions.RequestException) as raised:
+        client.get(stand_in_server.base_url + "/slow")
+    assert http_client.is_timeout(raised.value)
+    assert stand_in_server.hits == 1
+
+
+def test_refused_connection_is_not_a_timeout(client):
+    with pytest.raises(requests.exceptions.ConnectionError) as raised:
+        client.get(f"http://127.0.0.1:{unused_port()}/")
+    assert not http_client.is_timeout(raised.value)
+
+
+def test_server_errors_are_retried(client, stand_in_server):
+    stand_in_server.status = 503
+    assert client.get(stand_in_server.base_url + "/").status_code == 503
+    assert stand_in_server.hits == 1 + http_client.HTTP_RETRIES
+
+
+def test_bing_read_timeout_counts_as_timeout(client, stand_in_server, monkeypatch):
+    monkeypatch.setattr(image_search, "BING_SEARCH_URL", stand_in_server.base_url + "/images/search")
+    stand_in_server.delay = 1.0
+    timeouts = counter('bing_fetch_errors_total{reason="timeout"}')
+    connection_errors = counter('bing_fetch_errors_total{reason="connection"}')
+
+    assert image_search.fetch_result_set("slow query") is None
+
+    assert counter('bing_fetch_errors_total{reason="timeout"}') == timeouts + 1
+    assert counter('bing_fetch_errors_total{reason="connection"}') == connection_errors
@@ -0,0 +1,236 @@
+import hashlib
+import hmac
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+import requests
+
+import http_client
+import image_proxy
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PNG_BODY = b"\x89PNG\r\n\x1a\n" + b"\0" * 64
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_SECRET", "shared-secret")
+
+
+def proxy_enabled(**env) -> bool:
+    """IMAGE_PROXY_ENABLED as a fresh process with the given environment sees it."""
+    environment = {key: value for key, value in os.environ.items() if not key.startswith("IMAGE_PROXY_")}
+    environment.update(env)
+    result = subprocess.run([sys.executable, "-c", "import image_proxy; print(image_proxy.IMAGE_PROXY_ENABLED)"],
+                            cwd=REPO_ROOT, env=environment, capture_output=True, text=True, check=True)
+    return result.stdout.strip().splitlines()[-1] == "True"
+
+
+def test_proxy_is_off_without_a_shared_secret():
+    assert not proxy_enabled()
+    assert not proxy_enabled(IMAGE_PROXY_ENABLED="1")
+    assert proxy_enabled(IMAGE_PROXY_SECRET="shared-secret")
+    assert not proxy_enabled(IMAGE_PROXY_SECRET="shared-secret", IMAGE_PROXY_ENABLED="0")
+
+
+def test_token_round_trip(secret):
+    token = image_proxy.make_token("https://example.com/a.jpg", "https://tse.example/th?id=1")
+    assert image_proxy.read_token(token) == ("https://example.com/a.jpg", "https://tse.example/th?id=1")
+    assert image_proxy.read_token(image_proxy.make_token("https://example.com/b.png")) == ("https://example.com/b.png", None)
+
+
+def test_token_signed_with_another_secret_is_rejected(secret, monkeypatch):
+    token = image_proxy.make_token("https://example.com/a.jpg")
+    key_id = image_proxy.key_id()
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_SECRET", "rotated-secret")
+    assert image_proxy.read_token(token) is None
+    assert image_proxy.key_id() != key_id
+
+
+def test_forged_or_malformed_tokens_are_rejected(secret):
+    token = image_proxy.make_token("https://example.com/a.jpg")
+    payload, _, signature = token.partition(".")
+    forged_payload = image_proxy._b64encode(b"http://169.254.169.254/\n")
+    assert image_proxy.read_token(f"{forged_payload}.{signature}") is None
+    assert image_proxy.read_token(payload) is None
+    assert image_proxy.read_token("not a token") is None
+
+
+def forged_token(key: bytes, url: str) -> str:
+    payload = f"{url}\n".encode("utf-8")
+    signature = hmac.new(key, payload, hashlib.sha256).digest()[:image_proxy._SIGNATURE_BYTES]
+    return f"{image_proxy._b64encode(payload)}.{image_proxy._b64encode(signature)}"
+
+
+def test_without_a_secret_no_token_is_accepted(monkeypatch):
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_SECRET", "")
+    assert image_proxy.read_token(forged_token(b"", "https://attacker.example/anything.png")) is None
+    assert image_proxy.read_token(image_proxy.make_token("https://example.com/a.jpg")) is None
+
+
+@pytest.mark.parametrize("secret_value", ["", "shared-secret"])
+def test_img_route_is_not_found_while_the_proxy_is_disabled(secret_value, monkeypatch):
+    import app
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_ENABLED", False)
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_SECRET", secret_value)
+    monkeypatch.setattr(image_proxy.image_proxy, "resolve", lambda *urls: pytest.fail(f"fetched {urls}"))
+    token = forged_token(secret_value.encode("utf-8"), "https://attacker.example/anything.png")
+    response = app.app.test_client().get(f"/img/{token}")
+    assert response.status_code == 404
+
+
+def test_img_route_serves_signed_tokens_while_the_proxy_is_enabled(secret, monkeypatch):
+    import app
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_ENABLED", True)
+    stored = image_proxy.StoredImage(PNG_BODY, "image/png", "digest")
+    monkeypatch.setattr(image_proxy.image_proxy, "resolve", lambda image_url, thumbnail_url: (stored, "original"))
+    client = app.app.test_client()
+    response = client.get(image_proxy.proxy_url("https://example.com/a.png"))
+    assert response.status_code == 200
+    assert response.data == PNG_BODY
+    assert client.get(f"/img/{forged_token(b'', 'https://attacker.example/anything.png')}").status_code == 404
+
+
+# --- Fetching: only public hosts, on every redirect hop, without retries ---
+
+@pytest.fixture
+def image_host(stand_in_server, monkeypatch):
+    """The stand-in server, reachable as if 127.0.0.1 were a public address."""
+    is_public_address = image_proxy._is_public_address
+    monkeypatch.setattr(image_proxy, "_is_public_address", lambda address: address == "127.0.0.1" or is_public_address(address))
+    stand_in_server.body = PNG_BODY
+    stand_in_server.content_type = "image/png"
+    return stand_in_server
+
+
+@pytest.mark.parametrize("url", [
+    "http://localhost/a.png",
+    "http://images.localhost/a.png",
+    "http://127.0.0.1/a.png",
+    "http://10.0.0.8/a.png",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]/a.png",
+    "http://[::ffff:127.0.0.1]/a.png",
+    "ftp://93.184.216.34/a.png",
+    "http:///a.png",
+])
+def test_non_public_urls_are_refused(url):
+    assert not image_proxy._is_public_url(url)
+
+
+def test_host_names_are_resolved_before_fetching(monkeypatch):
+    addresses = {"cdn.example": "93.184.216.34", "intranet.example": "10.1.2.3"}
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if host not in addresses:
+            raise OSError("unknown host")
+        return [(None, None, None, "", (addresses[host], port))]
+
+    monkeypatch.setattr(image_proxy.socket, "getaddrinfo", getaddrinfo)
+    assert image_proxy._is_public_url("https://cdn.example/a.png")
+    assert not image_proxy._is_public_url("https://intranet.example/a.png")
+    assert not image_proxy._is_public_url("https://unknown.example/a.png")
+
+
+def test_redirect_to_a_private_address_is_not_followed(image_host):
+    image_host.redirects["/a.png"] = "http://169.254.169.254/latest/meta-data/"
+    with pytest.raises(image_proxy.ImageRejected):
+        image_proxy.fetch_image(image_host.base_url + "/a.png")
+    assert image_host.paths == ["/a.png"]
+
+
+def test_redirect_to_localhost_is_not_followed(image_host):
+    image_host.redirects["/a.png"] = image_host.base_url.replace("127.0.0.1", "localhost") + "/b.png"
+    with pytest.raises(image_proxy.ImageRejected):
+        image_proxy.fetch_image(image_host.base_url + "/a.png")
+    assert image_host.paths == ["/a.png"]
+
+
+def test_redirects_between_public_urls_are_followed(image_host):
+    image_host.redirects["/a.png"] = "/b.png"
+    assert image_proxy.fetch_image(image_host.base_url + "/a.png") == (PNG_BODY, "image/png")
+    assert image_host.paths == ["/a.png", "/b.png"]
+
+
+def test_redirect_chains_are_limited(image_host):
+    for hop in range(image_proxy.IMAGE_PROXY_MAX_REDIRECTS + 1):
+        image_host.redirects[f"/{hop}.png"] = f"/{hop + 1}.png"
+    with pytest.raises(image_proxy.ImageRejected):
+        image_proxy.fetch_image(image_host.base_url + "/0.png")
+    assert image_host.hits == image_proxy.IMAGE_PROXY_MAX_REDIRECTS + 1
+
+
+def test_image_fetches_are_not_retried_and_use_their_own_session(image_host):
+    image_host.status = 503
+    with pytest.raises(requests.exceptions.HTTPError):
+        image_proxy.fetch_image(image_host.base_url + "/a.png")
+    assert image_host.hits == 1
+    assert image_proxy.image_http_client is not http_client.get_client()
+    assert image_proxy.image_http_client.session is not http_client.get_client().session
+
+
+# --- Downscaling: bounded decode, shrink once, then re-encode ---
+
+@pytest.fixture
+def Image():
+    return pytest.importorskip("PIL.Image")
+
+
+def encode(image, format: str) -> bytes:
+    out = io.BytesIO()
+    image.save(out, format=format)
+    return out.getvalue()
+
+
+def noise(Image, size: tuple, mode: str = "RGB"):
+    """An image that does not compress well, so it is over the byte cap at its full size."""
+    return Image.frombytes(mode, size, os.urandom(size[0] * size[1] * len(mode)))
+
+
+def test_small_image_is_returned_unchanged(Image):
+    data = encode(Image.new("RGB", (64, 48), "red"), "PNG")
+    assert image_proxy.downscale(data, "image/png") == (data, "image/png")
+
+
+def test_image_over_the_pixel_budget_is_refused_before_decoding(Image, monkeypatch):
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_MAX_PIXELS", 100 * 100)
+    data = encode(Image.new("RGB", (101, 100)), "PNG")
+    monkeypatch.setattr(Image.Image, "load", lambda image: pytest.fail("decoded an image over the pixel budget"))
+    with pytest.raises(image_proxy.ImageRejected):
+        image_proxy.downscale(data, "image/png")
+
+
+@pytest.mark.parametrize("format, mode, content_type", [
+    ("JPEG", "RGB", "image/jpeg"),
+    ("PNG", "RGB", "image/jpeg"),
+    ("PNG", "RGBA", "image/png"),
+])
+def test_large_image_is_shrunk_before_it_is_converted(Image, format, mode, content_type, monkeypatch):
+    data = encode(noise(Image, (1600, 1200), mode), format)
+    convert, converted_sizes = Image.Image.convert, []
+
+    def recording_convert(image, mode=None, *args, **kwargs):
+        if mode in ("RGB", "RGBA"):  # Not the premultiplied "RGBa" Pillow uses inside resize()
+            converted_sizes.append(image.size)
+        return convert(image, mode, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "convert", recording_convert)
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_MAX_BYTES", 10 ** 7)
+    result, result_type = image_proxy.downscale(data, f"image/{format.lower()}")
+
+    assert result_type == content_type
+    assert converted_sizes and all(max(size) <= image_proxy.IMAGE_PROXY_MAX_DIMENSION for size in converted_sizes)
+    with Image.open(io.BytesIO(result)) as image:
+        assert max(image.size) == image_proxy.IMAGE_PROXY_MAX_DIMENSION
+
+
+def test_image_is_made_smaller_until_it_fits_the_byte_cap(Image, monkeypatch):
+    monkeypatch.setattr(image_proxy, "IMAGE_PROXY_MAX_BYTES", 200 * 1024)
+    result, result_type = image_proxy.downscale(encode(noise(Image, (1600, 1200)), "JPEG"), "image/jpeg")
+    assert result_type == "image/jpeg"
+    assert len(result) <= 200 * 1024
+    with Image.open(io.BytesIO(result)) as image:
+        assert max(image.size) < image_proxy.IMAGE_PROXY_MAX_DIMENSION
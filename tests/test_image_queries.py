@@ -0,0 +1,96 @@
+import json
+import threading
+import types
+
+import pytest
+
+import app
+
+TOPIC = "Volcanoes"
+SLOTS = [{"heading": heading, "context": f"Text about {heading.lower()}."} for heading in ("Magma", "Lava", "Ash")]
+
+
+class ScriptedModel:
+    """Answers the batched query prompt with a fixed reply and each single query prompt with '<heading> single'."""
+
+    def __init__(self, batch_reply):
+        self.batch_reply = batch_reply
+        self.batch_calls = 0
+        self.single_headings = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, safety_settings=None, generation_config=None, **kwargs):
+        if "JSON array" in prompt:
+            self.batch_calls += 1
+            if isinstance(self.batch_reply, Exception):
+                raise self.batch_reply
+            return types.SimpleNamespace(text=self.batch_reply)
+        heading = prompt.split('section heading is: "', 1)[1].split('"', 1)[0]
+        with self._lock:
+            self.single_headings.append(heading)
+        return types.SimpleNamespace(text=f"{heading} single")
+
+
+@pytest.fixture
+def scripted(monkeypatch):
+    def use(batch_reply) -> ScriptedModel:
+        model = ScriptedModel(batch_reply)
+        monkeypatch.setattr(app, "model", model)
+        return model
+    monkeypatch.setattr(app, "IMAGE_QUERY_MODE", "gemini")
+    monkeypatch.setattr(app, "IMAGE_QUERY_BATCH", True)
+    return use
+
+
+@pytest.mark.parametrize("reply", [
+    json.dumps(["magma chamber", "lava flow", "ash cloud"]),
+    json.dumps({"queries": ["magma chamber", "lava flow", "ash cloud"]}),
+    "```json\n" + json.dumps(["magma chamber", "lava flow", "ash cloud"]) + "\n```",
+    json.dumps(["Query: magma chamber", '"lava flow"', " ash cloud "]),
+])
+def test_batch_reply_answers_every_slot_with_one_call(scripted, reply):
+    model = scripted(reply)
+    assert app.generate_slot_queries(SLOTS, TOPIC) == ["magma chamber", "lava flow", "ash cloud"]
+    assert model.batch_calls == 1
+    assert model.single_headings == []
+
+
+@pytest.mark.parametrize("reply", [
+    json.dumps(["magma chamber", "lava flow"]),  # Too short
+    json.dumps(["magma chamber", "lava flow", "ash cloud", "extra"]),  # Too long
+    json.dumps({"results": ["magma chamber", "lava flow", "ash cloud"]}),  # Dict without "queries"
+    json.dumps("magma chamber"),
+    "magma chamber, lava flow, ash cloud",  # Not JSON
+    "",
+    RuntimeError("batch call failed"),
+])
+def test_unusable_batch_reply_falls_back_to_per_image_queries(scripted, reply):
+    model = scripted(reply)
+    assert app.generate_slot_queries(SLOTS, TOPIC) == ["Magma single", "Lava single", "Ash single"]
+    assert model.batch_calls == 1
+    assert sorted(model.single_headings) == ["Ash", "Lava", "Magma"]
+
+
+def test_only_empty_batch_entries_go_through_the_per_image_path(scripted):
+    model = scripted(json.dumps(["magma chamber", "", None]))
+    assert app.generate_slot_queries(SLOTS, TOPIC) == ["magma chamber", "Lava single", "Ash single"]
+    assert sorted(model.single_headings) == ["Ash", "Lava"]
+
+
+def test_entry_that_is_empty_after_cleaning_goes_through_the_per_image_path(scripted):
+    model = scripted(json.dumps(["magma chamber", "Query: ", "ash cloud"]))
+    assert app.generate_slot_queries(SLOTS, TOPIC) == ["magma chamber", "Lava single", "ash cloud"]
+    assert model.single_headings == ["Lava"]
+
+
+def test_single_slot_is_not_batched(scripted):
+    model = scripted(json.dumps(["unused"]))
+    assert app.generate_slot_queries(SLOTS[:1], TOPIC) == ["Magma single"]
+    assert model.batch_calls == 0
+
+
+def test_batching_can_be_turned_off(scripted, monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_QUERY_BATCH", False)
+    model = scripted(json.dumps(["magma chamber", "lava flow", "ash cloud"]))
+    assert app.generate_slot_queries(SLOTS, TOPIC) == ["Magma single", "Lava single", "Ash single"]
+    assert model.batch_calls == 0
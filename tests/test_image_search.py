@@ -0,0 +1,116 @@
+import threading
+import time
+
+from image_search import BingResultSet, ResultSetCache
+
+
+class CountingFetcher:
+    """Stand-in for fetch_result_set that records every fetch; queries in `failing` fail (return None)."""
+
+    def __init__(self, failing=(), release=None):
+        self.queries = []
+        self.failing = set(failing)
+        self.release = release  # Event fetches wait on, to keep them in flight
+        self.started = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, query: str) -> BingResultSet | None:
+        with self._lock:
+            self.queries.append(query)
+        self.started.set()
+        if self.release is not None:
+            self.release.wait(5)
+        if query in self.failing:
+            return None
+        return BingResultSet(query, [f"https://example.com/{query}.jpg"], [])
+
+
+def test_repeated_queries_are_fetched_once():
+    fetcher = CountingFetcher()
+    cache = ResultSetCache(max_entries=10, ttl_seconds=60, fetcher=fetcher)
+    first = cache.get("Lava flows")
+    assert cache.get("  lava   FLOWS ") is first
+    assert fetcher.queries == ["Lava flows"]
+    assert (cache.stats()["misses"], cache.stats()["hits"]) == (1, 1)
+
+
+def test_entries_expire_after_the_ttl():
+    fetcher = CountingFetcher()
+    cache = ResultSetCache(max_entries=10, ttl_seconds=0.05, fetcher=fetcher)
+    cache.get("geysers")
+    time.sleep(0.06)
+    cache.get("geysers")
+    assert fetcher.queries == ["geysers", "geysers"]
+    stats = cache.stats()
+    assert (stats["expirations"], stats["misses"], stats["hits"], stats["entries"]) == (1, 2, 0, 1)
+
+
+def test_least_recently_used_entry_is_evicted_and_counted():
+    fetcher = CountingFetcher()
+    cache = ResultSetCache(max_entries=2, ttl_seconds=60, fetcher=fetcher)
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")  # "a" is now more recently used than "b"
+    cache.get("c")
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["entries"] == 2
+
+    cache.get("a")
+    assert fetcher.queries == ["a", "b", "c"]
+    cache.get("b")
+    assert fetcher.queries == ["a", "b", "c", "b"]
+    assert cache.stats()["evictions"] == 2
+
+
+def test_failed_fetches_are_not_cached():
+    fetcher = CountingFetcher(failing={"dead"})
+    cache = ResultSetCache(max_entries=10, ttl_seconds=60, fetcher=fetcher)
+    assert cache.get("dead") is None
+    assert cache.get("dead") is None
+    assert fetcher.queries == ["dead", "dead"]
+    assert cache.stats()["entries"] == 0
+
+
+def test_disabled_cache_fetches_every_time():
+    fetcher = CountingFetcher()
+    cache = ResultSetCache(max_entries=0, ttl_seconds=60, fetcher=fetcher)
+    cache.get("tuff")
+    cache.get("tuff")
+    assert fetcher.queries == ["tuff", "tuff"]
+
+
+def run_concurrent_lookups(cache: ResultSetCache, fetcher: CountingFetcher, query: str, count: int) -> list:
+    results = [None] * count
+
+    def look_up(index):
+        results[index] = cache.get(query)
+
+    threads = [threading.Thread(target=look_up, args=(index,)) for index in range(count)]
+    threads[0].start()
+    fetcher.started.wait(5)  # The first lookup is fetching; the others arrive while it is in flight
+    for thread in threads[1:]:
+        thread.start()
+    while cache.stats()["coalesced"] < count - 1:
+        time.sleep(0.005)
+    fetcher.release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_misses_share_one_fetch():
+    fetcher = CountingFetcher(release=threading.Event())
+    cache = ResultSetCache(max_entries=10, ttl_seconds=60, fetcher=fetcher)
+    results = run_concurrent_lookups(cache, fetcher, "pumice", 8)
+    assert fetcher.queries == ["pumice"]
+    assert results[0] is not None and all(result is results[0] for result in results)
+    assert (cache.stats()["misses"], cache.stats()["coalesced"]) == (1, 7)
+
+
+def test_concurrent_misses_share_a_failed_fetch_without_caching_it():
+    fetcher = CountingFetcher(failing={"obsidian"}, release=threading.Event())
+    cache = ResultSetCache(max_entries=10, ttl_seconds=60, fetcher=fetcher)
+    assert run_concurrent_lookups(cache, fetcher, "obsidian", 4) == [None] * 4
+    assert fetcher.queries == ["obsidian"]
+    cache.get("obsidian")
+    assert fetcher.queries == ["obsidian", "obsidian"]
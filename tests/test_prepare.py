@@ -0,0 +1,140 @@
+import json
+import re
+import socket
+
+import pytest
+
+import app
+import image_search
+import resilience
+
+PROMPT = "Volcanoes"
+
+
+def unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def cached_answer(answers, model_key: str | None = None) -> str | None:
+    return answers.get(answers.key_for(PROMPT, model_key or app.answer_cache_model_key()))
+
+
+def failed_images(html: str) -> int:
+    """Image-error placeholders in a page or in the JSON of streamed events."""
+    return len(re.findall(r'class=\\?"image-error', html))
+
+
+def stream_events(web, prompt: str = PROMPT) -> str:
+    return web.post("/prepare/stream", data={"prompt": prompt}).get_data(as_text=True)
+
+
+@pytest.fixture
+def bing_down(bing_results, monkeypatch):
+    """Bing refusing connections; returns a function that brings it back with a closed circuit."""
+    monkeypatch.setattr(image_search, "BING_SEARCH_URL", f"http://127.0.0.1:{unused_port()}/images/search")
+
+    def bring_back():
+        monkeypatch.setattr(image_search, "BING_SEARCH_URL", bing_results.search_url)
+        monkeypatch.setattr(resilience, "bing_breaker", resilience.CircuitBreaker("bing", resilience.BING_MAX_IN_FLIGHT))
+    return bring_back
+
+
+# --- Degraded answers are not cached ---
+
+def test_healthy_answer_is_cached(web, answers, bing_results):
+    page = web.post("/prepare", data={"prompt": PROMPT}).get_data(as_text=True)
+    assert not failed_images(page)
+    assert not failed_images(cached_answer(answers))
+    assert web.post("/prepare", data={"prompt": PROMPT}).get_data(as_text=True) == page
+    assert answers.hits == 1
+
+
+def test_answer_without_images_is_not_cached_while_bing_is_down(web, answers, bing_down):
+    page = web.post("/prepare", data={"prompt": PROMPT}).get_data(as_text=True)
+    assert failed_images(page)
+    assert cached_answer(answers) is None
+
+    bing_down()  # Bing is back
+    page = web.post("/prepare", data={"prompt": PROMPT}).get_data(as_text=True)
+    assert not failed_images(page)
+    assert answers.hits == 0
+    assert cached_answer(answers) is not None
+
+
+def test_answer_degraded_by_the_time_budget_is_not_cached(web, answers, bing_results, monkeypatch):
+    monkeypatch.setattr(resilience, "IMAGE_FETCH_MIN_SECONDS", 10 ** 6)
+    monkeypatch.setattr(resilience, "IMAGE_QUERY_MIN_SECONDS", 10 ** 6)
+    page = web.post("/prepare", data={"prompt": PROMPT}).get_data(as_text=True)
+    assert failed_images(page)
+    assert bing_results.requests == 0
+    assert cached_answer(answers) is None
+
+
+def test_image_queries_built_without_gemini_are_not_cached(web, answers, bing_results, monkeypatch):
+    monkeypatch.setattr(resilience, "IMAGE_QUERY_MIN_SECONDS", 10 ** 6)  # Images still load, from local queries
+    page = web.post("/prepare", data={"prompt": PROMPT}).get_data(as_text=True)
+    assert not failed_images(page)
+    assert cached_answer(answers) is None
+
+
+def test_streamed_answer_without_images_is_not_cached(web, answers, bing_down):
+    events = stream_events(web)
+    assert "event: done" in events and failed_images(events)
+    assert cached_answer(answers) is None
+
+    bing_down()
+    events = stream_events(web)
+    assert not failed_images(events)
+    assert cached_answer(answers) is not None
+
+
+def test_degraded_answer_is_kept_for_the_degraded_ttl(web, answers, bing_down):
+    answers.degraded_ttl_seconds = 60
+    web.post("/prepare", data={"prompt": PROMPT})
+    assert failed_images(cached_answer(answers))
+
+
+# --- Streamed answers in the answer cache ---
+
+LIST_ACROSS_IMAGE = """# Volcanoes
+
+Volcanoes vent molten rock.
+
+[IMAGE]
+
+## Eruptions
+
+1. Magma rises
+2. Pressure builds
+[IMAGE]
+3. The volcano erupts
+
+Ash clouds follow.
+"""
+
+
+@pytest.fixture
+def list_across_image(fake_model, monkeypatch):
+    import fakes
+    monkeypatch.setattr(fakes, "canned_markdown", lambda topic, images: LIST_ACROSS_IMAGE)
+
+
+def test_streamed_answer_is_cached_as_prepare_renders_it(web, answers, bing_results, list_across_image):
+    events = stream_events(web)
+    assert "event: done" in events
+    streamed_page = cached_answer(answers)
+    assert streamed_page is not None
+    assert streamed_page.count("<ol>") == 1  # The list continues past the image, as in one render_document() pass
+
+    answers.purge()
+    web.post("/prepare", data={"prompt": PROMPT})
+    assert cached_answer(answers) == streamed_page
+
+
+def test_stream_serves_an_answer_cached_by_prepare(web, answers, bing_results, list_across_image):
+    web.post("/prepare", data={"prompt": PROMPT})
+    events = stream_events(web)
+    assert answers.hits == 1
+    assert json.loads(events.split("data: ", 1)[1].split("\n", 1)[0])["html"] == cached_answer(answers)
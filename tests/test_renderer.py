@@ -0,0 +1,60 @@
+import pytest
+
+import renderer
+
+SECTION = """## Section {n}
+
+Some text about part {n} with *emphasis* and a [link](https://example.com/{n}).
+
+[IMAGE]
+
+1. first step
+2. second step
+[IMAGE]
+3. third step
+
+"""
+
+DOCUMENTS = {
+    "sections": "# Title\n\nIntro.\n\n[IMAGE]\n\n" + "".join(SECTION.format(n=n) for n in range(20)),
+    "heading inside a list item": "# Title\n\n" + "Padding paragraph.\n\n" * 5 +
+        "- item one\n  # nested heading\n- item two\n\n## After\n\nText.\n",
+    "heading without a blank line above": "# Title\n\n" + "Padding paragraph.\n\n" * 5 +
+        "A paragraph line\n# Heading right below\n\nText.\n",
+    "heading inside an html block": "# Title\n\n" + "Padding paragraph.\n\n" * 5 +
+        "<div class=\"note\">\n<div>\n\n# not a heading\n\n</div>\ninside\n\n</div>\n\n# Heading\n\nText.\n",
+    "heading inside fenced code": "# Title\n\n" + "Padding paragraph.\n\n" * 5 +
+        "```python\n\n# comment\nx = 1\n```\n\n# Heading\n\n[IMAGE]\n",
+    "heading inside an html comment": "# Title\n\n" + "Padding paragraph.\n\n" * 5 +
+        "<!-- a\n\n# x\n-->\n\n# Heading\n\nText.\n",
+    "heading after a one-line html comment": "# Title\n\n" + "Padding paragraph.\n\n" * 5 +
+        "<!-- note --> <!-- another\n\n# x\n--> text\n\n# Heading\n\n[IMAGE]\n",
+    "void html tag": "# Title\n\n" + "Padding paragraph.\n\n" * 5 + "<br>\n\n# Heading\n\nText.\n",
+}
+
+
+def render(text: str, chunk_chars: int, monkeypatch) -> tuple[str, list[dict]]:
+    monkeypatch.setattr(renderer, "RENDER_CHUNK_CHARS", chunk_chars)
+    document = renderer.render_document(text, "topic")
+    images = [f"<img data-slot=\"{n}\">" for n in range(len(document.image_slots))]
+    return document.assemble(images), document.image_slots
+
+
+@pytest.mark.parametrize("name", DOCUMENTS)
+def test_chunked_rendering_matches_whole_document(name, monkeypatch):
+    text = DOCUMENTS[name]
+    whole_html, whole_slots = render(text, 10 ** 9, monkeypatch)
+    chunked_html, chunked_slots = render(text, 1, monkeypatch)
+    assert chunked_html == whole_html
+    assert chunked_slots == whole_slots
+
+
+def test_list_with_indented_heading_stays_one_list(monkeypatch):
+    html, _ = render(DOCUMENTS["heading inside a list item"], 1, monkeypatch)
+    assert html.count("<ul>") == 1
+
+
+def test_image_slots_carry_their_heading(monkeypatch):
+    _, slots = render(DOCUMENTS["sections"], 1, monkeypatch)
+    assert [slot["heading"] for slot in slots[:3]] == ["Title", "Section 0", "Section 0"]
+    assert all(slot["first_h1_text"] == "Title" for slot in slots)
@@ -0,0 +1,282 @@
+import contextvars
+import socket
+import threading
+import time
+import types
+
+import pytest
+
+import http_client
+import image_search
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError
+
+
+def within_budget(budget_seconds: float, function, *args):
+    """Runs function in a fresh context whose request deadline is budget_seconds away."""
+    def run():
+        resilience.start_deadline(budget_seconds)
+        return function(*args)
+    return contextvars.copy_context().run(run)
+
+
+def timed(function, *args) -> tuple:
+    started = time.monotonic()
+    result = function(*args)
+    return result, time.monotonic() - started
+
+
+class Boom(Exception):
+    pass
+
+
+def fail(breaker: CircuitBreaker, times: int = 1, is_failure=lambda e: True) -> None:
+    for _ in range(times):
+        with pytest.raises(Boom):
+            with breaker.guard(is_failure=is_failure):
+                raise Boom()
+
+
+def succeed(breaker: CircuitBreaker) -> None:
+    with breaker.guard():
+        pass
+
+
+@pytest.fixture
+def bing(stand_in_server, monkeypatch):
+    monkeypatch.setattr(image_search, "BING_SEARCH_URL", stand_in_server.base_url + "/images/search")
+    monkeypatch.setattr(resilience, "IMAGE_FETCH_MIN_SECONDS", 0.1)
+    monkeypatch.setattr(http_client, "_client", http_client.PooledHttpClient())
+    return stand_in_server
+
+
+# --- Request deadlines ---
+
+def test_without_a_deadline_time_is_unlimited():
+    assert contextvars.copy_context().run(resilience.time_left) is None
+    assert contextvars.copy_context().run(resilience.has_time, 10 ** 6)
+    assert contextvars.copy_context().run(resilience.cap_timeout, 7.0) == 7.0
+
+
+def test_deadline_caps_timeouts():
+    assert within_budget(1.0, resilience.cap_timeout, 7.0) <= 1.0
+    assert within_budget(10.0, resilience.cap_timeout, 2.0) == 2.0
+    assert within_budget(1.0, http_client.capped_timeout, (0.5, 6.0))[0] == 0.5
+    assert within_budget(1.0, http_client.capped_timeout, (0.5, 6.0))[1] <= 1.0
+    assert not within_budget(1.0, resilience.has_time, 2.0)
+
+
+def test_deadline_follows_the_context_into_copied_contexts():
+    def in_worker():
+        return contextvars.copy_context().run(resilience.time_left)
+    assert 0 < within_budget(5.0, in_worker) <= 5.0
+
+
+# --- Bing fetches within the budget ---
+
+def test_bing_fetch_never_outlives_the_budget_when_bing_hangs(bing):
+    bing.delay = 5.0
+    result, elapsed = timed(within_budget, 1.0, image_search.fetch_result_set, "hanging query")
+    assert result is None
+    assert elapsed < 1.3
+    assert bing.hits == 1
+
+
+def test_bing_fetch_does_not_retry_past_the_budget(bing):
+    bing.delay = 0.4
+    bing.status = 503
+    result, elapsed = timed(within_budget, 1.0, image_search.fetch_result_set, "overloaded query")
+    assert result is None
+    assert elapsed < 1.3
+    assert bing.hits == 1  # The 0.6 s left cannot cover a retry's backoff plus a connect timeout
+
+
+def test_bing_fetch_retries_while_the_budget_allows(bing, monkeypatch):
+    monkeypatch.setattr(http_client, "_client", http_client.PooledHttpClient(connect_timeout=0.2, backoff_factor=0,
+                                                                             backoff_jitter=0))
+    bing.status = 503
+    assert within_budget(5.0, image_search.fetch_result_set, "flaky query") is None
+    assert bing.hits == 1 + http_client.HTTP_RETRIES
+
+
+def test_refused_connection_is_retried_within_the_budget(monkeypatch):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(image_search, "BING_SEARCH_URL", f"http://127.0.0.1:{port}/images/search")
+    monkeypatch.setattr(resilience, "IMAGE_FETCH_MIN_SECONDS", 0.1)
+    client = http_client.PooledHttpClient(connect_timeout=0.2, backoff_factor=0.1, backoff_jitter=0)
+    monkeypatch.setattr(http_client, "_client", client)
+
+    result, elapsed = timed(within_budget, 1.0, image_search.fetch_result_set, "refused query")
+
+    assert result is None
+    assert elapsed < 1.3
+    assert client.errors == 1
+
+
+def test_bing_fetch_is_skipped_when_too_little_budget_is_left(bing, monkeypatch):
+    monkeypatch.setattr(resilience, "IMAGE_FETCH_MIN_SECONDS", 2.0)
+    assert within_budget(1.0, image_search.fetch_result_set, "late query") is None
+    assert bing.hits == 0
+
+
+# --- Circuit breaker ---
+
+def test_circuit_opens_after_consecutive_failures_and_fails_fast():
+    breaker = CircuitBreaker("test", max_in_flight=4, failure_threshold=3, reset_seconds=60)
+    fail(breaker, 2)
+    succeed(breaker)  # A success resets the count
+    fail(breaker, 2)
+    assert breaker.state == "closed"
+    fail(breaker)
+    assert breaker.state == "open"
+
+    calls = []
+    with pytest.raises(CircuitOpenError) as raised:
+        with breaker.guard():
+            calls.append(1)
+    assert raised.value.reason == "open"
+    assert not calls
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_exceptions_that_are_not_outages_do_not_open_the_circuit():
+    breaker = CircuitBreaker("test", max_in_flight=4, failure_threshold=2, reset_seconds=60)
+    fail(breaker, 5, is_failure=lambda e: False)
+    assert breaker.state == "closed"
+
+
+def test_half_open_circuit_lets_one_trial_call_through():
+    breaker = CircuitBreaker("test", max_in_flight=4, failure_threshold=1, reset_seconds=0.05)
+    fail(breaker)
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+
+    trial_running, release_trial = threading.Event(), threading.Event()
+
+    def trial():
+        with breaker.guard():
+            trial_running.set()
+            release_trial.wait(5)
+
+    thread = threading.Thread(target=trial)
+    thread.start()
+    trial_running.wait(5)
+    with pytest.raises(CircuitOpenError):
+        succeed(breaker)  # Only one trial at a time
+    release_trial.set()
+    thread.join(5)
+    assert breaker.state == "closed"
+
+
+def test_failed_trial_reopens_the_circuit():
+    breaker = CircuitBreaker("test", max_in_flight=4, failure_threshold=3, reset_seconds=0.05)
+    fail(breaker, 3)
+    time.sleep(0.06)
+    fail(breaker)  # The trial call
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+
+
+def test_calls_beyond_max_in_flight_wait_then_are_rejected():
+    breaker = CircuitBreaker("test", max_in_flight=2, queue_timeout=0.2)
+    holding, release = threading.Barrier(3), threading.Event()
+
+    def hold():
+        with breaker.guard():
+            holding.wait(5)
+            release.wait(5)
+
+    threads = [threading.Thread(target=hold) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    holding.wait(5)
+
+    started = time.monotonic()
+    with pytest.raises(CircuitOpenError) as raised:
+        succeed(breaker)
+    assert raised.value.reason == "saturated"
+    assert 0.15 < time.monotonic() - started < 1
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    succeed(breaker)  # Slots are released again
+    assert breaker.state == "closed"  # Saturation is not an upstream failure
+
+
+def test_waiting_for_a_slot_is_capped_by_the_budget():
+    breaker = CircuitBreaker("test", max_in_flight=1, queue_timeout=5)
+    holding, release = threading.Event(), threading.Event()
+
+    def hold():
+        with breaker.guard():
+            holding.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait(5)
+    try:
+        _, elapsed = timed(within_budget, 0.2, lambda: pytest.raises(CircuitOpenError, succeed, breaker))
+        assert elapsed < 1
+    finally:
+        release.set()
+        thread.join(5)
+
+
+# --- Gemini streams ---
+
+QUERY_PROMPT = 'The current section heading is: "Lava"'
+
+
+@pytest.fixture
+def single_gemini_slot(fake_model, monkeypatch):
+    breaker = CircuitBreaker("gemini", max_in_flight=1, failure_threshold=1, reset_seconds=0.05, queue_timeout=0.1)
+    monkeypatch.setattr(resilience, "gemini_breaker", breaker)
+    return breaker
+
+
+def test_explanation_stream_holds_its_slot_until_it_is_read(single_gemini_slot):
+    import app
+    stream = app.generate_explanation_stream("Volcanoes")
+    first_chunk = next(stream)
+    with pytest.raises(CircuitOpenError) as raised:
+        app.call_gemini("image_query", QUERY_PROMPT)
+    assert raised.value.reason == "saturated"
+
+    assert first_chunk + "".join(stream)
+    assert app.call_gemini("image_query", QUERY_PROMPT).text == "Lava diagram"
+
+
+def test_abandoned_explanation_stream_releases_its_slot(single_gemini_slot):
+    import app
+    stream = app.generate_explanation_stream("Volcanoes")
+    next(stream)
+    stream.close()  # The streaming client went away
+    assert app.call_gemini("image_query", QUERY_PROMPT).text == "Lava diagram"
+
+
+def test_failure_while_reading_the_stream_opens_the_circuit(single_gemini_slot, fake_model, monkeypatch):
+    import app
+
+    def stream_that_times_out(text):
+        yield types.SimpleNamespace(text=text[:10])
+        raise TimeoutError("stream stalled")
+
+    monkeypatch.setattr(fake_model, "_stream", stream_that_times_out)
+    with pytest.raises(TimeoutError):
+        list(app.generate_explanation_stream("Volcanoes"))
+    assert single_gemini_slot.state == "open"
+
+
+def test_abandoned_trial_stream_does_not_keep_the_circuit_half_open(single_gemini_slot):
+    import app
+    fail(single_gemini_slot)
+    time.sleep(0.06)
+    stream = app.generate_explanation_stream("Volcanoes")
+    next(stream)  # The half-open trial call
+    stream.close()
+    assert app.call_gemini("image_query", QUERY_PROMPT).text == "Lava diagram"
+    assert single_gemini_slot.state == "closed"
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from streaming import IMAGE_PLACEHOLDER, MarkdownSectionSplitter, sse_event
+
+DOCUMENT = """# Volcanoes
+
+Volcanoes vent molten rock.
+[IMAGE]
+
+## Eruptions
+
+1. Magma rises
+
+2. Pressure builds
+   and keeps building
+[IMAGE]
+3. The volcano erupts
+
+| Type | Example |
+|---|---|
+
+| Shield | Mauna Loa |
+
+```python
+# not a heading
+
+[IMAGE]
+```
+
+Text with [IMAGE] in the middle and [IMAGE] twice.
+No newline at the end"""
+
+
+def split(text: str, chunk_size: int) -> list[tuple[str, str | None]]:
+    splitter = MarkdownSectionSplitter()
+    blocks = []
+    for start in range(0, len(text), chunk_size):
+        blocks.extend(splitter.feed(text[start:start + chunk_size]))
+    return blocks + splitter.close()
+
+
+def joined(blocks) -> str:
+    return "".join(text if kind == "text" else IMAGE_PLACEHOLDER for kind, text in blocks)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 10 ** 6])
+def test_blocks_reproduce_the_input_however_it_is_chunked(chunk_size):
+    blocks = split(DOCUMENT, chunk_size)
+    assert joined(blocks) == DOCUMENT
+    assert blocks == split(DOCUMENT, 10 ** 6)
+
+
+def test_headings_and_placeholders_end_blocks():
+    blocks = split("# Title\nIntro.\n[IMAGE]\n## Section\nBody.\n", 5)
+    assert blocks == [
+        ("text", "# Title\nIntro.\n"),
+        ("image", None),
+        ("text", "\n"),
+        ("text", "## Section\nBody.\n"),
+    ]
+
+
+def test_blank_line_before_a_new_paragraph_ends_the_block():
+    assert split("First paragraph.\n\nSecond paragraph.\n", 4) == [
+        ("text", "First paragraph.\n\n"),
+        ("text", "Second paragraph.\n"),
+    ]
+
+
+@pytest.mark.parametrize("continuation", ["2. Second item\n", "- Other item\n", "   indented continuation\n",
+                                          "| a | b |\n"])
+def test_continuation_lines_after_a_blank_line_stay_in_the_block(continuation):
+    text = "1. First item\n\n" + continuation
+    assert split(text, 3) == [("text", text)]
+
+
+def test_fenced_code_is_never_split():
+    code = "```python\n# comment\n\n[IMAGE]\n\nx = 1\n```\n"
+    blocks = split("Intro.\n\n" + code + "After.\n", 2)
+    assert blocks == [("text", "Intro.\n\n"), ("text", code + "After.\n")]
+    assert ("image", None) not in blocks
+
+
+def test_tilde_fence_only_closes_on_its_own_marker():
+    code = "~~~\n```\n# still code\n~~~\n"
+    assert split(code, 1) == [("text", code)]
+
+
+def test_placeholder_in_the_middle_of_a_line():
+    assert split("Before [IMAGE] after [IMAGE]\n", 3) == [
+        ("text", "Before "),
+        ("image", None),
+        ("text", " after "),
+        ("image", None),
+        ("text", "\n"),
+    ]
+
+
+def test_placeholder_split_across_chunks():
+    splitter = MarkdownSectionSplitter()
+    assert splitter.feed("Intro.\n[IMA") == []
+    assert splitter.feed("GE]\nMore") == [("text", "Intro.\n"), ("image", None)]
+    assert splitter.close() == [("text", "\nMore")]
+
+
+def test_sse_event_format():
+    message = sse_event("image", {"slot": 2, "html": "<p>a\nb</p>"})
+    assert message.startswith("event: image\ndata: ") and message.endswith("\n\n")
+    assert json.loads(message.split("data: ", 1)[1]) == {"slot": 2, "html": "<p>a\nb</p>"}